@@ -4,12 +4,19 @@ Here are all subprocess, threading etc related utilities,
 most of them quite low level.
 """
 
+from __future__ import print_function
+
 from threading import Lock, currentThread
 import sys
 import os
 from contextlib import contextmanager
 import errno
 import time
+_moduleLoadTime = time.time()  # for ExecingProcess.startupReport
+import pickle
+import array
+import types
+from collections import OrderedDict
 from extpickle import Pickler, Unpickler
 
 
@@ -45,535 +52,5010 @@ class ForwardedKeyboardInterrupt(Exception):
     pass
 
 
+try:
+    from concurrent.futures import CancelledError, TimeoutError as FutureTimeoutError
+except ImportError:  # Python 2 without the futures backport
+    class CancelledError(Exception):
+        pass
+
+    class FutureTimeoutError(Exception):
+        pass
+
+
+class Tracing:
+    """
+    Opt-in timeline tracing over processes.
+    Spans (spawn, pickling, the work in the child, execInMainProc, message transfer)
+    are recorded in the parent and in the children.
+    Each process appends its events to its own file in the trace directory.
+    writeChromeTrace() merges them into one Chrome trace-event JSON file,
+    which can be loaded e.g. in chrome://tracing or Perfetto.
+
+    Enable it via Tracing.enable() or by setting the env var TASKSYSTEM_TRACE_DIR.
+    The children get it via the environment.
+    """
+
+    EnvVar = "TASKSYSTEM_TRACE_DIR"
+    FlushThreshold = 1000  # number of events
+    traceDir = None
+    pid = None
+    events = []
+    lock = Lock()
+    _atexitRegistered = False
+
+    @classmethod
+    def enable(clazz, traceDir=None):
+        """
+        :param str|None traceDir: where to put the event files. By default, a new temp dir.
+        :return: traceDir
+        :rtype: str
+        """
+        if traceDir is None:
+            import tempfile
+            traceDir = tempfile.mkdtemp(prefix="TaskSystem-trace-")
+        elif not os.path.isdir(traceDir):
+            os.makedirs(traceDir)
+        os.environ[clazz.EnvVar] = traceDir
+        clazz._setup(traceDir)
+        return traceDir
+
+    @classmethod
+    def disable(clazz):
+        clazz.flush()
+        os.environ.pop(clazz.EnvVar, None)
+        with clazz.lock:
+            clazz.traceDir = None
+
+    @classmethod
+    def checkEnv(clazz):
+        """
+        Enables tracing if the env var is set, e.g. in a child when the parent has it enabled.
+        """
+        traceDir = os.environ.get(clazz.EnvVar)
+        if traceDir and (traceDir != clazz.traceDir or clazz.pid != os.getpid()):
+            clazz._setup(traceDir)
+
+    @classmethod
+    def _setup(clazz, traceDir):
+        with clazz.lock:
+            clazz.traceDir = traceDir
+            clazz.pid = os.getpid()
+            clazz.events = []
+            if not clazz._atexitRegistered:
+                import atexit
+                atexit.register(clazz.flush)
+                clazz._atexitRegistered = True
+
+    @classmethod
+    def isEnabled(clazz):
+        return clazz.traceDir is not None
+
+    @classmethod
+    def _checkPid(clazz):
+        if clazz.pid != os.getpid():
+            # We are in a fork. The events so far belong to the parent.
+            clazz.pid = os.getpid()
+            clazz.events = []
+
+    @classmethod
+    def _addEvent(clazz, event):
+        with clazz.lock:
+            clazz._checkPid()
+            clazz.events.append(event)
+            if len(clazz.events) >= clazz.FlushThreshold:
+                clazz._flush()
+
+    @classmethod
+    def addSpan(clazz, name, startTime, endTime, args=None):
+        """
+        :param str name:
+        :param float startTime: time.time()
+        :param float endTime: time.time()
+        :param dict[str]|None args: shown in the trace viewer
+        """
+        if clazz.traceDir is None:
+            return
+        event = {
+            "name": name, "cat": "TaskSystem", "ph": "X",
+            "ts": startTime * 1e6, "dur": (endTime - startTime) * 1e6,
+            "pid": os.getpid(), "tid": _getThreadIdent()}
+        if args:
+            event["args"] = args
+        clazz._addEvent(event)
+
+    @classmethod
+    @contextmanager
+    def span(clazz, name, args=None):
+        if clazz.traceDir is None:
+            yield
+            return
+        startTime = time.time()
+        try:
+            yield
+        finally:
+            clazz.addSpan(name, startTime, time.time(), args)
+
+    @classmethod
+    def setProcessName(clazz, name):
+        if clazz.traceDir is None:
+            return
+        clazz._addEvent({"name": "process_name", "ph": "M", "pid": os.getpid(), "args": {"name": name}})
+
+    @classmethod
+    def flush(clazz):
+        """
+        Writes the recorded events of this process to the trace directory.
+        This is called at exit, and at the end of AsyncTask and ExecingProcess children.
+        """
+        with clazz.lock:
+            clazz._flush()
+
+    @classmethod
+    def _flush(clazz):
+        clazz._checkPid()
+        if clazz.traceDir is None or not clazz.events:
+            return
+        import json
+        events, clazz.events = clazz.events, []
+        try:
+            with open(os.path.join(clazz.traceDir, "%i.jsonl" % os.getpid()), "a") as f:
+                for event in events:
+                    f.write(json.dumps(event) + "\n")
+        except (IOError, OSError) as e:
+            # Tracing should never break the program, e.g. when the trace dir was removed.
+            print("Tracing: cannot write events: %s" % e)
+
+    @classmethod
+    def writeChromeTrace(clazz, filename, traceDir=None):
+        """
+        Merges the events of all processes into a Chrome trace-event JSON file.
+        Children must have exited (or flushed) to be complete.
+
+        :param str filename:
+        :param str|None traceDir: by default, the current one
+        :return: number of events
+        :rtype: int
+        """
+        import json
+        clazz.flush()
+        traceDir = traceDir or clazz.traceDir
+        assert traceDir, "tracing not enabled"
+        events = []
+        for fn in sorted(os.listdir(traceDir)):
+            if not fn.endswith(".jsonl"):
+                continue
+            with open(os.path.join(traceDir, fn)) as f:
+                for line in f:
+                    try:
+                        events.append(json.loads(line))
+                    except ValueError:
+                        pass  # incomplete line, e.g. the process crashed while writing
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        return len(events)
+
+
+Tracing.checkEnv()
+
+
 class _AsyncCallQueue:
+    """
+    The asyncExec protocol (used by execInMainProc):
+    The child sends (asyncExec, (requestId, func)) and the parent answers
+    with (result or exception, (requestId, value)).
+    Multiple threads in the child can have requests in flight at the same time.
+    By default, the parent executes them inline in the asyncCall loop, one after another.
+    If `HostThreads` > 0, they are executed concurrently in a process-wide thread pool of that size.
+    Note that a blocking request (e.g. one which does a nested asyncCall) then occupies a pool thread,
+    so they can deadlock once all threads are taken.
+    In both cases, all requests are answered before the asyncCall loop returns,
+    so that no late answer reaches the next task on a reused connection.
+
+    For asyncCallIter, the child sends (item, value) for every item.
+    The parent grants credits via (credit, (-grantId, numItems)) or cancels via (cancel, (-grantId, None)),
+    i.e. these use the negative request ids, in sequence.
+    """
+
     Self = None
+    HostThreads = 0
 
     class Types:
         result = 0
         exception = 1
         asyncExec = 2
+        item = 3
+        credit = 4
+        cancel = 5
 
     def __init__(self, queue):
+        import threading
         assert not self.Self
         self.__class__.Self = self
         self.mutex = Lock()
+        self.responseCond = threading.Condition(self.mutex)
+        self.sendLock = Lock()
+        self.nextRequestId = 0
+        self.responses = {}  # requestId -> (type, value)
+        self.haveReader = False
         self.queue = queue
 
     def put(self, type, value):
-        self.queue.put((type, value))
+        with self.sendLock:
+            self.queue.put((type, value))
 
     def asyncExecClient(self, func):
         with self.mutex:
-            self.put(self.Types.asyncExec, func)
-            t, value = self.queue.get()
-            if t == self.Types.result:
-                return value
-            elif t == self.Types.exception:
-                raise value
+            self.nextRequestId += 1
+            requestId = self.nextRequestId
+        with Tracing.span("execInMainProc", {"requestId": requestId}):
+            self.put(self.Types.asyncExec, (requestId, func))
+            t, value = self._getResponse(requestId)
+        if t == self.Types.result:
+            return value
+        elif t == self.Types.exception:
+            raise value
+        else:
+            assert False, "bad behavior of asyncCall in asyncExec (%r)" % t
+
+    def _getResponse(self, requestId, block=True):
+        """
+        Waits for the response to our request.
+        One of the waiting threads reads from the queue
+        and hands over the responses for the other threads.
+        If not `block`, returns None if the response is not there yet.
+        """
+        with self.responseCond:
+            while requestId not in self.responses:
+                if not self.haveReader:
+                    self.haveReader = True
+                    break
+                if not block:
+                    return None
+                self.responseCond.wait()
             else:
-                assert False, "bad behavior of asyncCall in asyncExec (%r)" % t
+                return self.responses.pop(requestId)
+        try:
+            while True:
+                if not block and not self.queue.poll():
+                    return None
+                t, (responseId, value) = self.queue.get()
+                if responseId == requestId:
+                    return t, value
+                with self.responseCond:
+                    self.responses[responseId] = (t, value)
+                    self.responseCond.notifyAll()
+        finally:
+            with self.responseCond:
+                self.haveReader = False
+                self.responseCond.notifyAll()
 
     @classmethod
-    def asyncExecHost(clazz, task, func):
+    def asyncExecHost(clazz, task, requestId, func, sendLock=None):
         q = task
         name = "<unknown>"
         try:
             name = repr(func)
-            res = func()
+            with Tracing.span("execInMainProc host", {"requestId": requestId}):
+                res = func()
         except Exception as exc:
-            print "Exception in asyncExecHost", name, exc
-            q.put((clazz.Types.exception, exc))
+            print("Exception in asyncExecHost", name, exc)
+            msg = (clazz.Types.exception, (requestId, exc))
+        else:
+            msg = (clazz.Types.result, (requestId, res))
+        try:
+            if sendLock:
+                with sendLock:
+                    q.put(msg)
+            else:
+                q.put(msg)
+        except (IOError, ProcConnectionDied):
+            # broken pipe or so. parent quit. treat like a SIGINT
+            raise KeyboardInterrupt
+
+    _hostPool = None  # (pid, queue)
+    _hostPoolLock = Lock()
+
+    @classmethod
+    def asyncExecHostSubmit(clazz, task, requestId, func, sendLock):
+        """
+        Executes the request via asyncExecHost, in our thread pool if HostThreads > 0, otherwise inline.
+        :return: event which gets set when the request was answered, or None if it was answered already
+        :rtype: threading.Event|None
+        """
+        if clazz.HostThreads <= 0:
+            clazz.asyncExecHost(task, requestId, func)
+            return None
+        import threading
+        done = threading.Event()
+        clazz._getHostPool().put((task, requestId, func, sendLock, done))
+        return done
+
+    @classmethod
+    def _getHostPool(clazz):
+        import threading
+        if PY3:
+            from queue import Queue
         else:
+            from Queue import Queue
+        with clazz._hostPoolLock:
+            # After a fork, the threads are gone, so check the pid.
+            if clazz._hostPool is None or clazz._hostPool[0] != os.getpid():
+                queue = Queue()
+                for i in range(clazz.HostThreads):
+                    thread = threading.Thread(
+                        target=clazz._hostPoolThread, args=(queue,), name="asyncExecHost pool %i" % i)
+                    thread.daemon = True
+                    thread.start()
+                clazz._hostPool = (os.getpid(), queue)
+            return clazz._hostPool[1]
+
+    @classmethod
+    def _hostPoolThread(clazz, queue):
+        while True:
+            task, requestId, func, sendLock, done = queue.get()
             try:
-                q.put((clazz.Types.result, res))
-            except IOError:
-                # broken pipe or so. parent quit. treat like a SIGINT
-                raise KeyboardInterrupt
+                clazz.asyncExecHost(task, requestId, func, sendLock=sendLock)
+            except KeyboardInterrupt:
+                pass  # The child died. The asyncCall loop will notice that.
+            except Exception:
+                print("Exception in asyncExecHost pool")
+                sys.excepthook(*sys.exc_info())
+            finally:
+                done.set()
+
+    @staticmethod
+    def asyncExecHostPending(pending, done):
+        """
+        :param list[threading.Event] pending: requests which are executed in the thread pool. updated inplace
+        :param threading.Event|None done: from asyncExecHostSubmit
+        """
+        pending[:] = [event for event in pending if not event.is_set()]
+        if done is not None:
+            pending.append(done)
 
+    @staticmethod
+    def asyncExecHostDrain(pending):
+        """
+        Waits until all requests from asyncExecHostPending were answered.
+        """
+        for event in pending:
+            event.wait()
+        del pending[:]
 
-def asyncCall(func, name=None, mustExec=False):
-    """
-    This executes func() in another process and waits/blocks until
-    it is finished. The returned value is passed back to this process
-    and returned. Exceptions are passed back as well and will be
-    reraised here.
 
-    If `mustExec` is set, the other process must `exec()` after the `fork()`.
-    If it is not set, it might omit the `exec()`, depending on the platform.
+def _asyncCallChild(q, func, name):
     """
-
-    def doCall(queue):
-        q = _AsyncCallQueue(queue)
+    Child side of asyncCall: executes func() and passes the result
+    or the exception back via the _AsyncCallQueue q.
+    """
+    try:
         try:
-            try:
+            with Tracing.span("asyncCall func", {"name": name}):
                 res = func()
-            except KeyboardInterrupt as exc:
-                print "Exception in asyncCall", name, ": KeyboardInterrupt"
-                q.put(q.Types.exception, ForwardedKeyboardInterrupt(exc))
-            except BaseException as exc:
-                print "Exception in asyncCall", name
-                sys.excepthook(*sys.exc_info())
-                q.put(q.Types.exception, exc)
-            else:
+        except KeyboardInterrupt as exc:
+            print("Exception in asyncCall", name, ": KeyboardInterrupt")
+            q.put(q.Types.exception, ForwardedKeyboardInterrupt(exc))
+        except BaseException as exc:
+            print("Exception in asyncCall", name)
+            sys.excepthook(*sys.exc_info())
+            q.put(q.Types.exception, exc)
+        else:
+            with Tracing.span("asyncCall send result", {"name": name}):
                 q.put(q.Types.result, res)
-        except (KeyboardInterrupt, ForwardedKeyboardInterrupt):
-            print "asyncCall: SIGINT in put, probably the parent died"
-            # ignore
+    except (KeyboardInterrupt, ForwardedKeyboardInterrupt):
+        print("asyncCall: SIGINT in put, probably the parent died")
+        # ignore
 
-    task = AsyncTask(func=doCall, name=name, mustExec=mustExec)
 
+def _asyncCallHostLoop(task, ignoreItems=False, sendLock=None):
+    """
+    Parent side of asyncCall: serves asyncExec requests until
+    the final result or exception arrives.
+    :param bool ignoreItems: skip asyncCallIter items, e.g. after cancellation
+    :param Lock|None sendLock: for everything we send to the task
+    :return: (type, value) with type being _AsyncCallQueue.Types.result or .exception
+    """
+    if sendLock is None:
+        sendLock = Lock()  # the asyncExec requests might be answered from multiple threads
+    pending = []
     while True:
-        # If there is an unhandled exception in doCall or the process got killed/segfaulted or so,
+        # If there is an unhandled exception in the child or the process got killed/segfaulted or so,
         # this will raise an EOFError here.
         # However, normally, we should catch all exceptions and just reraise them here.
         t,value = task.get()
-        if t == _AsyncCallQueue.Types.result:
-            return value
-        elif t == _AsyncCallQueue.Types.exception:
-            raise value
+        if t in (_AsyncCallQueue.Types.result, _AsyncCallQueue.Types.exception):
+            _AsyncCallQueue.asyncExecHostDrain(pending)
+            return t, value
         elif t == _AsyncCallQueue.Types.asyncExec:
-            _AsyncCallQueue.asyncExecHost(task, value)
+            requestId, func = value
+            _AsyncCallQueue.asyncExecHostPending(
+                pending, _AsyncCallQueue.asyncExecHostSubmit(task, requestId, func, sendLock=sendLock))
+        elif t == _AsyncCallQueue.Types.item and ignoreItems:
+            pass
         else:
             assert False, "unknown _AsyncCallQueue type %r" % t
 
 
+def _asyncCallResult(t, value):
+    if t == _AsyncCallQueue.Types.result:
+        return value
+    elif t == _AsyncCallQueue.Types.exception:
+        raise value
+    else:
+        assert False, "unknown _AsyncCallQueue type %r" % t
 
-def attrChain(base, *attribs, **kwargs):
-    default = kwargs.get("default", None)
-    obj = base
-    for attr in attribs:
-        if obj is None: return default
-        obj = getattr(obj, attr, None)
-    if obj is None: return default
-    return obj
 
+def asyncCall(func, name=None, mustExec=False, env_update=None, cache=None):
+    """
+    This executes func() in another process and waits/blocks until
+    it is finished. The returned value is passed back to this process
+    and returned. Exceptions are passed back as well and will be
+    reraised here.
 
-# This is needed in some cases to avoid pickling problems with bounded funcs.
-def funcCall(attrChainArgs, args=()):
-    f = attrChain(*attrChainArgs)
-    return f(*args)
+    If `mustExec` is set, the other process must `exec()` after the `fork()`.
+    If it is not set, it might omit the `exec()`, depending on the platform.
+    `env_update` is used together with `mustExec`, see AsyncTask.
+    If `cache` (an AsyncCallCache) is given, the result is memoized (if func can be pickled for the key).
+    """
+    if cache is not None:
+        return cache.asyncCall(func, name=name, mustExec=mustExec, env_update=env_update)
 
+    with Tracing.span("asyncCall", {"name": name}):
+        task = _asyncCallStartTask(func, name=name, mustExec=mustExec, env_update=env_update)
+        t, value = _asyncCallHostLoop(task)
+    if Tracing.isEnabled():
+        task.join()  # so that the child has written its events
+    return _asyncCallResult(t, value)
 
-class ExecingProcess:
+
+def _asyncCallStartTask(func, name, mustExec, env_update=None):
     """
-    This is a replacement for multiprocessing.Process which always
-    uses fork+exec, not just fork.
-    This ensures that you have a separate independent process.
-    This can avoid many types of bugs, such as:
-      http://stackoverflow.com/questions/24509650
-      http://bugs.python.org/issue6721
-      http://stackoverflow.com/questions/8110920
-      http://stackoverflow.com/questions/23963997
-      https://github.com/numpy/numpy/issues/654
-      http://comments.gmane.org/gmane.comp.python.numeric.general/60204
+    :return: the started AsyncTask which executes func() via the asyncCall protocol
+    :rtype: AsyncTask
     """
 
-    def __init__(self, target, args, name, env_update):
-        self.target = target
-        self.args = args
-        self.name = name
-        self.env_update = env_update
-        self.daemon = True
-        self.pid = None
-        self.exit_status = None
-
-    def start(self):
-        assert self.pid is None
-        assert self.exit_status is None
-        def pipeOpen():
-            readend, writeend = os.pipe()
-            readend = os.fdopen(readend, "r")
-            writeend = os.fdopen(writeend, "w")
-            return readend, writeend
-        self.pipe_c2p = pipeOpen()
-        self.pipe_p2c = pipeOpen()
-        self.parent_pid = os.getpid()
-        pid = os.fork()
-        if pid == 0:  # child
-            try:
-                sys.stdin.close()  # Force no tty stdin.
-                self.pipe_c2p[0].close()
-                self.pipe_p2c[1].close()
-                py_mod_file = os.path.splitext(__file__)[0] + ".py"
-                assert os.path.exists(py_mod_file)
-                args = [sys.executable,
-                        py_mod_file,
-                        "--forkExecProc",
-                        str(self.pipe_c2p[1].fileno()),
-                        str(self.pipe_p2c[0].fileno())]
-                if self.env_update:
-                    os.environ.update(self.env_update)
-                os.execv(args[0], args)  # Does not return if successful.
-            except BaseException:
-                print "ExecingProcess: Error at initialization."
-                sys.excepthook(*sys.exc_info())
-                sys.exit(1)
-            finally:
-                sys.exit()
-        else:  # parent
-            self.pipe_c2p[1].close()
-            self.pipe_p2c[0].close()
-            self.pid = pid
-            self.pickler = Pickler(self.pipe_p2c[1])
-            self.pickler.dump(self.name)
-            self.pickler.dump(self.target)
-            self.pickler.dump(self.args)
-            self.pipe_p2c[1].flush()
+    def doCall(queue):
+        q = _AsyncCallQueue(queue)
+        _asyncCallChild(q, func, name)
 
-    def _wait(self, options=0):
-        assert self.parent_pid == os.getpid()
-        assert self.pid
-        assert self.exit_status is None
-        pid, exit_status = os.waitpid(self.pid, options)
-        if pid != self.pid:
-            assert pid == 0
-            # It's still alive, otherwise we would have get the same pid.
-            return
-        self.exit_status = exit_status
-        self.pid = None
+    return AsyncTask(func=doCall, name=name, mustExec=mustExec, env_update=env_update)
 
-    def is_alive(self):
-        if self.pid is None:
-            return False
-        self._wait(os.WNOHANG)
-        return self.pid is not None
 
-    def join(self, timeout=None):
-        if not self.is_alive():
-            return
-        if timeout:
-            # Simple and stupid implementation.
-            while self.is_alive():
-                if timeout < 0:
-                    break
-                if timeout < 1.0:
-                    time.sleep(timeout)
-                    break
-                else:
-                    time.sleep(1)
-                    timeout -= 1
-            return
-        self._wait()
+def _asyncCallIterChild(q, func, name, window):
+    """
+    Child side of asyncCallIter: sends the items of func() as long as we have credits,
+    and the final result (None) or exception.
+    """
+    credits = window
+    grantId = 0
+    try:
+        try:
+            it = iter(func())
+            try:
+                while True:
+                    # Check for credits or cancellation. Only block if we are out of credits.
+                    response = q._getResponse(-(grantId + 1), block=credits <= 0)
+                    if response is not None:
+                        grantId += 1
+                        t, value = response
+                        if t == q.Types.cancel:
+                            break
+                        assert t == q.Types.credit, "unexpected asyncCallIter response %r" % t
+                        credits += value
+                        continue
+                    try:
+                        item = next(it)
+                    except StopIteration:
+                        break
+                    q.put(q.Types.item, item)
+                    credits -= 1
+            finally:
+                if hasattr(it, "close"):
+                    it.close()  # e.g. on cancellation, this executes the finally blocks of the generator
+        except KeyboardInterrupt as exc:
+            print("Exception in asyncCallIter", name, ": KeyboardInterrupt")
+            q.put(q.Types.exception, ForwardedKeyboardInterrupt(exc))
+        except BaseException as exc:
+            print("Exception in asyncCallIter", name)
+            sys.excepthook(*sys.exc_info())
+            q.put(q.Types.exception, exc)
+        else:
+            q.put(q.Types.result, None)
+    except (KeyboardInterrupt, ForwardedKeyboardInterrupt):
+        print("asyncCallIter: SIGINT in put, probably the parent died")
+        # ignore
 
-    Verbose = False
 
-    @staticmethod
-    def checkExec():
-        if "--forkExecProc" in sys.argv:
-            try:
-                import better_exchook
-            except ImportError:
-                pass  # Doesn't matter.
+def _asyncCallIterHost(task, window):
+    """
+    Parent side of asyncCallIter. Yields the items and grants new credits as they are consumed.
+    If the consumer stops early, cancels the child and waits for it to finish.
+    """
+    sendLock = Lock()  # the asyncExec requests might be answered from multiple threads
+    pending = []
+    grantId = 0
+    consumed = 0
+    finished = False
+    try:
+        while True:
+            t, value = task.get()
+            if t == _AsyncCallQueue.Types.item:
+                yield value
+                consumed += 1
+                if consumed >= max(window // 2, 1):
+                    grantId += 1
+                    try:
+                        with sendLock:
+                            task.put((_AsyncCallQueue.Types.credit, (-grantId, consumed)))
+                    except (IOError, ProcConnectionDied):
+                        pass  # The child might have finished already. We still get the remaining messages.
+                    consumed = 0
+            elif t in (_AsyncCallQueue.Types.result, _AsyncCallQueue.Types.exception):
+                finished = True
+                _AsyncCallQueue.asyncExecHostDrain(pending)
+                _asyncCallResult(t, value)
+                return
+            elif t == _AsyncCallQueue.Types.asyncExec:
+                requestId, func = value
+                _AsyncCallQueue.asyncExecHostPending(
+                    pending, _AsyncCallQueue.asyncExecHostSubmit(task, requestId, func, sendLock=sendLock))
             else:
-                better_exchook.install()
-            argidx = sys.argv.index("--forkExecProc")
-            writeFileNo = int(sys.argv[argidx + 1])
-            readFileNo = int(sys.argv[argidx + 2])
-            readend = os.fdopen(readFileNo, "r")
-            writeend = os.fdopen(writeFileNo, "w")
-            unpickler = Unpickler(readend)
-            name = unpickler.load()
-            if ExecingProcess.Verbose: print("ExecingProcess child %s (pid %i)" % (name, os.getpid()))
+                assert False, "unknown _AsyncCallQueue type %r" % t
+    finally:
+        if not finished:
             try:
-                target = unpickler.load()
-                args = unpickler.load()
-            except EOFError:
-                print("Error: unpickle incomplete")
-                raise SystemExit
-            ret = target(*args)
-            sys.exited = True
-            # IOError is probably broken pipe. That probably means that the parent died.
-            try: Pickler(writeend).dump(ret)
-            except IOError: pass
-            try: readend.close()
-            except IOError: pass
-            try: writeend.close()
-            except IOError: pass
-            if ExecingProcess.Verbose: print("ExecingProcess child %s (pid %i) finished" % (name, os.getpid()))
-            raise SystemExit
+                with sendLock:
+                    task.put((_AsyncCallQueue.Types.cancel, (-(grantId + 1), None)))
+                # The child might still call execInMainProc, e.g. in a finally block of the generator.
+                t, value = _asyncCallHostLoop(task, ignoreItems=True, sendLock=sendLock)
+            except (IOError, EOFError, ProcConnectionDied, ForwardedKeyboardInterrupt):
+                pass  # the child is gone already
+            else:
+                if t == _AsyncCallQueue.Types.exception:
+                    print("asyncCallIter: exception in the child after cancellation: %r" % (value,))
 
 
-class ProcConnectionDied(Exception):
-    pass
+def asyncCallIter(func, name=None, mustExec=False, env_update=None, window=16):
+    """
+    Like asyncCall, but func() returns an iterable (e.g. func is a generator function),
+    and the items are streamed back as they are produced.
+    This returns a generator over the items.
 
+    There is credit-based flow control: the child sends at most `window` items
+    which we have not consumed yet. Thus the memory is bounded on both sides.
+    If you stop iterating (i.e. the returned generator gets closed or garbage collected),
+    the child gets cancelled: its iterator gets closed (i.e. the finally blocks of the generator run)
+    and we wait until it finishes.
+    The child checks for the cancellation after each item.
 
-class ExecingProcess_ConnectionWrapper(object):
+    :param int window: max number of items in flight
+    :rtype: typing.Generator
     """
-    Wrapper around _multiprocessing.Connection.
-    This is needed to use our own Pickler.
+    assert window >= 1
+
+    def doCall(queue):
+        q = _AsyncCallQueue(queue)
+        _asyncCallIterChild(q, func, name, window)
+
+    task = AsyncTask(func=doCall, name=name, mustExec=mustExec, env_update=env_update)
+    return _asyncCallIterHost(task, window)
+
+
+class AsyncCallFuture(object):
+    """
+    The result of asyncCallFuture().
+    This implements the interface of concurrent.futures.Future.
+    Note that the call is already running when you get this object,
+    thus cancel() kills the child process.
     """
 
-    def __init__(self, fd=None, conn=None):
-        self.fd = fd
-        if self.fd:
-            from _multiprocessing import Connection
-            self.conn = Connection(fd)
-        elif conn:
-            self.conn = conn
-        else:
-            self.conn = None
+    Running = "running"
+    Finished = "finished"
+    Cancelled = "cancelled"
 
-    def __getstate__(self):
-        if self.fd is not None:
-            return {"fd": self.fd}
-        elif self.conn is not None:
-            return {"conn": self.conn}  # Try to pickle the connection.
-        else:
-            return {}
-    def __setstate__(self, state):
-        self.__init__(**state)
+    def __init__(self):
+        import threading
+        self.cond = threading.Condition()
+        self.state = self.Running
+        self._result = None
+        self._exception = None
+        self.callbacks = []
+        self.task = None  # AsyncTask
 
-    def __getattr__(self, attr): return getattr(self.conn, attr)
+    def cancel(self):
+        with self.cond:
+            if self.state != self.Running:
+                return self.state == self.Cancelled
+            self.state = self.Cancelled
+            self.cond.notifyAll()
+        if self.task:
+            self.task.setCancel()
+        self._invokeCallbacks()
+        return True
 
-    def _check_closed(self):
-        if self.conn.closed: raise ProcConnectionDied("connection closed")
-    def _check_writable(self):
-        if not self.conn.writable: raise ProcConnectionDied("connection not writeable")
-    def _check_readable(self):
-        if not self.conn.readable: raise ProcConnectionDied("connection not readable")
+    def cancelled(self):
+        return self.state == self.Cancelled
 
-    def poll(self, *args, **kwargs):
-        while True:
+    def running(self):
+        return self.state == self.Running
+
+    def done(self):
+        return self.state != self.Running
+
+    def _waitDone(self, timeout):
+        with self.cond:
+            if self.state == self.Running:
+                self.cond.wait(timeout)
+            if self.state == self.Running:
+                raise FutureTimeoutError()
+            if self.state == self.Cancelled:
+                raise CancelledError()
+
+    def result(self, timeout=None):
+        self._waitDone(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        self._waitDone(timeout)
+        return self._exception
+
+    def add_done_callback(self, fn):
+        with self.cond:
+            if self.state == self.Running:
+                self.callbacks.append(fn)
+                return
+        fn(self)
+
+    def _invokeCallbacks(self):
+        with self.cond:
+            callbacks = list(self.callbacks)
+            del self.callbacks[:]
+        for fn in callbacks:
             try:
-                return self.conn.poll(*args, **kwargs)
-            except IOError as e:
-                if e.errno == errno.EINTR:
-                    # http://stackoverflow.com/questions/14136195
-                    # We can just keep trying.
-                    continue
-                raise ProcConnectionDied("poll IOError: %s" % e)
-            except EOFError as e:
-                raise ProcConnectionDied("poll EOFError: %s" % e)
+                fn(self)
+            except Exception:
+                print("AsyncCallFuture: exception in done callback")
+                sys.excepthook(*sys.exc_info())
 
-    def send_bytes(self, value):
+    def _setDone(self, result=None, exception=None):
+        with self.cond:
+            if self.state != self.Running:
+                return  # cancelled
+            self._result = result
+            self._exception = exception
+            self.state = self.Finished
+            self.cond.notifyAll()
+        self._invokeCallbacks()
+
+
+def asyncCallFuture(func, name=None, mustExec=False, env_update=None):
+    """
+    Like asyncCall(), but does not block.
+    The child process is started directly, and a thread waits for its result.
+
+    :return: future for the result. Exceptions from the child (e.g. ForwardedKeyboardInterrupt)
+      are reraised by future.result().
+    :rtype: AsyncCallFuture
+    """
+    import threading
+    future = AsyncCallFuture()
+    task = _asyncCallStartTask(func, name=name, mustExec=mustExec, env_update=env_update)
+    future.task = task
+
+    def waitThread():
         try:
-            self.conn.send_bytes(value)
-        except (EOFError, IOError) as e:
-            raise ProcConnectionDied("send_bytes EOFError/IOError: %s" % e)
+            t, value = _asyncCallHostLoop(task)
+            res = _asyncCallResult(t, value)
+        except BaseException as exc:  # e.g. also SystemExit from the child. Otherwise the future never finishes.
+            future._setDone(exception=exc)
+        else:
+            future._setDone(result=res)
+        task.join()
 
-    def send(self, value):
-        self._check_closed()
-        self._check_writable()
+    thread = threading.Thread(target=waitThread, name="asyncCallFuture %s" % (name or "unnamed"))
+    thread.daemon = True
+    thread.start()
+    return future
+
+
+def asCompleted(futures, timeout=None):
+    """
+    Like concurrent.futures.as_completed(), for AsyncCallFuture.
+    Yields the futures in the order as they are done.
+    """
+    if PY3:
+        from queue import Queue, Empty
+    else:
+        from Queue import Queue, Empty
+    futures = list(futures)
+    doneQueue = Queue()
+    for future in futures:
+        future.add_done_callback(doneQueue.put)
+    deadline = (time.time() + timeout) if timeout is not None else None
+    for _ in futures:
+        try:
+            if deadline is None:
+                # Queue.get without timeout cannot be interrupted by KeyboardInterrupt in Python 2.
+                yield doneQueue.get(timeout=365 * 24 * 60 * 60)
+            else:
+                yield doneQueue.get(timeout=max(deadline - time.time(), 0))
+        except Empty:
+            raise FutureTimeoutError()
+
+
+def _makeStarCall(func, args):
+    return lambda: func(*args)
+
+
+def asyncCallStarmap(func, iterable, ordered=True, maxWorkers=None, name=None, mustExec=False, env_update=None):
+    """
+    Executes func(*args) for each args from iterable, each in its own process via asyncCallFuture(),
+    with at most `maxWorkers` of them running in parallel.
+    This is a generator which yields the results.
+    If the generator is closed early, the remaining calls are cancelled.
+
+    :param bool ordered: if True, the results are yielded in the order of iterable,
+      otherwise in the order as they are done
+    :param int|None maxWorkers: by default, the number of CPUs
+    """
+    import collections
+    if PY3:
+        from queue import Queue
+    else:
+        from Queue import Queue
+    if maxWorkers is None:
+        import multiprocessing
+        maxWorkers = multiprocessing.cpu_count()
+    assert maxWorkers > 0
+    argsIter = iter(iterable)
+    pending = collections.deque()
+    doneQueue = Queue()
+
+    def submit():
+        for args in argsIter:
+            future = asyncCallFuture(
+                _makeStarCall(func, args), name=name, mustExec=mustExec, env_update=env_update)
+            if not ordered:
+                future.add_done_callback(doneQueue.put)
+            pending.append(future)
+            return
+
+    try:
+        for _ in range(maxWorkers):
+            submit()
+        while pending:
+            if ordered:
+                future = pending.popleft()
+            else:
+                future = doneQueue.get(timeout=365 * 24 * 60 * 60)
+                pending.remove(future)
+            future.exception()  # wait, and start the next one before we yield
+            submit()
+            yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def asyncCallMap(func, iterable, ordered=True, maxWorkers=None, name=None, mustExec=False, env_update=None):
+    """
+    Like asyncCallStarmap(), but calls func(x) for each x from iterable.
+    """
+    return asyncCallStarmap(
+        func, ((x,) for x in iterable), ordered=ordered, maxWorkers=maxWorkers,
+        name=name, mustExec=mustExec, env_update=env_update)
+
+
+class AsyncCallCache(object):
+    """
+    Opt-in memoizing cache for asyncCall(), see asyncCall(cache=...) or asyncCall() of this class.
+    Only use it for deterministic functions.
+
+    The key is a stable hash of the pickled function, i.e. of its code, closure (thus the arguments)
+    and default arguments. Functions from modules are pickled by reference,
+    so if you change such a function, also change `version` (or pass an explicit key).
+    Functions from `__main__` are pickled by value, together with the globals of `__main__`,
+    thus their key changes whenever any global of the main script changes.
+    If the function cannot be pickled at all (e.g. a fork-only closure which refers to a lock,
+    or a function from a main script with such globals), the call is not cached
+    (counted as `uncachable` in stats()). Pass an explicit key in these cases.
+    The results are kept pickled, thus every caller gets its own copy. Exceptions are not cached.
+
+    There is an in-memory LRU tier (`maxEntries`, `maxBytes`) and an optional on-disk tier
+    (one file per entry in `cacheDir`, at most `maxDiskBytes`, least recently used are removed first).
+    Entries expire after `ttl` seconds, if given.
+    Concurrent calls with the same key (from multiple threads) share one child process (single-flight).
+    """
+
+    FileSuffix = ".pickle"
+
+    def __init__(self, maxEntries=128, maxBytes=256 * 1024 * 1024, cacheDir=None, maxDiskBytes=None,
+                 ttl=None, version=None):
+        """
+        :param int maxEntries: in memory
+        :param int maxBytes: in memory, of the pickled results
+        :param str|None cacheDir: enables the on-disk tier
+        :param int|None maxDiskBytes: for the on-disk tier. None means unlimited
+        :param float|None ttl: in seconds. None means that the entries don't expire
+        :param str|None version: part of the key. change it to invalidate the cache
+        """
+        import threading
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.cacheDir = cacheDir
+        self.maxDiskBytes = maxDiskBytes
+        self.ttl = ttl
+        self.version = version
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()  # key -> (data, expireTime), LRU order
+        self.memoryBytes = 0
+        self.inflight = {}  # key -> AsyncCallFuture, which gets the pickled result
+        self.counters = {
+            "hits": 0, "diskHits": 0, "misses": 0, "sharedCalls": 0, "uncachable": 0,
+            "evictions": 0, "diskEvictions": 0}
+        if cacheDir and not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+
+    def makeKey(self, func):
+        """
+        :param func: as for asyncCall
+        :return: stable hash, or None if func cannot be pickled
+        :rtype: str|None
+        """
+        import hashlib
+        buf = BytesIO()
+        try:
+            Pickler(buf, protocol=2).dump(func)
+        except Exception:  # PicklingError, TypeError, ... depending on what is not picklable
+            return None
+        h = hashlib.sha1(buf.getvalue())
+        h.update(("%r %r" % (tuple(sys.version_info[:2]), self.version)).encode("utf8"))
+        return h.hexdigest()
+
+    @staticmethod
+    def _dumps(value):
         buf = BytesIO()
         Pickler(buf).dump(value)
-        self.send_bytes(buf.getvalue())
+        return buf.getvalue()
 
-    def recv_bytes(self):
-        while True:
+    @staticmethod
+    def _loads(data):
+        return Unpickler(BytesIO(data)).load()
+
+    def _putMemory(self, key, data, expireTime):
+        # Must be called with the lock held.
+        old = self.memory.pop(key, None)
+        if old is not None:
+            self.memoryBytes -= len(old[0])
+        if len(data) > self.maxBytes:
+            return
+        self.memory[key] = (data, expireTime)
+        self.memoryBytes += len(data)
+        while len(self.memory) > self.maxEntries or self.memoryBytes > self.maxBytes:
+            _, (oldData, _) = self.memory.popitem(last=False)
+            self.memoryBytes -= len(oldData)
+            self.counters["evictions"] += 1
+
+    def _diskPath(self, key):
+        return os.path.join(self.cacheDir, key + self.FileSuffix)
+
+    def _diskGet(self, key, now):
+        path = self._diskPath(key)
+        try:
+            with open(path, "rb") as f:
+                expireTime, data = self._loads(f.read())
+        except (IOError, OSError):
+            return None
+        except Exception:  # corrupt, e.g. from a crash while writing
+            self._diskRemove(path)
+            return None
+        if expireTime is not None and expireTime <= now:
+            self._diskRemove(path)
+            return None
+        try:
+            os.utime(path, None)  # for the LRU order
+        except OSError:
+            pass
+        return data, expireTime
+
+    @staticmethod
+    def _diskRemove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _diskPut(self, key, data, expireTime):
+        import tempfile
+        try:
+            fd, tmpPath = tempfile.mkstemp(prefix=".tmp-", dir=self.cacheDir)
+            with os.fdopen(fd, "wb") as f:
+                f.write(self._dumps((expireTime, data)))
+            os.rename(tmpPath, self._diskPath(key))  # atomic
+        except (IOError, OSError) as e:
+            print("AsyncCallCache: cannot write to %s: %s" % (self.cacheDir, e))
+            return
+        if self.maxDiskBytes is not None:
+            self._diskEvict()
+
+    def _diskEvict(self):
+        files = []
+        for fn in os.listdir(self.cacheDir):
+            if not fn.endswith(self.FileSuffix):
+                continue
+            path = os.path.join(self.cacheDir, fn)
             try:
-                return self.conn.recv_bytes()
-            except IOError as e:
-                if e.errno == errno.EINTR:
-                    # http://stackoverflow.com/questions/14136195
-                    # We can just keep trying.
-                    continue
-                raise ProcConnectionDied("recv_bytes IOError: %s" % e)
-            except EOFError as e:
-                raise ProcConnectionDied("recv_bytes EOFError: %s" % e)
+                st = os.stat(path)
+            except OSError:
+                continue  # removed in the meantime
+            files.append((st.st_mtime, st.st_size, path))
+        files.sort()
+        totalSize = sum([size for (_, size, _) in files])
+        for _, size, path in files:
+            if totalSize <= self.maxDiskBytes:
+                break
+            self._diskRemove(path)
+            totalSize -= size
+            with self.lock:
+                self.counters["diskEvictions"] += 1
 
-    def recv(self):
-        self._check_closed()
-        self._check_readable()
-        buf = self.recv_bytes()
-        f = BytesIO(buf)
-        res = Unpickler(f).load()
+    def get(self, key):
+        """
+        :param str key:
+        :return: pickled result, or None if not cached
+        :rtype: bytes|None
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                data, expireTime = entry
+                if expireTime is None or expireTime > now:
+                    del self.memory[key]
+                    self.memory[key] = entry  # most recently used
+                    self.counters["hits"] += 1
+                    return data
+                del self.memory[key]
+                self.memoryBytes -= len(data)
+        if self.cacheDir:
+            res = self._diskGet(key, now)
+            if res is not None:
+                data, expireTime = res
+                with self.lock:
+                    self.counters["diskHits"] += 1
+                    self._putMemory(key, data, expireTime)
+                return data
+        return None
+
+    def put(self, key, data, ttl=None):
+        """
+        :param str key:
+        :param bytes data: pickled result
+        :param float|None ttl: by default self.ttl
+        """
+        if ttl is None:
+            ttl = self.ttl
+        expireTime = (time.time() + ttl) if ttl is not None else None
+        with self.lock:
+            self._putMemory(key, data, expireTime)
+        if self.cacheDir:
+            self._diskPut(key, data, expireTime)
+
+    def asyncCall(self, func, name=None, mustExec=False, env_update=None, key=None, ttl=None):
+        """
+        Like asyncCall(), but returns the cached result, if there is one.
+
+        :param str|None key: by default makeKey(func). If that fails, the call is not cached
+        :param float|None ttl: by default self.ttl
+        """
+        if key is None:
+            key = self.makeKey(func)
+            if key is None:
+                with self.lock:
+                    self.counters["uncachable"] += 1
+                return asyncCall(func, name=name, mustExec=mustExec, env_update=env_update)
+        data = self.get(key)
+        if data is not None:
+            return self._loads(data)
+        with self.lock:
+            future = self.inflight.get(key)
+            isLeader = future is None
+            if isLeader:
+                future = self.inflight[key] = AsyncCallFuture()
+            else:
+                self.counters["sharedCalls"] += 1
+        if not isLeader:
+            return self._loads(future.result())
+        try:
+            data = self.get(key)  # another leader might have finished right before
+            if data is None:
+                with self.lock:
+                    self.counters["misses"] += 1
+                res = asyncCall(func, name=name, mustExec=mustExec, env_update=env_update)
+                data = self._dumps(res)
+                self.put(key, data, ttl=ttl)
+            else:
+                res = self._loads(data)
+        except BaseException as exc:
+            with self.lock:
+                del self.inflight[key]
+            future._setDone(exception=exc)
+            raise
+        with self.lock:
+            del self.inflight[key]
+        future._setDone(result=data)
         return res
 
+    def stats(self):
+        """
+        :return: counters, and the number of entries and bytes in memory
+        :rtype: dict[str,int]
+        """
+        with self.lock:
+            d = dict(self.counters)
+            d["memoryEntries"] = len(self.memory)
+            d["memoryBytes"] = self.memoryBytes
+        return d
 
-def ExecingProcess_Pipe():
+    def clear(self):
+        """
+        Removes all entries, also on disk.
+        """
+        with self.lock:
+            self.memory.clear()
+            self.memoryBytes = 0
+        if self.cacheDir:
+            for fn in os.listdir(self.cacheDir):
+                if fn.endswith(self.FileSuffix):
+                    self._diskRemove(os.path.join(self.cacheDir, fn))
+
+
+def asyncioCall(func, name=None, mustExec=False, loop=None, env_update=None):
     """
-    This is like multiprocessing.Pipe(duplex=True).
-    It uses our own ExecingProcess_ConnectionWrapper.
+    Like asyncCall(), but does not block.
+    Instead, it returns an asyncio future for the result,
+    which is driven by the event loop (via loop.add_reader), i.e. no thread is needed per call.
+    execInMainProc() requests from the child are executed in the event loop thread.
+    Cancelling the future kills the child.
+    Once the future is done, the child is joined as soon as it has exited.
+
+    :param func: function to execute in the other process
+    :param str|None name: name for the sub process
+    :param bool mustExec: see asyncCall()
+    :param asyncio.AbstractEventLoop|None loop: by default, asyncio.get_event_loop()
+    :param dict[str,str]|None env_update: used together with `mustExec`, see AsyncTask
+    :rtype: asyncio.Future
     """
-    import socket
-    s1, s2 = socket.socketpair()
-    c1 = ExecingProcess_ConnectionWrapper(os.dup(s1.fileno()))
-    c2 = ExecingProcess_ConnectionWrapper(os.dup(s2.fileno()))
-    s1.close()
-    s2.close()
-    return c1, c2
+    import asyncio
+    loop = loop or asyncio.get_event_loop()
+    result = loop.create_future()
+    task = _asyncCallStartTask(func, name=name, mustExec=mustExec, env_update=env_update)
+    pending = [None]  # the outstanding aget() future
 
+    def getMessage():
+        pending[0] = task.aget(loop=loop)
+        pending[0].add_done_callback(onMessage)
 
-def Pipe_ConnectionWrapper(*args, **kwargs):
-    from multiprocessing import Pipe
-    c1, c2 = Pipe(*args, **kwargs)
-    c1 = ExecingProcess_ConnectionWrapper(conn=c1)
-    c2 = ExecingProcess_ConnectionWrapper(conn=c2)
-    return c1, c2
+    def onMessage(msgFuture):
+        if result.done():
+            return
+        try:
+            t, value = msgFuture.result()
+            if t == _AsyncCallQueue.Types.asyncExec:
+                requestId, execFunc = value
+                _AsyncCallQueue.asyncExecHost(task, requestId, execFunc)
+                getMessage()
+                return
+            result.set_result(_asyncCallResult(t, value))
+        except Exception as exc:
+            result.set_exception(exc)
 
+    def reap():
+        # The child exits right after it has sent the result. Join it without blocking the loop.
+        sentinel = getattr(task.proc, "sentinel", None)
+        if sentinel is None or not task.is_alive():
+            task.join()
+            return
 
-if sys.platform == "win32":
-    from multiprocessing.forking import Popen as mp_Popen
+        def onExit():
+            loop.remove_reader(sentinel)
+            task.join()
 
-    class Win32_mp_Popen_wrapper:
-        def __init__(self, env_update):
-            self.env = os.environ.copy()
-            self.env.update(env_update)
+        loop.add_reader(sentinel, onExit)
 
-        class Popen(mp_Popen):
-            # noinspection PyMissingConstructor
-            def __init__(self, process_obj, env):
-                # No super init call by intention!
+    def onResultDone(_):
+        if result.cancelled():
+            pending[0].cancel()
+            task.setCancel()
+        reap()
 
-                from multiprocessing.forking import duplicate, get_command_line, _python_exe, close, get_preparation_data, HIGHEST_PROTOCOL, dump
-                import msvcrt
-                import _subprocess
+    result.add_done_callback(onResultDone)
+    getMessage()
+    return result
 
-                # create pipe for communication with child
-                rfd, wfd = os.pipe()
 
-                # get handle for read end of the pipe and make it inheritable
-                rhandle = duplicate(msvcrt.get_osfhandle(rfd), inheritable=True)
-                os.close(rfd)
+def attrChain(base, *attribs, **kwargs):
+    default = kwargs.get("default", None)
+    obj = base
+    for attr in attribs:
+        if obj is None: return default
+        obj = getattr(obj, attr, None)
+    if obj is None: return default
+    return obj
 
-                # start process
-                cmd = get_command_line() + [rhandle]
-                cmd = ' '.join('"%s"' % x for x in cmd)
-                hp, ht, pid, tid = _subprocess.CreateProcess(
-                    _python_exe, cmd, None, None, 1, 0, env, None, None
-                )
-                ht.Close()
-                close(rhandle)
 
-                # set attributes of self
-                self.pid = pid
-                self.returncode = None
-                self._handle = hp
+# This is needed in some cases to avoid pickling problems with bounded funcs.
+def funcCall(attrChainArgs, args=()):
+    f = attrChain(*attrChainArgs)
+    return f(*args)
 
-                # send information to child
-                prep_data = get_preparation_data(process_obj._name)
-                to_child = os.fdopen(wfd, 'wb')
-                mp_Popen._tls.process_handle = int(hp)
-                try:
-                    dump(prep_data, to_child, HIGHEST_PROTOCOL)
-                    dump(process_obj, to_child, HIGHEST_PROTOCOL)
-                finally:
-                    del mp_Popen._tls.process_handle
-                    to_child.close()
 
-        def __call__(self, process_obj):
-            return self.Popen(process_obj, self.env)
+_pidfdSupported = None
+
+
+def _checkPidfdSupport():
+    """
+    :return: whether os.pidfd_open works (Python >=3.9, Linux >=5.3)
+    :rtype: bool
+    """
+    global _pidfdSupported
+    if _pidfdSupported is None:
+        _pidfdSupported = False
+        if hasattr(os, "pidfd_open"):
+            try:
+                os.close(os.pidfd_open(os.getpid()))
+                _pidfdSupported = True
+            except OSError:
+                pass
+    return _pidfdSupported
+
+
+_exitPipeFd = None  # in an exec'd child, the write end of its exit pipe, see ExecingProcess.start
+
+
+def _closeExitPipe():
+    """
+    Called in forked children of an exec'd child.
+    They must not keep the exit pipe open, otherwise the parent would not see the exit of the exec'd child.
+    (Exec'd children don't get it anyway, as it is close-on-exec.)
+    """
+    global _exitPipeFd
+    if _exitPipeFd is None:
+        return
+    try:
+        os.close(_exitPipeFd)
+    except OSError:
+        pass
+    _exitPipeFd = None
+
+
+def _keepExitPipe(fd):
+    """
+    :param int fd: the write end of our exit pipe. Called in the exec'd child
+    """
+    global _exitPipeFd
+    _exitPipeFd = fd
+    _setCloexec(fd)
+    if hasattr(os, "register_at_fork"):  # Python >=3.7. This covers every fork
+        os.register_at_fork(after_in_child=_closeExitPipe)
+    else:  # at least the forks via multiprocessing, e.g. an AsyncTask in the child
+        import multiprocessing.util
+        multiprocessing.util.register_after_fork(_closeExitPipe, lambda func: func())
+
+
+def _setCloexec(fd, cloexec=True):
+    import fcntl
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    if cloexec:
+        flags |= fcntl.FD_CLOEXEC
+    else:
+        flags &= ~fcntl.FD_CLOEXEC
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags)
+
+
+def _selectReadable(fds, timeout):
+    """
+    Waits until one of the fds is readable (or at EOF), and retries on EINTR with the remaining timeout.
+    This uses poll() where available, as select() cannot handle fds >= FD_SETSIZE (1024).
+    :param list[int] fds:
+    :param float|None timeout: in seconds
+    :return: readable fds
+    :rtype: list[int]
+    """
+    import select
+    import math
+    poller = None
+    if hasattr(select, "poll"):
+        poller = select.poll()
+        for fd in fds:
+            poller.register(fd, select.POLLIN | select.POLLPRI | select.POLLERR | select.POLLHUP)
+    deadline = (time.time() + timeout) if timeout is not None else None
+    while True:
+        remaining = None if deadline is None else max(deadline - time.time(), 0)
+        try:
+            if poller is not None:
+                # In milliseconds. Round up, otherwise we would spin for the last fraction of a millisecond.
+                return [fd for fd, _ in poller.poll(None if remaining is None else int(math.ceil(remaining * 1000)))]
+            r, _, _ = select.select(fds, [], [], remaining)
+            return r
+        except (select.error, OSError) as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+
+
+def _rusageDict(rusage):
+    """
+    :param resource.struct_rusage rusage: e.g. from os.wait4
+    :return: CPU times in seconds and maxRss, which is in KB on Linux (but in bytes on Mac)
+    :rtype: dict[str,float|int]
+    """
+    return {"userTime": rusage.ru_utime, "systemTime": rusage.ru_stime, "maxRss": rusage.ru_maxrss}
+
+
+class _CodeCache:
+    """
+    LRU cache for marshaled code objects, used by _TargetPickler.
+    extpickle serializes the code objects of functions which are not globally referenceable,
+    which is the expensive part when we send the same target to many children.
+    Code objects are immutable, thus we can key them by identity
+    (we keep a reference, so the id stays valid).
+    The children get the code under its digest, see _TargetUnpickler.
+    """
+
+    def __init__(self, maxSize):
+        """
+        :param int maxSize: number of code objects. 0 disables the cache (and _TargetPickler)
+        """
+        self.maxSize = maxSize
+        self.lock = Lock()
+        self.entries = OrderedDict()  # id(code) -> (code, digest, data)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, code):
+        """
+        :param types.CodeType code:
+        :return: digest, marshaled code
+        :rtype: (str, bytes)
+        """
+        import marshal
+        import hashlib
+        with self.lock:
+            entry = self.entries.pop(id(code), None)
+            if entry is not None:
+                self.entries[id(code)] = entry  # most recently used
+                self.hits += 1
+                return entry[1], entry[2]
+            self.misses += 1
+        data = marshal.dumps(code)
+        digest = hashlib.sha1(data).hexdigest()
+        with self.lock:
+            self.entries[id(code)] = (code, digest, data)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+        return digest, data
+
+
+class _TargetPickler(Pickler):
+    """
+    Pickler for the target and args of ExecingProcess.
+    Code objects are replaced by a reference to their digest.
+    The marshaled code is collected in `codeBlobs` and sent separately,
+    unless the child already has it (see ExecingForkServer).
+    """
+
+    def __init__(self, file, codeCache):
+        """
+        :param _CodeCache codeCache:
+        """
+        Pickler.__init__(self, file)
+        self.codeCache = codeCache
+        self.codeBlobs = {}  # digest -> marshaled code
+
+    def persistent_id(self, obj):
+        if type(obj) is not types.CodeType:
+            return None
+        digest, data = self.codeCache.get(obj)
+        self.codeBlobs[digest] = data
+        return "TaskSystem.code", digest
+
+
+class _TargetUnpickler(Unpickler):
+    """
+    Counterpart of _TargetPickler. The code comes from ExecingProcess.ChildCodeCache.
+    """
+
+    def persistent_load(self, pid):
+        tag, digest = pid
+        if tag != "TaskSystem.code":
+            raise pickle.UnpicklingError("unsupported persistent id %r" % (pid,))
+        return ExecingProcess.ChildCodeCache[digest]
+
+
+def _lazyBetterExchook(*excInfo):
+    """
+    sys.excepthook which imports and installs better_exchook only when it is needed.
+    """
+    try:
+        import better_exchook
+    except ImportError:
+        sys.__excepthook__(*excInfo)
+    else:
+        better_exchook.install()
+        sys.excepthook(*excInfo)
+
+
+class ExecingBootstrap:
+    """
+    Bootstrap profile: how the ExecingProcess child starts up.
+    The default is to run this file as a script with the normal interpreter settings.
+    Fast is a profile for a minimal startup.
+    This is not relevant for children of an ExecingForkServer, which don't exec.
+    """
+
+    class ExchookModes:
+        eager = "eager"  # install better_exchook at startup
+        lazy = "lazy"  # import and install better_exchook on the first unhandled exception
+        off = "off"
+
+    def __init__(self, noSite=False, isolated=False, passSysPath=None, dontWriteBytecode=False,
+                 precompile=False, preload=(), betterExchook=ExchookModes.eager, interpreterFlags=()):
+        """
+        :param bool noSite: skip the site module (-S). This implies passSysPath.
+          Note that .pth files are not executed then.
+        :param bool isolated: ignore PYTHON* env vars (-E) and the user site-packages (-s).
+          This implies passSysPath.
+        :param bool|None passSysPath: the child gets our sys.path, and it imports this module
+          as a module (via -c), not as a script, thus it can use the compiled bytecode.
+          By default, only if noSite or isolated.
+        :param bool dontWriteBytecode: -B, i.e. the child does not write .pyc files.
+        :param bool precompile: compile this module and the preload modules to bytecode in the parent,
+          once, so that the children don't each need to do it.
+        :param list[str] preload: modules which the child imports before it unpickles the target
+        :param str betterExchook: see ExchookModes
+        :param list[str] interpreterFlags: additional flags for the interpreter
+        """
+        assert betterExchook in (self.ExchookModes.eager, self.ExchookModes.lazy, self.ExchookModes.off)
+        if passSysPath is None:
+            passSysPath = noSite or isolated
+        assert passSysPath or not (noSite or isolated), "the child would not find its modules"
+        self.noSite = noSite
+        self.isolated = isolated
+        self.passSysPath = passSysPath
+        self.dontWriteBytecode = dontWriteBytecode
+        self.precompile = precompile
+        self.preload = list(preload)
+        self.betterExchook = betterExchook
+        self.interpreterFlags = list(interpreterFlags)
+        self.precompiled = False
+
+    def _precompile(self):
+        import py_compile
+        if self.precompiled:
+            return
+        self.precompiled = True
+        mods = [sys.modules[__name__]] + [sys.modules[modName] for modName in self.preload if modName in sys.modules]
+        for mod in mods:
+            fn = getattr(mod, "__file__", None)
+            if not fn:
+                continue
+            fn = os.path.splitext(fn)[0] + ".py"
+            if not os.path.exists(fn):
+                continue
+            try:
+                py_compile.compile(fn, doraise=True)
+            except (py_compile.PyCompileError, IOError, OSError):
+                pass  # e.g. not writeable. The child just compiles it itself.
+
+    def commandLine(self, args):
+        """
+        :param list[str] args: for ExecingProcess.checkExec, starting with "--forkExecProc"
+        :return: the command line for the child
+        :rtype: list[str]
+        """
+        if self.precompile:
+            self._precompile()
+        cmd = [sys.executable] + self.interpreterFlags
+        if self.isolated:
+            cmd += ["-E", "-s"]
+        if self.noSite:
+            cmd += ["-S"]
+        if self.dontWriteBytecode:
+            cmd += ["-B"]
+        if self.passSysPath and __name__ != "__main__":
+            cmd += ["-c", (
+                "import sys, time; sys.TaskSystemBootstrapTime = time.time(); sys.path = %r; "
+                "__import__(%r); sys.modules[%r].ExecingProcess.bootstrapMain()") % (
+                list(sys.path), __name__, __name__)]
+        else:
+            py_mod_file = os.path.splitext(__file__)[0] + ".py"
+            assert os.path.exists(py_mod_file)
+            cmd += [py_mod_file]
+        cmd += args
+        if self.preload:
+            cmd += ["--preload", ",".join(self.preload)]
+        if self.betterExchook != self.ExchookModes.eager:
+            cmd += ["--exchook", self.betterExchook]
+        return cmd
+
+
+ExecingBootstrap.Default = ExecingBootstrap()
+ExecingBootstrap.Fast = ExecingBootstrap(
+    noSite=True, isolated=True, precompile=True, betterExchook=ExecingBootstrap.ExchookModes.lazy)
+
+
+class ExecingProcess:
+    """
+    This is a replacement for multiprocessing.Process which always
+    uses fork+exec, not just fork.
+    This ensures that you have a separate independent process.
+    This can avoid many types of bugs, such as:
+      http://stackoverflow.com/questions/24509650
+      http://bugs.python.org/issue6721
+      http://stackoverflow.com/questions/8110920
+      http://stackoverflow.com/questions/23963997
+      https://github.com/numpy/numpy/issues/654
+      http://comments.gmane.org/gmane.comp.python.numeric.general/60204
+
+    The code objects in the target and args are cached in TargetCache (see _CodeCache).
+    A child from an ExecingForkServer inherits the code from the fork server,
+    thus repeated targets are sent only as a digest reference.
+    """
+
+    TargetCache = _CodeCache(maxSize=256)
+    ChildCodeCache = {}  # digest -> code. in the child (and the fork server)
+    DefaultBootstrap = ExecingBootstrap.Default
+    MpMainEnvVar = "TASKSYSTEM_MP_MAIN_PATH"  # see _getMpMainPath
+
+    def __init__(self, target, args, name, env_update, forkServer=None, pass_fds=(), bootstrap=None):
+        """
+        :param target: function to call in the child
+        :param tuple args: args for target
+        :param str name: name of the child
+        :param dict[str,str]|None env_update: update these env vars in the child
+        :param ExecingForkServer|None forkServer: if given, the child is forked from this fork server
+          instead of being fork+exec'd by us
+        :param list[int]|tuple[int] pass_fds: fds which the child needs, under the same fd number.
+          With fork+exec, we make them inheritable in the child before the exec
+          (since Python 3.4, new fds are non-inheritable by default, PEP 446).
+        :param ExecingBootstrap|None bootstrap: how the child starts up. By default DefaultBootstrap.
+          Not used with forkServer.
+        """
+        self.target = target
+        self.args = args
+        self.name = name
+        mpMainPath = _getMpMainPath()
+        if mpMainPath:
+            env_update = dict(env_update or {})
+            env_update.setdefault(self.MpMainEnvVar, mpMainPath)
+        self.env_update = env_update
+        self.forkServer = forkServer
+        self.pass_fds = pass_fds
+        self.bootstrap = bootstrap or self.DefaultBootstrap
+        self.daemon = True
+        self.pid = None
+        self.exit_status = None
+        self.exit_fd = None
+        self.rusage = None  # see _rusageDict. set when we reaped the child
+        self.start_time = None
+        self.startup_report = None
+
+    @property
+    def sentinel(self):
+        """
+        Like multiprocessing.Process.sentinel:
+        an fd which becomes readable when the child exited.
+        This is a pidfd if supported, otherwise the read end of a pipe
+        whose write end is only open in the child (so we get EOF when it exits).
+        Its forked children close it (see _closeExitPipe), except for a plain os.fork in Python 2.
+        With a fork server, this is the status pipe.
+        None if we already waited for the child.
+        """
+        if self.forkServer:
+            return self.status_fd if self.pid is not None else None
+        return self.exit_fd
+
+    def start(self):
+        assert self.pid is None
+        assert self.exit_status is None
+        def pipeOpen():
+            readend, writeend = os.pipe()
+            readend = os.fdopen(readend, "rb")
+            writeend = os.fdopen(writeend, "wb")
+            return readend, writeend
+        self.start_time = time.time()
+        self.pipe_c2p = pipeOpen()
+        self.pipe_p2c = pipeOpen()
+        self.parent_pid = os.getpid()
+        if self.forkServer:
+            self._startViaForkServer()
+            return
+        exit_pipe = None
+        if not _checkPidfdSupport():
+            exit_pipe = os.pipe()
+            # Other children which we fork+exec in the meantime should not get it.
+            _setCloexec(exit_pipe[0])
+            _setCloexec(exit_pipe[1])
+        pid = os.fork()
+        if pid == 0:  # child
+            try:
+                sys.stdin.close()  # Force no tty stdin.
+                self.pipe_c2p[0].close()
+                self.pipe_p2c[1].close()
+                for fd in [self.pipe_c2p[1].fileno(), self.pipe_p2c[0].fileno()] + list(self.pass_fds):
+                    _setCloexec(fd, False)
+                args = ["--forkExecProc",
+                        str(self.pipe_c2p[1].fileno()),
+                        str(self.pipe_p2c[0].fileno())]
+                if exit_pipe:
+                    os.close(exit_pipe[0])
+                    _setCloexec(exit_pipe[1], False)
+                    args.append(str(exit_pipe[1]))
+                args = self.bootstrap.commandLine(args)
+                if self.env_update:
+                    os.environ.update(self.env_update)
+                os.execv(args[0], args)  # Does not return if successful.
+            except BaseException:
+                print("ExecingProcess: Error at initialization.")
+                sys.excepthook(*sys.exc_info())
+                sys.exit(1)
+            finally:
+                sys.exit()
+        else:  # parent
+            self.pipe_c2p[1].close()
+            self.pipe_p2c[0].close()
+            self.pid = pid
+            if exit_pipe:
+                os.close(exit_pipe[1])
+                self.exit_fd = exit_pipe[0]
+            else:
+                self.exit_fd = os.pidfd_open(pid)
+            data, codeBlobs = self._pickleTarget()
+            self._sendTarget(data, codeBlobs)
+
+    def _startViaForkServer(self):
+        fds = [self.pipe_c2p[1].fileno(), self.pipe_p2c[0].fileno()] + list(self.pass_fds)
+        env_update = self.env_update
+        if Tracing.isEnabled():
+            # The fork server might have been started before, so pass it explicitly.
+            env_update = dict(env_update or {})
+            env_update[Tracing.EnvVar] = Tracing.traceDir
+        data, codeBlobs = self._pickleTarget()
+        self.status_fd = self.forkServer.spawn(
+            name=self.name, env_update=env_update, fds=fds, codeBlobs=codeBlobs)
+        self.status_buf = b""
+        self.pipe_c2p[1].close()
+        self.pipe_p2c[0].close()
+        if not os.read(self.status_fd, 1):  # the fork server writes one byte when it has forked
+            raise ProcConnectionDied("ExecingForkServer died while spawning %s" % self.name)
+        self.pid = self._readStatusLine(block=True)
+        self._sendTarget(data, codeBlobs={})  # the child got the code from the fork server
+
+    def _pickleTarget(self):
+        """
+        :return: pickled target and args, and the code which they reference (digest -> marshaled code)
+        :rtype: (bytes, dict[str,bytes])
+        """
+        with Tracing.span("pickle target", {"name": self.name}):
+            buf = BytesIO()
+            if self.TargetCache.maxSize > 0:
+                pickler = _TargetPickler(buf, self.TargetCache)
+            else:
+                pickler = Pickler(buf)
+            pickler.dump(self.target)
+            pickler.dump(self.args)
+            return buf.getvalue(), getattr(pickler, "codeBlobs", {})
+
+    def _sendTarget(self, data, codeBlobs):
+        pickler = Pickler(self.pipe_p2c[1])
+        pickler.dump(self.name)
+        pickler.dump(codeBlobs)
+        self.pipe_p2c[1].write(data)
+        self.pipe_p2c[1].flush()
+
+    @staticmethod
+    def _addChildCode(codeBlobs):
+        import marshal
+        for digest, data in codeBlobs.items():
+            if digest not in ExecingProcess.ChildCodeCache:
+                ExecingProcess.ChildCodeCache[digest] = marshal.loads(data)
+
+    def _readStatusLine(self, block):
+        """
+        The fork server reports the pid and then the exit status of the child,
+        one line each, via the status pipe.
+        :return: int from the next line, or None if not available (yet)
+        """
+        while b"\n" not in self.status_buf:
+            if not block:
+                if not _selectReadable([self.status_fd], 0):
+                    return None
+            try:
+                data = os.read(self.status_fd, 1024)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if not data:
+                # The waiter process in the fork server died without reporting.
+                # Treat this as an unclean exit of the child.
+                self.status_buf += b"%i\n" % (1 << 8)
+                continue
+            self.status_buf += data
+        line, self.status_buf = self.status_buf.split(b"\n", 1)
+        fields = line.split()
+        if len(fields) == 4:  # exit status with rusage
+            self.rusage = {"userTime": float(fields[1]), "systemTime": float(fields[2]), "maxRss": int(fields[3])}
+        return int(fields[0])
+
+    def _wait(self, options=0):
+        assert self.parent_pid == os.getpid()
+        assert self.pid
+        assert self.exit_status is None
+        if self.forkServer:
+            exit_status = self._readStatusLine(block=not (options & os.WNOHANG))
+            if exit_status is None:
+                return
+            os.close(self.status_fd)
+            self.exit_status = exit_status
+            self.pid = None
+            return
+        if hasattr(os, "wait4"):
+            pid, exit_status, rusage = os.wait4(self.pid, options)
+        else:
+            pid, exit_status = os.waitpid(self.pid, options)
+            rusage = None
+        if pid != self.pid:
+            assert pid == 0
+            # It's still alive, otherwise we would have get the same pid.
+            return
+        self.exit_status = exit_status
+        if rusage is not None:
+            self.rusage = _rusageDict(rusage)
+        self.pid = None
+        if self.exit_fd is not None:
+            os.close(self.exit_fd)
+            self.exit_fd = None
+
+    def is_alive(self):
+        if self.pid is None:
+            return False
+        if self.sentinel is not None and not _selectReadable([self.sentinel], 0):
+            return True
+        self._wait(os.WNOHANG)
+        return self.pid is not None
+
+    def startupReport(self):
+        """
+        Waits until the child has started up, i.e. it has unpickled the target.
+        All times are in seconds:
+          interpreterStartup: from start() until our bootstrap code runs in the child
+            (for a fork server child: until it was forked)
+          importTaskSystem: until this module is imported in the child
+          preload: installing better_exchook (if eager) and importing the preload modules
+          unpickleTarget: reading and unpickling the target and args
+          total: from start() until the target is ready to run
+        :return: the times, or None if the child died before
+        :rtype: dict[str,float]|None
+        """
+        if self.startup_report is None:
+            try:
+                times = Unpickler(self.pipe_c2p[0]).load()
+            except (EOFError, IOError, pickle.UnpicklingError):
+                return None
+            self.startup_report = {
+                "interpreterStartup": times["bootstrap"] - self.start_time,
+                "importTaskSystem": times["imported"] - times["bootstrap"],
+                "preload": times["preloaded"] - times["imported"],
+                "unpickleTarget": times["targetLoaded"] - times["preloaded"],
+                "total": times["targetLoaded"] - self.start_time}
+        return self.startup_report
+
+    def join(self, timeout=None):
+        if self.pid is None:
+            return
+        if timeout is not None:
+            if not _selectReadable([self.sentinel], timeout):
+                return  # still alive
+        self._wait()
+
+    Verbose = False
+
+    @staticmethod
+    def bootstrapMain():
+        """
+        Called via -c by the child, see ExecingBootstrap.passSysPath. Does not return.
+        """
+        try:
+            ExecingProcess.checkExec()
+        except KeyboardInterrupt:
+            sys.exit(1)
+        print("ExecingProcess.bootstrapMain: missing --forkExecProc")
+        sys.exit(1)
+
+    @staticmethod
+    def _getArgvOption(name, default=None):
+        if name in sys.argv:
+            return sys.argv[sys.argv.index(name) + 1]
+        return default
+
+    @staticmethod
+    def checkExec():
+        if "--forkExecProc" in sys.argv:
+            startupTimes = {
+                "bootstrap": getattr(sys, "TaskSystemBootstrapTime", _moduleLoadTime),
+                "imported": time.time()}
+            exchookMode = ExecingProcess._getArgvOption("--exchook", ExecingBootstrap.ExchookModes.eager)
+            if exchookMode == ExecingBootstrap.ExchookModes.eager:
+                try:
+                    import better_exchook
+                except ImportError:
+                    pass  # Doesn't matter.
+                else:
+                    better_exchook.install()
+            elif exchookMode == ExecingBootstrap.ExchookModes.lazy:
+                sys.excepthook = _lazyBetterExchook
+            for modName in ExecingProcess._getArgvOption("--preload", "").split(","):
+                if modName:
+                    __import__(modName)
+            startupTimes["preloaded"] = time.time()
+            argidx = sys.argv.index("--forkExecProc")
+            writeFileNo = int(sys.argv[argidx + 1])
+            readFileNo = int(sys.argv[argidx + 2])
+            if len(sys.argv) > argidx + 3 and sys.argv[argidx + 3].isdigit():
+                # The parent gets EOF on this when we exit. Keep it open, but don't pass it on.
+                _keepExitPipe(int(sys.argv[argidx + 3]))
+            readend = os.fdopen(readFileNo, "rb")
+            writeend = os.fdopen(writeFileNo, "wb")
+            Tracing.checkEnv()
+            _installMpMainFinder(os.environ.get(ExecingProcess.MpMainEnvVar))
+            unpickler = Unpickler(readend)
+            name = unpickler.load()
+            Tracing.setProcessName(name)
+            if ExecingProcess.Verbose: print("ExecingProcess child %s (pid %i)" % (name, os.getpid()))
+            try:
+                with Tracing.span("unpickle target", {"name": name}):
+                    ExecingProcess._addChildCode(unpickler.load())
+                    unpickler = _TargetUnpickler(readend)
+                    target = unpickler.load()
+                    args = unpickler.load()
+            except EOFError:
+                print("Error: unpickle incomplete")
+                raise SystemExit
+            startupTimes["targetLoaded"] = time.time()
+            try:
+                Pickler(writeend).dump(startupTimes)  # see startupReport
+                writeend.flush()
+            except IOError:
+                pass
+            ret = target(*args)
+            sys.exited = True
+            # IOError is probably broken pipe. That probably means that the parent died.
+            try: Pickler(writeend).dump(ret)
+            except IOError: pass
+            try: readend.close()
+            except IOError: pass
+            try: writeend.close()
+            except IOError: pass
+            if ExecingProcess.Verbose: print("ExecingProcess child %s (pid %i) finished" % (name, os.getpid()))
+            Tracing.flush()  # in case of the fork server, we exit via os._exit
+            raise SystemExit
+
+
+class ProcConnectionDied(Exception):
+    pass
+
+
+def _getMpMainPath():
+    """
+    In Python 3, multiprocessing registers the __main__ module also as __mp_main__,
+    and extpickle then refers to functions from the main script via __mp_main__.
+    The child must be able to import that, see _installMpMainFinder.
+
+    :return: the path of the main script, if it is registered as __mp_main__, otherwise None
+    :rtype: str|None
+    """
+    mainMod = sys.modules.get("__main__")
+    if mainMod is None or sys.modules.get("__mp_main__") is not mainMod:
+        return None
+    path = getattr(mainMod, "__file__", None)
+    if not path:
+        return None  # interactive or -c
+    return os.path.abspath(path)
+
+
+class _MpMainFinder(object):
+    """
+    Import hook for the __mp_main__ module, like multiprocessing does in its spawned children.
+    The main script is imported under that name (thus its `if __name__ == "__main__"` block does not run),
+    but only when it is needed, i.e. when the child unpickles something from it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def find_spec(self, fullname, path=None, target=None):
+        if fullname != "__mp_main__":
+            return None
+        import importlib.util
+        return importlib.util.spec_from_file_location(fullname, self.path)
+
+
+def _installMpMainFinder(path):
+    """
+    :param str|None path: see _getMpMainPath. Called in the child
+    """
+    if not path or not PY3 or "__mp_main__" in sys.modules:
+        return
+    if any([isinstance(finder, _MpMainFinder) for finder in sys.meta_path]):
+        return
+    sys.meta_path.append(_MpMainFinder(path))
+
+
+def _shmCreate(size):
+    """
+    :param int size:
+    :return: fd of a new anonymous shared memory segment of the given size
+    :rtype: int
+    """
+    if hasattr(os, "memfd_create"):
+        fd = os.memfd_create("TaskSystem-shm")
+    else:
+        import tempfile
+        shmDir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+        fd, path = tempfile.mkstemp(prefix="TaskSystem-shm-", dir=shmDir)
+        os.unlink(path)
+    try:
+        os.ftruncate(fd, size)
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+
+def _shmWrite(fd, obj, size):
+    """
+    Writes the raw memory of the buffer-protocol object `obj` into the fd.
+    """
+    if PY3:
+        view = memoryview(obj).cast("B")
+    pos = 0
+    while pos < size:
+        chunkSize = min(size - pos, 64 * 1024 * 1024)
+        if PY3:
+            chunk = view[pos:pos + chunkSize]
+        else:
+            # noinspection PyUnresolvedReferences
+            chunk = buffer(obj, pos, chunkSize)
+        pos += os.write(fd, chunk)
+
+
+def _getNumpyNdarrayType():
+    numpy = sys.modules.get("numpy")  # If it's not imported, there cannot be any ndarray.
+    if numpy is None:
+        return None
+    return numpy.ndarray
+
+
+def _oobIdentity(obj):
+    return obj
+
+
+def _oobMakeBytes(buf):
+    return bytes(buf)
+
+
+def _oobMakeArray(typecode, buf):
+    obj = array.array(typecode)
+    obj.frombytes(buf)
+    return obj
+
+
+class _PickleSession:
+    """
+    Sender side of the session mode of ExecingProcess_ConnectionWrapper, see enableSession().
+    Keeps the objects which we already sent, and under which session id.
+    The receiver keeps the same table (see _ConnUnpickler), so we can send back-references.
+
+    Eligible are large str/bytes/unicode objects, code objects (e.g. of lambdas which are pickled by value),
+    and objects which were explicitly shared (see share()). These must not be modified after they were sent.
+    Session ids are never reused. Evicted ids are told to the receiver along with the next new object.
+    All changes during one message are only kept when the message was pickled successfully (see endMessage).
+    """
+
+    Tag = "TaskSystem.session"
+
+    def __init__(self, maxObjects, maxBytes, minSize):
+        self.maxObjects = maxObjects
+        self.maxBytes = maxBytes
+        self.minSize = minSize
+        self.nextId = 0
+        self.sent = OrderedDict()  # id(obj) -> (obj, sid, size), LRU order
+        self.sentBytes = 0
+        self.shared = {}  # id(obj) -> obj
+        self.pendingEvictions = []  # sids, to be sent with the next new object
+        self.messageNew = set()  # id(obj), added during the current message
+        self.messageEvictions = None  # pendingEvictions at the start of the current message
+        self.counters = {"sessionHits": 0, "sessionSavedBytes": 0, "sessionNewObjects": 0}
+
+    def share(self, obj):
+        """
+        Makes obj eligible, e.g. a config dict or a vocabulary. You promise not to modify it anymore.
+        """
+        self.shared[id(obj)] = obj
+
+    def _isEligible(self, obj):
+        t = type(obj)
+        if t in (bytes, type(u"")):
+            return len(obj) >= self.minSize
+        if t is types.CodeType:
+            return True
+        return id(obj) in self.shared
+
+    def beginMessage(self):
+        self.messageNew = set()
+        self.messageEvictions = list(self.pendingEvictions)
+
+    def persistentId(self, obj):
+        """
+        :return: persistent id, or None if obj should be pickled as usual
+        """
+        key = id(obj)
+        entry = self.sent.get(key)
+        if entry is not None and entry[0] is obj:
+            del self.sent[key]
+            self.sent[key] = entry  # most recently used
+            if key not in self.messageNew:  # otherwise, the pickle memo would have done that as well
+                self.counters["sessionHits"] += 1
+                self.counters["sessionSavedBytes"] += entry[2]
+            return self.Tag, "ref", entry[1]
+        if not self._isEligible(obj):
+            return None
+        buf = BytesIO()
+        Pickler(buf).dump(obj)
+        payload = buf.getvalue()
+        if len(payload) < self.minSize:
+            return None
+        sid = self.nextId
+        self.nextId += 1
+        self.sent[key] = (obj, sid, len(payload))
+        self.sentBytes += len(payload)
+        self.messageNew.add(key)
+        self.counters["sessionNewObjects"] += 1
+        evictions, self.pendingEvictions = self.pendingEvictions, []
+        return self.Tag, "new", sid, payload, evictions
+
+    def endMessage(self, success):
+        """
+        :param bool success: whether the message was pickled. otherwise, forget the new objects again
+        """
+        if not success:
+            for key in self.messageNew:
+                _, sid, size = self.sent.pop(key)
+                self.sentBytes -= size
+            self.pendingEvictions = self.messageEvictions
+        else:
+            # Evict only now, as the message might reference the objects multiple times.
+            while self.sent and (len(self.sent) > self.maxObjects or self.sentBytes > self.maxBytes):
+                _, (_, sid, size) = self.sent.popitem(last=False)
+                self.sentBytes -= size
+                self.pendingEvictions.append(sid)
+        self.messageNew = set()
+        self.messageEvictions = None
+
+
+class _ConnPickler(Pickler):
+    """
+    Pickler used by ExecingProcess_ConnectionWrapper.send.
+
+    If `shmThreshold` is set, puts large buffer-protocol objects into shared memory segments.
+    The pickle stream only contains a reference to them.
+    The segment fds are then passed via the connection.
+
+    If `oobThreshold` is set, uses pickle protocol 5 to keep large buffers out of the pickle stream.
+    They are collected in `oobBuffers` and sent separately.
+
+    If `session` is set, objects which were already sent are replaced by back-references, see _PickleSession.
+    This takes precedence over the shared memory segments.
+    """
+
+    def __init__(self, file, shmThreshold=None, oobThreshold=None, session=None):
+        if oobThreshold is not None:
+            self.oobBuffers = []
+            Pickler.__init__(self, file, protocol=5, buffer_callback=self.oobBuffers.append)
+        else:
+            self.oobBuffers = None
+            Pickler.__init__(self, file)
+        self.shmThreshold = shmThreshold
+        self.oobThreshold = oobThreshold
+        self.session = session
+        self.inSavePers = False
+        self.shmFds = []
+        self.shmIds = {}  # id(obj) -> (obj, persistent id)
+        self.ndarrayType = _getNumpyNdarrayType()
+
+    def persistent_id(self, obj):
+        if self.inSavePers:
+            return None  # the elements of a persistent id, e.g. the session payload
+        pid = None
+        if self.session is not None:
+            pid = self.session.persistentId(obj)
+        if pid is None:
+            pid = self._shmPersistentId(obj)
+        return pid
+
+    def save_pers(self, pid):
+        self.inSavePers = True
+        try:
+            Pickler.save_pers(self, pid)
+        finally:
+            self.inSavePers = False
+
+    def _shmPersistentId(self, obj):
+        if self.shmThreshold is None:
+            return None
+        t = type(obj)
+        if t is bytes:
+            kind, size, meta = "bytes", len(obj), None
+        elif t is bytearray:
+            kind, size, meta = "bytearray", len(obj), None
+        elif t is array.array:
+            kind, size, meta = "array", len(obj) * obj.itemsize, obj.typecode
+        elif t is self.ndarrayType and not obj.dtype.hasobject:
+            kind, size, meta = "ndarray", obj.nbytes, (obj.dtype.str, obj.shape)
+        else:
+            return None
+        if size < self.shmThreshold:
+            return None
+        if id(obj) in self.shmIds:
+            return self.shmIds[id(obj)][1]
+        origObj = obj
+        if kind == "ndarray" and not obj.flags.c_contiguous:
+            obj = obj.copy(order="C")
+        fd = _shmCreate(size)
+        self.shmFds.append(fd)
+        try:
+            _shmWrite(fd, obj, size)
+        except BaseException:
+            self.closeFds()
+            raise
+        pid = ("TaskSystem.shm", len(self.shmFds) - 1, kind, size, meta)
+        self.shmIds[id(origObj)] = (origObj, pid)
+        return pid
+
+    def reducer_override(self, obj):
+        # Only used by the Python 3 pickle, and only relevant for protocol 5.
+        if self.oobThreshold is None:
+            return NotImplemented
+        t = type(obj)
+        if t is bytes and len(obj) >= self.oobThreshold:
+            return _oobMakeBytes, (pickle.PickleBuffer(obj),)
+        if t is bytearray and len(obj) >= self.oobThreshold:
+            return _oobIdentity, (pickle.PickleBuffer(obj),)  # we get a bytearray back, i.e. no copy
+        if t is array.array and len(obj) * obj.itemsize >= self.oobThreshold:
+            return _oobMakeArray, (obj.typecode, pickle.PickleBuffer(obj))
+        if t is self.ndarrayType and obj.nbytes >= self.oobThreshold:
+            # Numpy supports protocol 5 by itself. This bypasses the extpickle ndarray handling.
+            return obj.__reduce_ex__(5)
+        return NotImplemented
+
+    def closeFds(self):
+        for fd in self.shmFds:
+            os.close(fd)
+        del self.shmFds[:]
+
+
+class _SessionLoadFailure:
+    """
+    Placeholder in the receiver table of the session mode for an object which failed to unpickle.
+    """
+
+    def __init__(self, sid, exc):
+        self.sid = sid
+        self.exc = exc
+
+    def __str__(self):
+        return "session id %r failed to unpickle earlier: %r" % (self.sid, self.exc)
+
+
+class _ConnUnpickler(Unpickler):
+    """
+    Counterpart of _ConnPickler.
+    Maps the shared memory segments which we get via the connection.
+    Numpy arrays directly use the mapped memory, without a copy.
+    bytes, bytearray and array.array cannot wrap foreign memory, so they are copied out of the mapping once,
+    unless `shmViews` is set (Python 3 only): then they are memoryviews of the mapping
+    (read-only for bytes, and cast to the item format for array.array).
+    `buffers` are the out-of-band buffers for pickle protocol 5.
+    `session` is the receiver table of the session mode (sid -> obj), see _PickleSession.
+    Changes to it are only applied by commitSession(), i.e. after the message was unpickled,
+    also if that failed, as the sender keeps its changes then as well.
+    Objects whose payload failed to unpickle are kept as _SessionLoadFailure.
+    """
+
+    def __init__(self, file, conn, buffers=None, session=None, shmViews=False):
+        if buffers is not None:
+            Unpickler.__init__(self, file, buffers=buffers)
+        else:
+            Unpickler.__init__(self, file)
+        self.shmConn = conn
+        self.shmViews = shmViews and PY3
+        self.shmObjs = []
+        self.chunkedReader = file if isinstance(file, _ChunkedReader) else None
+        self.session = session
+        self.sessionNew = {}  # sid -> obj
+        self.sessionEvictions = []
+
+    def persistent_load(self, pid):
+        if pid[0] == _PickleSession.Tag:
+            return self._sessionLoad(pid)
+        return self._shmLoad(pid)
+
+    def _sessionLoad(self, pid):
+        if self.session is None:
+            raise pickle.UnpicklingError("session mode persistent id %r, but no session" % (pid,))
+        if pid[1] == "new":
+            _, _, sid, payload, evictions = pid
+            self.sessionEvictions.extend(evictions)
+            try:
+                obj = Unpickler(BytesIO(payload)).load()
+            except Exception as exc:
+                # The sender will send back-references to it. Give a clear error for those.
+                self.sessionNew[sid] = _SessionLoadFailure(sid, exc)
+                raise
+            self.sessionNew[sid] = obj
+            return obj
+        _, _, sid = pid
+        if sid in self.sessionNew:
+            obj = self.sessionNew[sid]
+        elif sid in self.session:
+            obj = self.session[sid]
+        else:
+            raise pickle.UnpicklingError(
+                "unknown session id %r (an earlier message might have failed to unpickle)" % sid)
+        if isinstance(obj, _SessionLoadFailure):
+            raise pickle.UnpicklingError(str(obj))
+        return obj
+
+    def commitSession(self):
+        if self.session is None:
+            return
+        for sid in self.sessionEvictions:
+            self.session.pop(sid, None)
+        self.session.update(self.sessionNew)
+
+    def _shmLoad(self, pid):
+        import mmap
+        tag, idx, kind, size, meta = pid
+        if tag != "TaskSystem.shm":
+            raise pickle.UnpicklingError("unsupported persistent id %r" % (pid,))
+        if idx < len(self.shmObjs):
+            return self.shmObjs[idx]
+        assert idx == len(self.shmObjs)
+        from multiprocessing.reduction import recv_handle
+        if self.chunkedReader:
+            self.chunkedReader.readAllFrames()  # the fds come after the last chunk
+        fd = recv_handle(self.shmConn)
+        try:
+            if self.shmViews and kind == "bytes":
+                m = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+            else:
+                m = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        if kind == "ndarray":
+            import numpy
+            dtype, shape = meta
+            obj = numpy.frombuffer(m, dtype=dtype).reshape(shape)  # keeps a reference to m
+        elif self.shmViews and kind in ("bytes", "bytearray"):
+            obj = memoryview(m)  # keeps a reference to m
+        elif self.shmViews and kind == "array" and meta not in ("u", "w"):  # no struct format for those
+            obj = memoryview(m).cast(meta)
+        else:
+            if kind == "bytearray":
+                obj = bytearray(m) if PY3 else bytearray(m[:])
+            elif kind == "array":
+                obj = array.array(meta)
+                if PY3:
+                    obj.frombytes(m)
+                else:
+                    obj.fromstring(m[:])
+            else:
+                obj = m[:]
+            m.close()
+        self.shmObjs.append(obj)
+        return obj
+
+
+class _ChunkedAbort(Exception):
+    """
+    The sender of a chunked message failed to pickle it, see _ChunkedWriter.abort.
+    """
+
+
+class _ChunkedWriter:
+    """
+    File-like object for the pickler in ExecingProcess_ConnectionWrapper.send.
+    As soon as there are more than `chunkSize` bytes, it sends them as frames:
+    the first one starts with ChunkedMagic, the following ones with b"C", the last one with b"E".
+    b"A" aborts the message.
+    Smaller messages are not sent here, see finish().
+    """
+
+    def __init__(self, conn, chunkSize):
+        """
+        :param ExecingProcess_ConnectionWrapper conn:
+        :param int chunkSize:
+        """
+        self.conn = conn
+        self.chunkSize = chunkSize
+        self.parts = []
+        self.size = 0
+        self.numFrames = 0
+        self.bytesSent = 0
+        self.sendTime = 0.0
+
+    def write(self, data):
+        pos = 0
+        n = len(data)
+        while n - pos >= self.chunkSize - self.size:
+            take = self.chunkSize - self.size
+            self.parts.append(data[pos:pos + take])
+            pos += take
+            self.size += take
+            self._sendFrame(b"C" if self.numFrames else self.conn.ChunkedMagic)
+        if pos < n:
+            self.parts.append(data[pos:] if pos else data)
+            self.size += n - pos
+
+    def _sendFrame(self, prefix):
+        startTime = time.time()
+        frame = b"".join([prefix] + self.parts)
+        self.parts = []
+        self.size = 0
+        self.conn._sendBytes(frame)  # within conn.send, i.e. under its sendLock
+        self.numFrames += 1
+        self.bytesSent += len(frame)
+        self.sendTime += time.time() - startTime
+
+    def finish(self):
+        """
+        :return: the whole pickle stream if it was small enough to be sent as a single frame,
+          otherwise it sends the last frame and returns None
+        :rtype: bytes|None
+        """
+        if not self.numFrames:
+            return b"".join(self.parts)
+        self._sendFrame(b"E")
+        return None
+
+    def abort(self):
+        if self.numFrames:
+            self.parts = []
+            self._sendFrame(b"A")
+
+
+class _ChunkedReader:
+    """
+    File-like object for the unpickler in ExecingProcess_ConnectionWrapper.recv,
+    which reads the frames of a chunked message (see _ChunkedWriter) on demand.
+    """
+
+    def __init__(self, conn, firstFrame):
+        """
+        :param ExecingProcess_ConnectionWrapper conn:
+        :param bytes firstFrame: starts with ChunkedMagic
+        """
+        self.conn = conn
+        self.buf = firstFrame
+        self.pos = len(conn.ChunkedMagic)
+        self.pendingFrames = []
+        self.last = False
+        self.numBytes = len(firstFrame)
+        self.recvTime = 0.0
+
+    def _recvFrame(self):
+        startTime = time.time()
+        frame = self.conn.recv_bytes()
+        self.recvTime += time.time() - startTime
+        self.numBytes += len(frame)
+        tag = frame[:1]
+        if tag == b"A":
+            self.last = True
+            raise _ChunkedAbort()
+        if tag not in (b"C", b"E"):
+            raise ProcConnectionDied("invalid chunk frame %r" % tag)
+        self.last = tag == b"E"
+        return frame
+
+    def _nextFrame(self):
+        if self.pendingFrames:
+            self.buf = self.pendingFrames.pop(0)
+        elif self.last:
+            return False
+        else:
+            self.buf = self._recvFrame()
+        self.pos = 1
+        return True
+
+    def readAllFrames(self):
+        while not self.last:
+            self.pendingFrames.append(self._recvFrame())
+
+    def finish(self):
+        while not self.last:
+            self._recvFrame()
+
+    def read(self, n=-1):
+        parts = []
+        while n != 0:
+            avail = len(self.buf) - self.pos
+            if avail == 0:
+                if not self._nextFrame():
+                    break
+                continue
+            take = avail if n < 0 else min(n, avail)
+            parts.append(self.buf[self.pos:self.pos + take])
+            self.pos += take
+            if n > 0:
+                n -= take
+        if len(parts) == 1:
+            return parts[0]
+        return b"".join(parts)
+
+    def readline(self):
+        parts = []
+        while True:
+            if self.pos >= len(self.buf):
+                if not self._nextFrame():
+                    break
+                continue
+            idx = self.buf.find(b"\n", self.pos)
+            if idx >= 0:
+                parts.append(self.buf[self.pos:idx + 1])
+                self.pos = idx + 1
+                break
+            parts.append(self.buf[self.pos:])
+            self.pos = len(self.buf)
+        return b"".join(parts)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+CompressionCodecs = OrderedDict()  # name -> (compress, decompress)
+
+
+def registerCompressionCodec(name, compress, decompress):
+    """
+    Registers a codec for the compression of ExecingProcess_ConnectionWrapper.
+    For exec'd children, it must also be registered in the child (e.g. at import time of your module),
+    otherwise the negotiation (see AsyncTask) will not pick it.
+
+    :param str name:
+    :param (bytes)->bytes compress:
+    :param (bytes)->bytes decompress:
+    """
+    assert name and "\0" not in name
+    CompressionCodecs[name] = (compress, decompress)
+
+
+def _registerBuiltinCompressionCodecs():
+    import zlib
+    registerCompressionCodec("zlib", lambda data: zlib.compress(data, 1), zlib.decompress)
+    try:
+        import lzma
+    except ImportError:  # Python 2
+        pass
+    else:
+        registerCompressionCodec("lzma", lambda data: lzma.compress(data, preset=0), lzma.decompress)
+
+
+_registerBuiltinCompressionCodecs()
+
+
+class ExecingProcess_ConnectionWrapper(object):
+    """
+    Wrapper around _multiprocessing.Connection.
+    This is needed to use our own Pickler.
+
+    If `SharedMemThreshold` is set, large buffer objects (bytes, bytearray, array.array, Numpy arrays)
+    of at least that many bytes are not sent through the pipe but put into
+    a shared memory segment, whose fd is passed via the (unix socket) connection.
+    This is opt-in (None by default): each segment costs a memfd/mmap and an fd pass,
+    which only pays off for really large buffers.
+    The receiver maps the segment. Numpy arrays use the mapping directly. bytes, bytearray and array.array
+    are copied out of it once (they cannot wrap foreign memory), unless the receiver sets `SharedMemViews`
+    (Python 3 only): then it gets them as memoryviews of the mapping, without any copy.
+
+    If `OutOfBandThreshold` is set (Python >=3.8 only), we use pickle protocol 5
+    and buffers of at least that size are kept out of the pickle stream.
+    They are written directly after the pickle stream with vectored I/O (sendmsg)
+    and the receiver reads them into preallocated buffers (recv_into).
+    The receiver detects this automatically, so only the sender needs to enable it.
+
+    Messages whose pickle stream is larger than `ChunkSize` are sent in chunks (see _ChunkedWriter),
+    and the receiver unpickles directly from the chunks as they arrive (see _ChunkedReader).
+    Thus the peak memory for the pickle stream is bounded by the chunk size on both sides,
+    and there is no limit on the message size. Set ChunkSize to None to disable this.
+    This is not used together with out-of-band buffers.
+
+    If a compression codec is set (see setCompression, CompressionCodecs, and AsyncTask),
+    single-frame messages of at least `CompressionThreshold` bytes are compressed.
+    It is adaptive: if the ratio is above `CompressionMaxRatio` or the speed is below
+    `CompressionMinSpeed` (bytes/sec), it skips the compression for the next messages
+    (with exponential backoff) and then tries again.
+    The receiver detects compressed frames automatically.
+
+    In the session mode (see enableSession), the sender and the receiver keep a table of the objects
+    which were already sent, and these are then only sent as back-references. See _PickleSession.
+    Only the sender needs to enable it.
+
+    It counts messages, bytes, pickle/unpickle time and the time blocked in recv, see stats().
+    The bytes are what went through the connection, i.e. without shared memory segments.
+
+    send() and send_bytes() can be called from multiple threads.
+    A message (all its frames and fds) is sent under `sendLock`, thus messages don't interleave.
+    """
+
+    SharedMemThreshold = None
+    SharedMemViews = False
+    OutOfBandThreshold = None
+    OutOfBandMagic = b"TSOOB1"  # pickle streams start with b"\x80", so this cannot be confused
+    ChunkSize = 16 * 1024 * 1024
+    ChunkedMagic = b"TSCHUNK1"
+    CompressionThreshold = 4096
+    CompressionMaxRatio = 0.9
+    CompressionMinSpeed = 20 * 1024 * 1024
+    CompressedMagic = b"TSZ1"
+    CompressionHelloMagic = b"TSZHELLO"
+
+    def __init__(self, fd=None, conn=None):
+        self.canPassFds = None  # will be checked on first use
+        self.sock = None  # for sendmsg/recv_into, created on first use
+        self.counters = {
+            "messagesSent": 0, "bytesSent": 0, "pickleTime": 0.0, "chunkedMessagesSent": 0,
+            "messagesReceived": 0, "bytesReceived": 0, "unpickleTime": 0.0, "recvBlockedTime": 0.0,
+            "chunkedMessagesReceived": 0,
+            "compressedMessagesSent": 0, "compressionSavedBytes": 0, "compressTime": 0.0, "decompressTime": 0.0}
+        self.compression = None  # codec name
+        self.compressionSkip = 0
+        self.compressionBackoff = 1
+        self.session = None  # _PickleSession, for what we send
+        self.recvSession = {}  # sid -> obj, for what we receive
+        self.sendLock = Lock()
+        self.fd = fd
+        if self.fd:
+            if PY3:
+                from multiprocessing.connection import Connection
+            else:
+                from _multiprocessing import Connection
+            self.conn = Connection(fd)
+        elif conn:
+            self.conn = conn
+        else:
+            self.conn = None
+
+    def __getstate__(self):
+        if self.fd is not None:
+            return {"fd": self.fd}
+        elif self.conn is not None:
+            return {"conn": self.conn}  # Try to pickle the connection.
+        else:
+            return {}
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __getattr__(self, attr): return getattr(self.conn, attr)
+
+    def passFds(self):
+        """
+        :return: fds which a child process needs for this connection (see ExecingProcess pass_fds)
+        :rtype: tuple[int]
+        """
+        return (self.fd,)
+
+    def stats(self):
+        """
+        :return: counters since creation. Times are in seconds.
+        :rtype: dict[str,int|float]
+        """
+        d = dict(self.counters)
+        if self.session is not None:
+            d.update(self.session.counters)
+            d["sessionObjects"] = len(self.session.sent)
+            d["sessionBytes"] = self.session.sentBytes
+        return d
+
+    def enableSession(self, maxObjects=1024, maxBytes=64 * 1024 * 1024, minSize=1024):
+        """
+        Enables the session mode for what we send.
+        Objects which were already sent are then sent as small back-references.
+        The objects are kept alive until they are evicted.
+
+        :param int maxObjects: evict the least recently used objects above this
+        :param int maxBytes: evict the least recently used objects above this (pickled size)
+        :param int minSize: objects with a smaller pickled size are always sent as usual
+        """
+        if self.session is None:
+            self.session = _PickleSession(maxObjects=maxObjects, maxBytes=maxBytes, minSize=minSize)
+
+    def shareInSession(self, obj):
+        """
+        Makes obj eligible for the session mode, e.g. a config dict or a vocabulary.
+        You promise not to modify it anymore. See enableSession().
+        """
+        assert self.session is not None, "call enableSession() first"
+        self.session.share(obj)
+
+    def setCompression(self, codec):
+        """
+        :param str|None codec: name in CompressionCodecs, or None to disable.
+          The other side must have it as well.
+        """
+        assert codec is None or codec in CompressionCodecs, "unknown codec %r" % codec
+        self.compression = codec
+        self.compressionSkip = 0
+        self.compressionBackoff = 1
+
+    def sendCompressionHello(self, codec):
+        """
+        For the negotiation in AsyncTask: tells the other side which codec to use.
+        :param str|None codec:
+        """
+        name = (codec or "").encode("ascii") if PY3 else (codec or "")
+        self.send_bytes(self.CompressionHelloMagic + name)
+
+    def recvCompressionHello(self):
+        """
+        Counterpart of sendCompressionHello.
+        :return: codec name or None
+        :rtype: str|None
+        """
+        frame = self.recv_bytes()
+        if frame[:len(self.CompressionHelloMagic)] != self.CompressionHelloMagic:
+            raise ProcConnectionDied("expected compression hello, got %r" % frame[:20])
+        name = frame[len(self.CompressionHelloMagic):]
+        if PY3:
+            name = name.decode("ascii")
+        return name or None
+
+    def _maybeCompress(self, data):
+        """
+        :param bytes data: pickle stream
+        :return: the frame to send, either data itself or the compressed frame
+        :rtype: bytes
+        """
+        if self.compression is None or len(data) < self.CompressionThreshold:
+            return data
+        if self.compressionSkip > 0:
+            self.compressionSkip -= 1
+            return data
+        compress = CompressionCodecs[self.compression][0]
+        startTime = time.time()
+        compressed = compress(data)
+        duration = max(time.time() - startTime, 1e-6)
+        self.counters["compressTime"] += duration
+        ratio = len(compressed) / float(len(data))
+        if ratio > self.CompressionMaxRatio or len(data) / duration < self.CompressionMinSpeed:
+            # Not worth it. Skip the next messages, and then try again.
+            self.compressionSkip = self.compressionBackoff
+            self.compressionBackoff = min(self.compressionBackoff * 2, 1024)
+        else:
+            self.compressionBackoff = 1
+        if ratio >= 1:
+            return data
+        self.counters["compressedMessagesSent"] += 1
+        self.counters["compressionSavedBytes"] += len(data) - len(compressed)
+        name = self.compression.encode("ascii") if PY3 else self.compression
+        return b"".join([self.CompressedMagic, name, b"\0", compressed])
+
+    def _decompress(self, frame):
+        """
+        :param bytes frame: starting with CompressedMagic
+        :return: pickle stream
+        :rtype: bytes
+        """
+        startTime = time.time()
+        idx = frame.index(b"\0", len(self.CompressedMagic))
+        name = frame[len(self.CompressedMagic):idx]
+        if PY3:
+            name = name.decode("ascii")
+        if name not in CompressionCodecs:
+            raise ProcConnectionDied("unknown compression codec %r" % name)
+        data = CompressionCodecs[name][1](frame[idx + 1:])
+        self.counters["decompressTime"] += time.time() - startTime
+        return data
+
+    def _check_closed(self):
+        if self.conn.closed: raise ProcConnectionDied("connection closed")
+    def _check_writable(self):
+        if not self.conn.writable: raise ProcConnectionDied("connection not writeable")
+    def _check_readable(self):
+        if not self.conn.readable: raise ProcConnectionDied("connection not readable")
+
+    def poll(self, *args, **kwargs):
+        while True:
+            try:
+                return self.conn.poll(*args, **kwargs)
+            except IOError as e:
+                if e.errno == errno.EINTR:
+                    # http://stackoverflow.com/questions/14136195
+                    # We can just keep trying.
+                    continue
+                raise ProcConnectionDied("poll IOError: %s" % e)
+            except EOFError as e:
+                raise ProcConnectionDied("poll EOFError: %s" % e)
+
+    def send_bytes(self, value):
+        with self.sendLock:
+            self._sendBytes(value)
+
+    def _sendBytes(self, value):
+        """
+        Like send_bytes, but the caller must hold sendLock.
+        """
+        try:
+            self.conn.send_bytes(value)
+        except (EOFError, IOError) as e:
+            raise ProcConnectionDied("send_bytes EOFError/IOError: %s" % e)
+
+    def _checkCanPassFds(self):
+        if self.canPassFds is None:
+            self.canPassFds = False
+            if sys.platform != "win32":
+                import stat
+                try:
+                    from multiprocessing.reduction import send_handle, recv_handle
+                    self.canPassFds = stat.S_ISSOCK(os.fstat(self.conn.fileno()).st_mode)
+                except (ImportError, AttributeError, OSError):
+                    pass
+        return self.canPassFds
+
+    def _checkOutOfBand(self):
+        if self.OutOfBandThreshold is None:
+            return False
+        if not PY3 or pickle.HIGHEST_PROTOCOL < 5:
+            return False
+        import socket
+        if not hasattr(socket.socket, "sendmsg"):
+            return False
+        return self._checkCanPassFds()  # i.e. it is a socket
+
+    def _getSocket(self):
+        if self.sock is None:
+            import socket
+            self.sock = socket.socket(fileno=os.dup(self.conn.fileno()))
+        return self.sock
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.conn.close()
+
+    def _sendOutOfBand(self, data, buffers):
+        """
+        Sends one frame which can be read by recv_bytes, containing the buffer sizes and the pickle stream,
+        and directly after it, the raw buffers. All via sendmsg, without concatenating them.
+        """
+        import struct
+        views = [b.raw() for b in buffers]
+        header = self.OutOfBandMagic + struct.pack("!I%iQ" % len(views), len(views), *[v.nbytes for v in views])
+        frameSize = len(header) + len(data)
+        assert frameSize < 0x7fffffff
+        parts = [struct.pack("!i", frameSize), header, data] + [v for v in views if v.nbytes]
+        sock = self._getSocket()
+        maxParts = 512  # below IOV_MAX
+        try:
+            while parts:
+                n = sock.sendmsg(parts[:maxParts])
+                while n > 0:
+                    if n >= len(parts[0]):
+                        n -= len(parts[0])
+                        parts.pop(0)
+                    else:
+                        parts[0] = memoryview(parts[0])[n:]
+                        n = 0
+        except (EOFError, IOError, OSError) as e:
+            raise ProcConnectionDied("sendmsg error: %s" % e)
+
+    def _recvOutOfBandBuffers(self, frame):
+        """
+        :param bytes frame: as we got it from recv_bytes, starting with OutOfBandMagic
+        :return: pickle stream, list of buffers
+        """
+        import struct
+        pos = len(self.OutOfBandMagic)
+        numBuffers, = struct.unpack_from("!I", frame, pos)
+        pos += 4
+        sizes = struct.unpack_from("!%iQ" % numBuffers, frame, pos)
+        pos += 8 * numBuffers
+        sock = self._getSocket()
+        buffers = []
+        for size in sizes:
+            buf = bytearray(size)
+            view = memoryview(buf)
+            received = 0
+            while received < size:
+                try:
+                    n = sock.recv_into(view[received:])
+                except (IOError, OSError) as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise ProcConnectionDied("recv_into error: %s" % e)
+                if n == 0:
+                    raise ProcConnectionDied("recv_into: EOF")
+                received += n
+            buffers.append(buf)
+        return memoryview(frame)[pos:], buffers
+
+    def send(self, value):
+        self._check_closed()
+        self._check_writable()
+        with self.sendLock:
+            self._send(value)
+
+    def _send(self, value):
+        shmThreshold = self.SharedMemThreshold if self._checkCanPassFds() else None
+        oobThreshold = self.OutOfBandThreshold if self._checkOutOfBand() else None
+        if self.ChunkSize and oobThreshold is None:
+            buf = _ChunkedWriter(self, self.ChunkSize)
+        else:
+            buf = BytesIO()
+        if shmThreshold is not None or oobThreshold is not None or self.session is not None:
+            pickler = _ConnPickler(buf, shmThreshold=shmThreshold, oobThreshold=oobThreshold, session=self.session)
+        else:
+            pickler = Pickler(buf)
+        try:
+            startTime = time.time()
+            if self.session is not None:
+                self.session.beginMessage()
+            try:
+                pickler.dump(value)
+            except BaseException:
+                if self.session is not None:
+                    self.session.endMessage(success=False)
+                if isinstance(buf, _ChunkedWriter):
+                    buf.abort()
+                raise
+            if self.session is not None:
+                self.session.endMessage(success=True)
+            if isinstance(buf, _ChunkedWriter):
+                data = buf.finish()  # None if it was sent in chunks
+                numBytes, sendTime = buf.bytesSent, buf.sendTime
+            else:
+                data = buf.getvalue()
+                numBytes, sendTime = 0, 0.0
+            self.counters["pickleTime"] += time.time() - startTime - sendTime
+            oobBuffers = getattr(pickler, "oobBuffers", None)
+            if data is None:
+                self.counters["chunkedMessagesSent"] += 1
+            elif oobBuffers:
+                self._sendOutOfBand(data, oobBuffers)
+                numBytes += len(data) + sum([b.raw().nbytes for b in oobBuffers])
+            else:
+                frame = self._maybeCompress(data)
+                self._sendBytes(frame)
+                numBytes += len(frame)
+            self.counters["messagesSent"] += 1
+            self.counters["bytesSent"] += numBytes
+            Tracing.addSpan("send", startTime, time.time(), {"bytes": numBytes})
+            if getattr(pickler, "shmFds", None):
+                from multiprocessing.reduction import send_handle
+                for fd in pickler.shmFds:
+                    try:
+                        send_handle(self.conn, fd, None)
+                    except (EOFError, IOError, OSError) as e:
+                        raise ProcConnectionDied("send_handle error: %s" % e)
+        finally:
+            if isinstance(pickler, _ConnPickler):
+                pickler.closeFds()
+
+    def recv_bytes(self):
+        while True:
+            try:
+                return self.conn.recv_bytes()
+            except IOError as e:
+                if e.errno == errno.EINTR:
+                    # http://stackoverflow.com/questions/14136195
+                    # We can just keep trying.
+                    continue
+                raise ProcConnectionDied("recv_bytes IOError: %s" % e)
+            except EOFError as e:
+                raise ProcConnectionDied("recv_bytes EOFError: %s" % e)
+
+    def recv(self):
+        self._check_closed()
+        self._check_readable()
+        while True:
+            startTime = time.time()
+            buf = self.recv_bytes()
+            numBytes = len(buf)
+            buffers = None
+            chunked = None
+            if buf[:len(self.OutOfBandMagic)] == self.OutOfBandMagic:
+                buf, buffers = self._recvOutOfBandBuffers(buf)
+                numBytes += sum([len(b) for b in buffers])
+                f = BytesIO(buf)
+            elif buf[:len(self.ChunkedMagic)] == self.ChunkedMagic:
+                f = chunked = _ChunkedReader(self, buf)
+            elif buf[:len(self.CompressedMagic)] == self.CompressedMagic:
+                f = BytesIO(self._decompress(buf))
+            else:
+                f = BytesIO(buf)
+            recvTime = time.time()
+            unpickler = _ConnUnpickler(
+                f, conn=self.conn, buffers=buffers, session=self.recvSession, shmViews=self.SharedMemViews)
+            aborted = False
+            try:
+                res = unpickler.load()
+            except _ChunkedAbort:
+                aborted = True
+                continue  # The sender failed to pickle this message. Wait for the next one.
+            finally:
+                if not aborted:  # then the sender discarded its session changes as well
+                    unpickler.commitSession()
+                if chunked is not None:
+                    chunked.finish()  # skip the rest of the message, if there is any
+            endTime = time.time()
+            recvBlockedTime = recvTime - startTime
+            if chunked is not None:
+                numBytes = chunked.numBytes
+                recvBlockedTime += chunked.recvTime
+                self.counters["chunkedMessagesReceived"] += 1
+            self.counters["recvBlockedTime"] += recvBlockedTime
+            self.counters["unpickleTime"] += endTime - startTime - recvBlockedTime
+            self.counters["messagesReceived"] += 1
+            self.counters["bytesReceived"] += numBytes
+            Tracing.addSpan("unpickle", recvTime, endTime, {"bytes": numBytes})
+            return res
+
+
+def ExecingProcess_Pipe():
+    """
+    This is like multiprocessing.Pipe(duplex=True).
+    It uses our own ExecingProcess_ConnectionWrapper.
+    """
+    import socket
+    s1, s2 = socket.socketpair()
+    c1 = ExecingProcess_ConnectionWrapper(os.dup(s1.fileno()))
+    c2 = ExecingProcess_ConnectionWrapper(os.dup(s2.fileno()))
+    s1.close()
+    s2.close()
+    return c1, c2
+
+
+def Pipe_ConnectionWrapper(*args, **kwargs):
+    from multiprocessing import Pipe
+    c1, c2 = Pipe(*args, **kwargs)
+    c1 = ExecingProcess_ConnectionWrapper(conn=c1)
+    c2 = ExecingProcess_ConnectionWrapper(conn=c2)
+    return c1, c2
+
+
+class _ShmMutex:
+    """
+    Process-shared robust pthread mutex in shared memory, via ctypes.
+    Uncontended, lock and unlock do not need a syscall.
+    If the owner died, the next lock() recovers it.
+    Use it only for a few memory accesses, as a signal might interrupt us in between.
+    """
+
+    Size = 64  # enough for pthread_mutex_t on the common platforms
+    EOwnerDead = getattr(errno, "EOWNERDEAD", 130)  # missing in Python 2. this is the Linux value
+    _lib = None
+
+    @classmethod
+    def _getLib(cls):
+        """
+        :return: the C library with the pthread functions, or None if not available
+        """
+        if cls._lib is None:
+            cls._lib = False
+            import ctypes
+            import ctypes.util
+            argTypes = {
+                "pthread_mutexattr_init": [ctypes.c_void_p],
+                "pthread_mutexattr_setpshared": [ctypes.c_void_p, ctypes.c_int],
+                "pthread_mutexattr_setrobust": [ctypes.c_void_p, ctypes.c_int],
+                "pthread_mutex_init": [ctypes.c_void_p, ctypes.c_void_p],
+                "pthread_mutex_lock": [ctypes.c_void_p],
+                "pthread_mutex_unlock": [ctypes.c_void_p],
+                "pthread_mutex_consistent": [ctypes.c_void_p]}
+            for libName in [None, ctypes.util.find_library("pthread")]:
+                try:
+                    # CDLL releases the GIL. This is needed if both sides of a ring are in the same process.
+                    lib = ctypes.CDLL(libName)
+                except OSError:
+                    continue
+                if all([hasattr(lib, name) for name in argTypes]):
+                    for name, types_ in argTypes.items():
+                        getattr(lib, name).argtypes = types_
+                        getattr(lib, name).restype = ctypes.c_int
+                    cls._lib = lib
+                    break
+        return cls._lib or None
+
+    @classmethod
+    def isSupported(cls):
+        return cls._getLib() is not None
+
+    @classmethod
+    def initialize(cls, mm, offset):
+        """
+        Creates a new mutex in mm at offset. This must be done once, before any process uses it.
+        """
+        import ctypes
+        lib = cls._getLib()
+        attr = ctypes.create_string_buffer(64)
+        buf = (ctypes.c_char * cls.Size).from_buffer(mm, offset)
+        try:
+            for res in [lib.pthread_mutexattr_init(attr),
+                        lib.pthread_mutexattr_setpshared(attr, 1),  # PTHREAD_PROCESS_SHARED
+                        lib.pthread_mutexattr_setrobust(attr, 1),  # PTHREAD_MUTEX_ROBUST
+                        lib.pthread_mutex_init(ctypes.addressof(buf), attr)]:
+                if res != 0:
+                    raise OSError(res, "pthread_mutex_init: %s" % os.strerror(res))
+        finally:
+            del buf  # release the buffer export, such that mm can be closed
+
+    def __init__(self, mm, offset):
+        import ctypes
+        lib = self._getLib()
+        self.buf = (ctypes.c_char * self.Size).from_buffer(mm, offset)
+        self.ptr = ctypes.c_void_p(ctypes.addressof(self.buf))
+        self._lock = lib.pthread_mutex_lock
+        self._unlock = lib.pthread_mutex_unlock
+        self._consistent = lib.pthread_mutex_consistent
+
+    def __enter__(self):
+        res = self._lock(self.ptr)
+        if res == 0:
+            return
+        if res == self.EOwnerDead:  # the other process died while it held it
+            self._consistent(self.ptr)
+        else:
+            raise OSError(res, "pthread_mutex_lock: %s" % os.strerror(res))
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._unlock(self.ptr)
+
+
+class _ShmRing:
+    """
+    One direction of ShmRing_ConnectionWrapper: a single-producer/single-consumer byte ring buffer
+    in shared memory. head and tail are monotonic byte counters, written only by the producer
+    resp. the consumer, as aligned 64bit values, thus no locks are needed for the data itself.
+    The waiting flags tell the other side that it should ring the doorbell.
+    A side sets its flag and checks the ring under the mutex (setWaiting),
+    and the other side checks the flag under the mutex after it has published (takeWaiting).
+    Thus, either the waiting side sees the new head/tail, or the other side sees the flag, i.e. no wakeup is lost.
+    Without _ShmMutex support, takeWaiting is always true, i.e. the doorbell is rung every time.
+    head/tail are published with plain stores, without a memory barrier. This relies on the total store order
+    of x86 (the data is visible before the new head, and the consumer is done reading before the new tail),
+    thus this is only supported there (see isSupported). Weaker memory models (e.g. ARM, POWER) would need fences.
+    """
+
+    HeaderSize = 256  # head, tail, the flags and the mutex each on their own cache line
+    SupportedMachines = ("x86_64", "amd64", "i386", "i486", "i586", "i686", "x86")
+
+    @classmethod
+    def isSupported(cls):
+        """
+        :return: whether this CPU has a strong enough memory model for the lock-free head/tail
+        :rtype: bool
+        """
+        import platform
+        return platform.machine().lower() in cls.SupportedMachines
+
+    def __init__(self, mm, offset, capacity):
+        import ctypes
+        self.mm = mm
+        self.dataOffset = offset + self.HeaderSize
+        self.capacity = capacity
+        self.head = ctypes.c_uint64.from_buffer(mm, offset)
+        self.tail = ctypes.c_uint64.from_buffer(mm, offset + 64)
+        self.consumerWaiting = ctypes.c_uint32.from_buffer(mm, offset + 128)
+        self.producerWaiting = ctypes.c_uint32.from_buffer(mm, offset + 132)
+        self.mutex = _ShmMutex(mm, offset + 192) if _ShmMutex.isSupported() else None
+
+    @classmethod
+    def initialize(cls, mm, offset):
+        """
+        Initializes the header of a new ring. The memory is expected to be zeroed.
+        """
+        if _ShmMutex.isSupported():
+            _ShmMutex.initialize(mm, offset + 192)
+
+    def setWaiting(self, flag, cond):
+        """
+        :param ctypes.c_uint32 flag: consumerWaiting or producerWaiting
+        :param ()->bool cond: checked after the flag was set
+        :return: cond()
+        :rtype: bool
+        """
+        if self.mutex is None:
+            flag.value = 1
+            return cond()
+        with self.mutex:
+            flag.value = 1
+            return cond()
+
+    def takeWaiting(self, flag):
+        """
+        Call this after you published (head or tail).
+        This also resets the flag, i.e. we ring at most once per wait of the other side.
+        :param ctypes.c_uint32 flag: the one of the other side
+        :return: whether we must ring the doorbell
+        :rtype: bool
+        """
+        if self.mutex is None:
+            return True
+        with self.mutex:
+            waiting = flag.value
+            flag.value = 0
+            return bool(waiting)
+
+    def available(self):
+        return self.head.value - self.tail.value
+
+    def free(self):
+        return self.capacity - self.available()
+
+    def write(self, data, pos, n):
+        """
+        Producer side. Writes data[pos:pos + n]. There must be at least n bytes free.
+        """
+        head = self.head.value
+        offset = head % self.capacity
+        first = min(n, self.capacity - offset)
+        start = self.dataOffset + offset
+        self.mm[start:start + first] = data[pos:pos + first]
+        if n > first:
+            self.mm[self.dataOffset:self.dataOffset + n - first] = data[pos + first:pos + n]
+        self.head.value = head + n  # publish
+
+    def read(self, n):
+        """
+        Consumer side. There must be at least n bytes available.
+        :rtype: bytes
+        """
+        tail = self.tail.value
+        offset = tail % self.capacity
+        first = min(n, self.capacity - offset)
+        start = self.dataOffset + offset
+        data = self.mm[start:start + first]
+        if n > first:
+            data += self.mm[self.dataOffset:self.dataOffset + n - first]
+        self.tail.value = tail + n  # release the space
+        return data
+
+
+class _PartsWriter(object):
+    """
+    Minimal file-like object for Pickler, which just collects the written parts.
+    Cheaper than BytesIO for small messages, esp. the pure Python StringIO in Python 2.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.write = self.parts.append
+
+
+class ShmRing_ConnectionWrapper(object):
+    """
+    Alternative transport to ExecingProcess_ConnectionWrapper, for high-frequency small messages.
+    See ShmRing_Pipe and AsyncTask(transport="shmring").
+
+    There is one single-producer/single-consumer ring buffer per direction in shared memory
+    (see _ShmRing). Messages are pickled and framed with their length.
+    A message larger than the ring is streamed through it.
+    When a side has to wait (for data or for free space), it spins for `SpinTime` seconds
+    (not on a single CPU, where this would only delay the other side),
+    and then it sets its waiting flag and blocks on a socketpair, which is used as the doorbell:
+    the other side writes a byte to it after it published data (or freed space) while the flag was set.
+    This is like an eventfd, but it is available in Python 2 and we also get EOF when the other side died.
+    There is one doorbell for data and one for space, as a sending and a receiving thread might wait at the same time.
+    The flag and the ring index are synchronized via a mutex in the ring header, thus no wakeup is lost.
+    The other side checks the flag once per message (and before it waits itself),
+    i.e. a message costs no syscall as long as the receiver does not wait,
+    and the doorbell is rung at most once per wait.
+
+    send/recv/poll/close/stats behave like ExecingProcess_ConnectionWrapper.
+    fileno() is not supported, i.e. this cannot be used with AsyncTaskSelector or aget/aput
+    (AsyncTask.fileno rejects it with a clear error).
+    The doorbell only gets rung while the other side waits, thus it is not a reliable readiness indicator.
+    It is safe to use from multiple threads, but it is meant for one sender and one receiver.
+    """
+
+    DefaultCapacity = 1024 * 1024
+    SpinTime = 50e-6  # seconds. 0 disables spinning
+    FrameHeader = "<Q"
+
+    def __init__(self, shmFd, dataSockFd, spaceSockFd, capacity, side):
+        """
+        :param int shmFd: shared memory of both rings
+        :param int dataSockFd: our end of the doorbell socketpair for "there is data in your ring"
+        :param int spaceSockFd: our end of the doorbell socketpair for "there is free space in your ring"
+        :param int capacity: bytes per ring
+        :param int side: 0 or 1. side 0 sends via the first ring, side 1 via the second
+        """
+        import mmap
+        import socket
+        import threading
+        self.shmFd = shmFd
+        self.dataSockFd = dataSockFd
+        self.spaceSockFd = spaceSockFd
+        # For the non-blocking writes. The fds themselves stay blocking, for our blocking reads.
+        self.dataSock = socket.fromfd(dataSockFd, socket.AF_UNIX, socket.SOCK_STREAM)
+        self.spaceSock = socket.fromfd(spaceSockFd, socket.AF_UNIX, socket.SOCK_STREAM)
+        self.capacity = capacity
+        self.side = side
+        self.mmap = mmap.mmap(shmFd, self.segmentSize(capacity))
+        ringSize = _ShmRing.HeaderSize + capacity
+        self.sendRing = _ShmRing(self.mmap, side * ringSize, capacity)
+        self.recvRing = _ShmRing(self.mmap, (1 - side) * ringSize, capacity)
+        self.sendLock = threading.Lock()
+        self.recvLock = threading.Lock()
+        self.spinTime = self._getSpinTime()
+        self.closed = False
+        self.peerDied = False
+        self.counters = {
+            "messagesSent": 0, "bytesSent": 0, "pickleTime": 0.0,
+            "messagesReceived": 0, "bytesReceived": 0, "unpickleTime": 0.0, "recvBlockedTime": 0.0,
+            "spinWaits": 0, "blockingWaits": 0}
+
+    @staticmethod
+    def segmentSize(capacity):
+        return 2 * (_ShmRing.HeaderSize + capacity)
+
+    @classmethod
+    def _getSpinTime(cls):
+        import multiprocessing
+        if multiprocessing.cpu_count() <= 1:
+            return 0.
+        return cls.SpinTime
+
+    def __getstate__(self):
+        return {"shmFd": self.shmFd, "dataSockFd": self.dataSockFd, "spaceSockFd": self.spaceSockFd,
+                "capacity": self.capacity, "side": self.side}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def passFds(self):
+        """
+        :return: fds which a child process needs for this connection (see ExecingProcess pass_fds)
+        :rtype: tuple[int]
+        """
+        return self.shmFd, self.dataSockFd, self.spaceSockFd
+
+    def stats(self):
+        """
+        :return: counters since creation. Times are in seconds.
+          spinWaits counts the waits which were satisfied while spinning,
+          blockingWaits the times we blocked on the doorbell.
+        :rtype: dict[str,int|float]
+        """
+        return dict(self.counters)
+
+    def fileno(self):
+        raise NotImplementedError("ShmRing_ConnectionWrapper cannot be used with select()")
+
+    def _checkOpen(self):
+        if self.closed:
+            raise ProcConnectionDied("connection closed")
+
+    def _ringDoorbell(self, sock):
+        import socket
+        try:
+            sock.send(b"\0", socket.MSG_DONTWAIT)
+        except (IOError, OSError) as e:  # socket.error is an IOError in Python 2
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return  # the other side has pending wakeups anyway
+            self.peerDied = True
+
+    def _drainDoorbell(self, fd):
+        """
+        Blocks until the doorbell was rung (or the other side died).
+        """
+        try:
+            if not os.read(fd, 4096):
+                self.peerDied = True  # EOF
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                self.peerDied = True
+
+    def _notifyData(self):
+        """
+        Call this after we published data in our send ring, at least before we wait ourselves.
+        """
+        ring = self.sendRing
+        if ring.takeWaiting(ring.consumerWaiting):
+            self._ringDoorbell(self.dataSock)
+
+    def _notifySpace(self):
+        """
+        Call this after we freed space in our recv ring, at least before we wait ourselves.
+        """
+        ring = self.recvRing
+        if ring.takeWaiting(ring.producerWaiting):
+            self._ringDoorbell(self.spaceSock)
+
+    def _waitUntil(self, cond, ring, waitingFlag, fd, timeout=None):
+        """
+        Spin, then block on the doorbell, until cond() is true.
+
+        :param ()->bool cond:
+        :param _ShmRing ring: the one we wait on
+        :param ctypes.c_uint32 waitingFlag: ours, in ring
+        :param int fd: the doorbell for waitingFlag
+        :param float|None timeout: in seconds
+        :return: False on timeout, otherwise True
+        :rtype: bool
+        """
+        if self.spinTime > 0:
+            spinEnd = time.time() + self.spinTime
+            while time.time() < spinEnd:
+                if cond():
+                    self.counters["spinWaits"] += 1
+                    return True
+        deadline = (time.time() + timeout) if timeout is not None else None
+        self.counters["blockingWaits"] += 1
+        try:
+            while True:
+                self._checkOpen()
+                if ring.setWaiting(waitingFlag, cond):
+                    return True
+                if self.peerDied:
+                    raise ProcConnectionDied("ShmRing: the other side died")
+                if deadline is None:
+                    self._drainDoorbell(fd)
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    if _selectReadable([fd], remaining):
+                        self._drainDoorbell(fd)
+                if cond():  # usually the case after a wakeup. no need for the mutex, as we don't wait
+                    return True
+        finally:
+            waitingFlag.value = 0
+
+    def send_bytes(self, data):
+        """
+        Sends one frame. The other side must read it with recv_bytes.
+        :param bytes data:
+        """
+        return self._sendFrame([data])
+
+    def _sendFrame(self, parts):
+        """
+        :param list[bytes] parts: the frame data
+        :return: number of bytes sent, including the frame header
+        :rtype: int
+        """
+        import struct
+        self._checkOpen()
+        if self.peerDied:
+            raise ProcConnectionDied("ShmRing: the other side died")
+        frame = b"".join([struct.pack(self.FrameHeader, sum(map(len, parts)))] + parts)
+        ring = self.sendRing
+        with self.sendLock:
+            pos = 0
+            while pos < len(frame):
+                free = ring.free()
+                if free == 0:
+                    self._notifyData()  # it must read before we get space
+                    self._waitUntil(lambda: ring.free() > 0, ring, ring.producerWaiting, self.spaceSockFd)
+                    continue
+                n = min(free, len(frame) - pos)
+                ring.write(frame, pos, n)
+                pos += n
+            self._notifyData()
+        return len(frame)
+
+    def _readExact(self, n):
+        ring = self.recvRing
+        if ring.available() >= n:
+            return ring.read(n)
+        parts = []
+        while n > 0:
+            available = ring.available()
+            if available == 0:
+                if parts:
+                    self._notifySpace()  # it might wait for the space we freed
+                self._waitUntil(lambda: ring.available() > 0, ring, ring.consumerWaiting, self.dataSockFd)
+                continue
+            k = min(available, n)
+            parts.append(ring.read(k))
+            n -= k
+        return b"".join(parts)
+
+    def recv_bytes(self):
+        """
+        :return: one frame, as sent by send_bytes
+        :rtype: bytes
+        """
+        import struct
+        self._checkOpen()
+        with self.recvLock:
+            headerSize = struct.calcsize(self.FrameHeader)
+            size, = struct.unpack(self.FrameHeader, self._readExact(headerSize))
+            data = self._readExact(size)
+            self._notifySpace()
+            return data
+
+    def send(self, value):
+        startTime = time.time()
+        buf = _PartsWriter()
+        Pickler(buf).dump(value)
+        self.counters["pickleTime"] += time.time() - startTime
+        numBytes = self._sendFrame(buf.parts)
+        self.counters["messagesSent"] += 1
+        self.counters["bytesSent"] += numBytes
+        Tracing.addSpan("send", startTime, time.time(), {"bytes": numBytes})
+
+    def recv(self):
+        startTime = time.time()
+        data = self.recv_bytes()
+        recvTime = time.time()
+        res = Unpickler(BytesIO(data)).load()
+        endTime = time.time()
+        self.counters["recvBlockedTime"] += recvTime - startTime
+        self.counters["unpickleTime"] += endTime - recvTime
+        self.counters["messagesReceived"] += 1
+        self.counters["bytesReceived"] += len(data)
+        Tracing.addSpan("unpickle", recvTime, endTime, {"bytes": len(data)})
+        return res
+
+    def poll(self, timeout=0):
+        """
+        :param float|None timeout: in seconds. None means to wait forever.
+        :return: whether there is something to recv, or the other side died (then recv raises)
+        :rtype: bool
+        """
+        self._checkOpen()
+        ring = self.recvRing
+        if ring.available() > 0:
+            return True
+        if timeout is not None and timeout <= 0:
+            if _selectReadable([self.dataSockFd], 0):
+                self._drainDoorbell(self.dataSockFd)
+            return ring.available() > 0 or self.peerDied
+        try:
+            return self._waitUntil(
+                lambda: ring.available() > 0, ring, ring.consumerWaiting, self.dataSockFd, timeout=timeout)
+        except ProcConnectionDied:
+            return True
+
+    def close(self):
+        # Note: we don't unmap explicitly, as another thread might still access the rings.
+        # The mapping is released when this object is garbage collected.
+        if self.closed:
+            return
+        self.closed = True
+        self.dataSock.close()
+        self.spaceSock.close()
+        os.close(self.dataSockFd)
+        os.close(self.spaceSockFd)
+        os.close(self.shmFd)
+
+
+def ShmRing_Pipe(capacity=None):
+    """
+    This is like ExecingProcess_Pipe(), but with the shared memory ring buffer transport.
+    The fds are inheritable, so that a fork+exec'd child can use its end.
+
+    :param int|None capacity: bytes per direction. default ShmRing_ConnectionWrapper.DefaultCapacity
+    :rtype: (ShmRing_ConnectionWrapper, ShmRing_ConnectionWrapper)
+    """
+    import socket
+    import mmap
+    if not _ShmRing.isSupported():
+        import platform
+        raise NotImplementedError(
+            "the shmring transport relies on the x86 memory model and is not supported on %r" % platform.machine())
+    capacity = capacity or ShmRing_ConnectionWrapper.DefaultCapacity
+    segmentSize = ShmRing_ConnectionWrapper.segmentSize(capacity)
+    shmFd = _shmCreate(segmentSize)
+    mm = mmap.mmap(shmFd, segmentSize)
+    for side in range(2):
+        _ShmRing.initialize(mm, side * (_ShmRing.HeaderSize + capacity))
+    mm.close()
+    dataSocks = socket.socketpair()
+    spaceSocks = socket.socketpair()
+    fds = [(os.dup(shmFd), os.dup(dataSocks[side].fileno()), os.dup(spaceSocks[side].fileno())) for side in range(2)]
+    os.close(shmFd)
+    for s in dataSocks + spaceSocks:
+        s.close()
+    conns = []
+    for side, sideFds in enumerate(fds):
+        for fd in sideFds:
+            _setCloexec(fd, False)
+        conns.append(ShmRing_ConnectionWrapper(*sideFds, capacity=capacity, side=side))
+    return tuple(conns)
+
+
+class ExecingForkServer:
+    """
+    A fork server (zygote) for ExecingProcess.
+    This is one clean fork+exec'd process which has imported the `preload` modules
+    and which never starts any threads.
+    New ExecingProcess children are forked from it on request.
+    Thus, the children still are fresh processes which were not forked from a threaded parent,
+    but they don't need to pay for the interpreter startup and the imports.
+
+    Note that the `env_update` of ExecingProcess is applied in the child after it was forked,
+    i.e. the preloaded modules only see the environment of the fork server.
+    Note that the child is not our child process but a grandchild of the fork server,
+    thus its exit status is reported back via a separate pipe.
+    """
+
+    def __init__(self, preload=(), env_update=None):
+        """
+        :param list[str] preload: modules to import in the fork server
+        :param dict[str,str]|None env_update: update these env vars for the fork server
+        """
+        self.preload = list(preload)
+        self.env_update = env_update
+        self.lock = Lock()
+        self.pid = None
+        self.conn = None
+        self.codeDigests = OrderedDict()  # what the fork server has in ExecingProcess.ChildCodeCache, LRU
+
+    def start(self):
+        import socket
+        with self.lock:
+            assert self.pid is None
+            s1, s2 = socket.socketpair()
+            parentFd = os.dup(s1.fileno())
+            childFd = os.dup(s2.fileno())
+            s1.close()
+            s2.close()
+            pid = os.fork()
+            if pid == 0:  # child
+                try:
+                    sys.stdin.close()  # Force no tty stdin.
+                    os.close(parentFd)
+                    _setCloexec(childFd, False)
+                    py_mod_file = os.path.splitext(__file__)[0] + ".py"
+                    assert os.path.exists(py_mod_file)
+                    args = [sys.executable,
+                            py_mod_file,
+                            "--forkServer",
+                            str(childFd),
+                            ",".join(self.preload)]
+                    if self.env_update:
+                        os.environ.update(self.env_update)
+                    os.execv(args[0], args)  # Does not return if successful.
+                except BaseException:
+                    print("ExecingForkServer: Error at initialization.")
+                    sys.excepthook(*sys.exc_info())
+                finally:
+                    os._exit(1)
+            os.close(childFd)
+            self.pid = pid
+            self.conn = ExecingProcess_ConnectionWrapper(parentFd)
+            self.codeDigests = OrderedDict()
+
+    def _updateCodeCache(self, codeBlobs):
+        """
+        :param dict[str,bytes] codeBlobs: the code which the new child needs
+        :return: the code which the fork server does not have yet, and the digests it should forget
+        :rtype: (dict[str,bytes], list[str])
+        """
+        newBlobs = {}
+        for digest, data in codeBlobs.items():
+            if digest in self.codeDigests:
+                del self.codeDigests[digest]
+            else:
+                newBlobs[digest] = data
+            self.codeDigests[digest] = True  # most recently used
+        evicted = []
+        excess = len(self.codeDigests) - ExecingProcess.TargetCache.maxSize
+        for digest in list(self.codeDigests.keys()):  # oldest first
+            if excess <= 0:
+                break
+            if digest in codeBlobs:
+                continue
+            del self.codeDigests[digest]
+            evicted.append(digest)
+            excess -= 1
+        return newBlobs, evicted
+
+    def spawn(self, name, env_update, fds, codeBlobs=None):
+        """
+        Lets the fork server fork a new ExecingProcess child.
+        The child will have `fds` under the same fd numbers
+        and will run ExecingProcess.checkExec() with the first two of them.
+        :param str name:
+        :param dict[str,str]|None env_update:
+        :param list[int] fds:
+        :param dict[str,bytes]|None codeBlobs: code for the child, see _TargetPickler.
+          The fork server keeps it, so we send each code only once.
+        :return: read end of the status pipe. It first gets one byte after the fork,
+          then a line with the child pid, then a line with its exit status,
+          followed by user time, system time and max RSS of the child.
+        :rtype: int
+        """
+        from multiprocessing.reduction import send_handle
+        if self.pid is None:
+            self.start()
+        statusReadFd, statusWriteFd = os.pipe()
+        try:
+            with self.lock:
+                newBlobs, evicted = self._updateCodeCache(codeBlobs or {})
+                self.conn.send((name, env_update, list(fds), newBlobs, evicted))
+                for fd in list(fds) + [statusWriteFd]:
+                    send_handle(self.conn, fd, self.pid)
+        except BaseException:
+            os.close(statusReadFd)
+            raise
+        finally:
+            os.close(statusWriteFd)
+        return statusReadFd
+
+    def stop(self):
+        with self.lock:
+            if self.pid is None:
+                return
+            try:
+                self.conn.send(None)
+            except ProcConnectionDied:
+                pass
+            self.conn.close()
+            os.waitpid(self.pid, 0)
+            self.pid = None
+            self.conn = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    @staticmethod
+    def checkServer():
+        if "--forkServer" not in sys.argv:
+            return
+        from multiprocessing.reduction import recv_handle
+        import signal
+        argidx = sys.argv.index("--forkServer")
+        connFd = int(sys.argv[argidx + 1])
+        preload = [modName for modName in sys.argv[argidx + 2].split(",") if modName]
+        for modName in preload:
+            __import__(modName)
+        # We don't wait for our children. They wait for the real child, see _serveChild.
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        conn = ExecingProcess_ConnectionWrapper(connFd)
+        while True:
+            try:
+                req = conn.recv()
+            except ProcConnectionDied:
+                break  # parent died
+            if req is None:
+                break
+            name, env_update, fdNums, codeBlobs, evicted = req
+            for digest in evicted:
+                ExecingProcess.ChildCodeCache.pop(digest, None)
+            ExecingProcess._addChildCode(codeBlobs)  # the child inherits it
+            fds = [recv_handle(conn) for _ in fdNums]
+            statusFd = recv_handle(conn)
+            pid = os.fork()
+            if pid == 0:  # child
+                try:
+                    ExecingForkServer._serveChild(
+                        connFd=connFd, name=name, env_update=env_update,
+                        fdNums=fdNums, fds=fds, statusFd=statusFd)
+                except BaseException:
+                    print("ExecingForkServer: Error in child %s." % name)
+                    sys.excepthook(*sys.exc_info())
+                finally:
+                    os._exit(1)
+            for fd in fds + [statusFd]:
+                os.close(fd)
+        raise SystemExit
+
+    @staticmethod
+    def _serveChild(connFd, name, env_update, fdNums, fds, statusFd):
+        """
+        This runs in a fork of the fork server.
+        It forks the real child and waits for it, to report its exit status.
+        Does not return.
+        """
+        import signal
+        import fcntl
+        os.close(connFd)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # we must survive to report the exit status
+        pid = os.fork()
+        if pid == 0:  # real child
+            sys.TaskSystemBootstrapTime = time.time()
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            os.close(statusFd)
+            # First move all fds out of the way, then put them at their expected place.
+            minFd = max(fdNums + fds) + 1
+            tmpFds = [fcntl.fcntl(fd, fcntl.F_DUPFD, minFd) for fd in fds]
+            for fd in fds:
+                os.close(fd)
+            for tmpFd, fd in zip(tmpFds, fdNums):
+                os.dup2(tmpFd, fd)
+                os.close(tmpFd)
+            if env_update:
+                os.environ.update(env_update)
+            sys.argv = [sys.argv[0], "--forkExecProc", str(fdNums[0]), str(fdNums[1])]
+            exitCode = 1
+            try:
+                ExecingProcess.checkExec()
+            except SystemExit as exc:
+                exitCode = exc.code if isinstance(exc.code, int) else (0 if exc.code is None else 1)
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                print("ExecingProcess: Error in %s." % name)
+                sys.excepthook(*sys.exc_info())
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(exitCode)
+        for fd in fds:
+            os.close(fd)
+        os.write(statusFd, b"\0%i\n" % pid)
+        while True:
+            try:
+                _, exitStatus, rusage = os.wait4(pid, 0)
+                break
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+        os.write(statusFd, b"%i %.6f %.6f %i\n" % (
+            exitStatus, rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss))
+        os._exit(0)
+
+
+if sys.platform == "win32":
+    from multiprocessing.forking import Popen as mp_Popen
+
+    class Win32_mp_Popen_wrapper:
+        def __init__(self, env_update):
+            self.env = os.environ.copy()
+            self.env.update(env_update)
+
+        class Popen(mp_Popen):
+            # noinspection PyMissingConstructor
+            def __init__(self, process_obj, env):
+                # No super init call by intention!
+
+                from multiprocessing.forking import duplicate, get_command_line, _python_exe, close, get_preparation_data, HIGHEST_PROTOCOL, dump
+                import msvcrt
+                import _subprocess
+
+                # create pipe for communication with child
+                rfd, wfd = os.pipe()
+
+                # get handle for read end of the pipe and make it inheritable
+                rhandle = duplicate(msvcrt.get_osfhandle(rfd), inheritable=True)
+                os.close(rfd)
+
+                # start process
+                cmd = get_command_line() + [rhandle]
+                cmd = ' '.join('"%s"' % x for x in cmd)
+                hp, ht, pid, tid = _subprocess.CreateProcess(
+                    _python_exe, cmd, None, None, 1, 0, env, None, None
+                )
+                ht.Close()
+                close(rhandle)
+
+                # set attributes of self
+                self.pid = pid
+                self.returncode = None
+                self._handle = hp
+
+                # send information to child
+                prep_data = get_preparation_data(process_obj._name)
+                to_child = os.fdopen(wfd, 'wb')
+                mp_Popen._tls.process_handle = int(hp)
+                try:
+                    dump(prep_data, to_child, HIGHEST_PROTOCOL)
+                    dump(process_obj, to_child, HIGHEST_PROTOCOL)
+                finally:
+                    del mp_Popen._tls.process_handle
+                    to_child.close()
+
+        def __call__(self, process_obj):
+            return self.Popen(process_obj, self.env)
+
+
+isFork = False  # fork() without exec()
+isMainProcess = True
+
+
+def _parseCpuList(s):
+    """
+    :param str s: e.g. "0-3,8-11", as in sysfs
+    :rtype: list[int]
+    """
+    cpus = []
+    for part in s.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-")
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def _getLibc():
+    import ctypes
+    return ctypes.CDLL(None, use_errno=True)
+
+
+def getCpuAffinity():
+    """
+    :return: CPUs which the current process may run on
+    :rtype: list[int]
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    import ctypes
+    import multiprocessing
+    numBits = 8 * ctypes.sizeof(ctypes.c_ulong)
+    mask = (ctypes.c_ulong * max(1024 // numBits, multiprocessing.cpu_count() // numBits + 1))()
+    if _getLibc().sched_getaffinity(0, ctypes.sizeof(mask), mask) != 0:
+        return list(range(multiprocessing.cpu_count()))
+    return [i * numBits + j for i in range(len(mask)) for j in range(numBits) if mask[i] & (1 << j)]
+
+
+def setCpuAffinity(cpus):
+    """
+    :param list[int] cpus: the current process (all threads created afterwards) will only run on these
+    """
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+        return
+    import ctypes
+    numBits = 8 * ctypes.sizeof(ctypes.c_ulong)
+    mask = (ctypes.c_ulong * max(1024 // numBits, max(cpus) // numBits + 1))()
+    for cpu in cpus:
+        mask[cpu // numBits] |= 1 << (cpu % numBits)
+    if _getLibc().sched_setaffinity(0, ctypes.sizeof(mask), mask) != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, "sched_setaffinity(%r): %s" % (cpus, os.strerror(e)))
+
+
+def getNumaNodes():
+    """
+    :return: NUMA node -> CPUs, from sysfs, restricted to getCpuAffinity().
+      Without NUMA info (e.g. not Linux), all CPUs are on node 0.
+    :rtype: dict[int,list[int]]
+    """
+    import glob
+    allowed = set(getCpuAffinity())
+    nodes = OrderedDict()
+    for path in sorted(glob.glob("/sys/devices/system/node/node[0-9]*"),
+                       key=lambda path: int(os.path.basename(path)[len("node"):])):
+        try:
+            with open(path + "/cpulist") as f:
+                cpus = [cpu for cpu in _parseCpuList(f.read()) if cpu in allowed]
+        except (IOError, OSError):
+            continue
+        if cpus:
+            nodes[int(os.path.basename(path)[len("node"):])] = cpus
+    if not nodes:
+        nodes[0] = sorted(allowed)
+    return nodes
+
+
+class ProcessPlacement:
+    """
+    Where and how a child process runs: CPU affinity, NUMA node, nice level, scheduling policy.
+    Pass it as `placement` to AsyncTask. It is applied in the child, before the target function runs.
+    Use spread() to distribute a number of workers over the CPUs and NUMA nodes.
+
+    The memory of a process bound to the CPUs of a NUMA node is usually allocated on that node
+    (first-touch). If libnuma is available, we additionally set the preferred node.
+    """
+
+    SchedPolicies = {"other": 0, "fifo": 1, "rr": 2, "batch": 3, "idle": 5}  # Linux
+
+    def __init__(self, cpus=None, numaNode=None, nice=None, schedPolicy=None, schedPriority=0):
+        """
+        :param list[int]|None cpus: CPU affinity. if None but numaNode is given, the CPUs of that node
+        :param int|None numaNode: prefer memory from this node
+        :param int|None nice: increment of the nice level, see os.nice()
+        :param str|None schedPolicy: key of SchedPolicies, e.g. "batch" or "idle"
+        :param int schedPriority: for "fifo" and "rr"
+        """
+        if cpus is None and numaNode is not None:
+            cpus = getNumaNodes().get(numaNode)
+        assert schedPolicy is None or schedPolicy in self.SchedPolicies, "unknown policy %r" % schedPolicy
+        self.cpus = list(cpus) if cpus is not None else None
+        self.numaNode = numaNode
+        self.nice = nice
+        self.schedPolicy = schedPolicy
+        self.schedPriority = schedPriority
+
+    def __repr__(self):
+        return "<ProcessPlacement cpus=%r numaNode=%r nice=%r schedPolicy=%r>" % (
+            self.cpus, self.numaNode, self.nice, self.schedPolicy)
+
+    @classmethod
+    def spread(cls, numWorkers, numaAware=True, **kwargs):
+        """
+        Distributes workers round-robin over the NUMA nodes, and within a node over its CPUs.
+        Each worker gets its own disjoint set of CPUs if there are enough,
+        otherwise the workers share the CPUs of their node.
+
+        :param int numWorkers:
+        :param bool numaAware: if False, ignore the NUMA nodes
+        :param kwargs: passed to ProcessPlacement, e.g. nice
+        :rtype: list[ProcessPlacement]
+        """
+        if numaAware:
+            nodes = getNumaNodes()
+        else:
+            nodes = {None: getCpuAffinity()}
+        nodeIds = list(nodes.keys())
+        workersPerNode = dict((nodeId, [i for i in range(numWorkers) if i % len(nodeIds) == j])
+                              for (j, nodeId) in enumerate(nodeIds))
+        placements = [None] * numWorkers
+        for nodeId in nodeIds:
+            cpus, workers = nodes[nodeId], workersPerNode[nodeId]
+            for k, i in enumerate(workers):
+                if len(workers) <= len(cpus):
+                    workerCpus = cpus[k * len(cpus) // len(workers):(k + 1) * len(cpus) // len(workers)]
+                else:
+                    workerCpus = cpus
+                placements[i] = cls(cpus=workerCpus, numaNode=nodeId, **kwargs)
+        return placements
+
+    def apply(self):
+        """
+        Applies this to the current process.
+        """
+        if self.cpus is not None:
+            setCpuAffinity(self.cpus)
+        if self.numaNode is not None:
+            self._setPreferredNumaNode(self.numaNode)
+        if self.nice:
+            os.nice(self.nice)
+        if self.schedPolicy is not None:
+            self._setScheduler(self.SchedPolicies[self.schedPolicy], self.schedPriority)
+
+    @staticmethod
+    def _setPreferredNumaNode(node):
+        import ctypes
+        import ctypes.util
+        libName = ctypes.util.find_library("numa")
+        if not libName:
+            return  # we rely on first-touch allocation
+        libnuma = ctypes.CDLL(libName)
+        if libnuma.numa_available() < 0:
+            return
+        libnuma.numa_set_preferred(node)
+
+    @staticmethod
+    def _setScheduler(policy, priority):
+        if hasattr(os, "sched_setscheduler"):
+            os.sched_setscheduler(0, policy, os.sched_param(priority))
+            return
+        import ctypes
+        param = ctypes.c_int(priority)  # struct sched_param
+        if _getLibc().sched_setscheduler(0, policy, ctypes.byref(param)) != 0:
+            e = ctypes.get_errno()
+            raise OSError(e, "sched_setscheduler(%r, %r): %s" % (policy, priority, os.strerror(e)))
+
+
+class AsyncTask:
+    """
+    This uses multiprocessing.Process or ExecingProcess to execute some function.
+    In addition, it provides a duplex pipe for communication. This is either
+    multiprocessing.Pipe or ExecingProcess_Pipe.
+
+    See stats() for performance counters.
+    All AsyncTasks are registered in asyncTaskStatsRegistry.
+    """
+
+    def __init__(self, func, name=None, mustExec=False, env_update=None, forkServer=None, bootstrap=None,
+                 compression=None, placement=None, transport=None, pickleSession=None):
+        """
+        :param func: a function which gets a single parameter,
+          which will be a reference to our instance in the fork,
+          so that it can use our communication methods put/get.
+        :type str name: name for the sub process
+        :param bool mustExec: if True, we do fork+exec, not just fork
+        :param dict[str,str] env_update: for mustExec, also update these env vars
+        :param ExecingForkServer|None forkServer: if given, the child is forked from this fork server.
+          This implies mustExec.
+        :param ExecingBootstrap|None bootstrap: for mustExec, how the child starts up
+        :param str|list[str]|None compression: codec name(s) in order of preference, see CompressionCodecs.
+          The child picks the first one which both sides have and tells us (this waits for the child),
+          and then both sides compress their messages with it.
+          See ExecingProcess_ConnectionWrapper for the details.
+        :param ProcessPlacement|None placement: CPU affinity, NUMA node, nice level etc. for the child
+        :param str|None transport: None for the default pipe (socketpair), or "shmring" for
+          shared memory ring buffers, which have a lower latency for small messages.
+          See ShmRing_ConnectionWrapper. This cannot be combined with compression,
+          and such a task has no fileno(), i.e. it cannot be used with waitAsyncTasks, aget etc.
+          It is only supported on x86 (see _ShmRing).
+        :param bool|dict[str]|None pickleSession: enables the session mode on both sides,
+          i.e. objects which were already sent are only sent as back-references.
+          A dict is passed as kwargs to ExecingProcess_ConnectionWrapper.enableSession.
+        """
+        startTime = time.time()
+        if forkServer:
+            mustExec = True
+        self.name = name or "unnamed"
+        self.func = func
+        self.mustExec = mustExec
+        self.env_update = env_update
+        self.forkServer = forkServer
+        self.placement = placement
+        self.parent_pid = os.getpid()
+        self.counters = {}
+        if isinstance(compression, str):
+            compression = [compression]
+        self.compression = [codec for codec in (compression or []) if codec in CompressionCodecs]
+        if pickleSession is True:
+            pickleSession = {}
+        self.pickleSession = pickleSession
+        proc_args = {
+            "target": funcCall,
+            "args": ((AsyncTask, "_asyncCall"), (self,)),
+            "name": self.name + " worker process"
+        }
+        if mustExec and sys.platform != "win32":
+            self.Process = ExecingProcess
+            self.Pipe = ExecingProcess_Pipe
+            proc_args["env_update"] = env_update
+            proc_args["bootstrap"] = bootstrap
+        else:
+            from multiprocessing import Process, Pipe
+            self.Process = Process
+            self.Pipe = Pipe_ConnectionWrapper
+        if transport == "shmring":
+            assert sys.platform != "win32", "shmring transport is not supported on Windows"
+            assert _ShmRing.isSupported(), "shmring transport is only supported on x86, see _ShmRing"
+            assert not self.compression, "shmring transport cannot be combined with compression"
+            assert pickleSession is None, "shmring transport cannot be combined with pickleSession"
+            self.Pipe = ShmRing_Pipe
+        else:
+            assert transport is None, "unknown transport %r" % transport
+        self.parent_conn, self.child_conn = self.Pipe()
+        if self.Process is ExecingProcess:
+            # The exec'd child gets only its own end.
+            for fd in self.parent_conn.passFds():
+                _setCloexec(fd)
+            proc_args["pass_fds"] = self.child_conn.passFds()
+            if forkServer:
+                proc_args["forkServer"] = forkServer
+        self.proc = self.Process(**proc_args)
+        self.proc.daemon = True
+        if sys.platform == 'win32':
+            self.proc._Popen = Win32_mp_Popen_wrapper(env_update=env_update)
+        self.proc.start()
+        self.child_conn.close()
+        self.child_pid = self.proc.pid
+        assert self.child_pid
+        self.conn = self.parent_conn
+        if self.pickleSession is not None:
+            self.conn.enableSession(**self.pickleSession)
+        if self.compression:
+            self.conn.setCompression(self.conn.recvCompressionHello())
+        self.counters["spawnTime"] = time.time() - startTime
+        Tracing.addSpan("spawn", startTime, startTime + self.counters["spawnTime"], {"name": self.name})
+        asyncTaskStatsRegistry.register(self)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.Process is ExecingProcess:
+            # The child does not inherit our fds, except of those passed explicitly.
+            state["forkServer"] = None
+            state["parent_conn"] = None
+            state["proc"] = None
+        return state
+
+    @staticmethod
+    def _asyncCall(self):
+        assert self.isChild
+        if self.parent_conn is not None:
+            self.parent_conn.close()
+        self.conn = self.child_conn # we are the child
+        if self.pickleSession is not None:
+            self.conn.enableSession(**self.pickleSession)
+        if self.compression:
+            codecs = [codec for codec in self.compression if codec in CompressionCodecs]
+            codec = codecs[0] if codecs else None
+            self.conn.sendCompressionHello(codec)
+            self.conn.setCompression(codec)
+        if not self.mustExec and sys.platform != "win32":
+            global isFork
+            isFork = True
+        global isMainProcess
+        isMainProcess = False
+        Tracing.checkEnv()
+        if not self.mustExec:  # otherwise ExecingProcess.checkExec did that
+            Tracing.setProcessName(self.name)
+        try:
+            if self.placement:
+                self.placement.apply()
+            with Tracing.span("AsyncTask", {"name": self.name}):
+                self.func(self)
+        except KeyboardInterrupt:
+            print("Exception in AsyncTask %s: KeyboardInterrupt" % self.name)
+            sys.exit(1)
+        except SystemExit:
+            raise
+        except BaseException:
+            print("Exception in AsyncTask %s" % self.name)
+            sys.excepthook(*sys.exc_info())
+            sys.exit(1)
+        finally:
+            self.conn.close()
+            Tracing.flush()  # a fork via multiprocessing exits via os._exit
+
+    def put(self, value):
+        self.conn.send(value)
+
+    def get(self):
+        thread = currentThread()
+        try:
+            thread.waitQueue = self
+            res = self.conn.recv()
+        except EOFError: # this happens when the child died
+            raise ForwardedKeyboardInterrupt()
+        except Exception:
+            raise
+        finally:
+            thread.waitQueue = None
+        return res
+
+    def aget(self, loop=None):
+        """
+        Like get(), but does not block.
+        It registers our connection with the asyncio event loop (loop.add_reader)
+        and returns a future which gets the value as soon as it is readable.
+        Note that once the message starts to arrive, reading it is blocking.
+        There must be at most one outstanding aget() per AsyncTask.
+
+        :param asyncio.AbstractEventLoop|None loop: by default, asyncio.get_event_loop()
+        :rtype: asyncio.Future
+        """
+        import asyncio
+        fd = self.fileno()
+        loop = loop or asyncio.get_event_loop()
+        future = loop.create_future()
+
+        def onReadable():
+            loop.remove_reader(fd)
+            if future.done():  # e.g. cancelled
+                return
+            try:
+                future.set_result(self.get())
+            except Exception as exc:
+                future.set_exception(exc)
+
+        def onDone(_):
+            if future.cancelled():
+                loop.remove_reader(fd)
+
+        loop.add_reader(fd, onReadable)
+        future.add_done_callback(onDone)
+        return future
+
+    def aput(self, value, loop=None):
+        """
+        Like put(), but waits via the asyncio event loop (loop.add_writer)
+        until our connection is writeable.
+
+        :param asyncio.AbstractEventLoop|None loop: by default, asyncio.get_event_loop()
+        :rtype: asyncio.Future
+        """
+        import asyncio
+        fd = self.fileno()
+        loop = loop or asyncio.get_event_loop()
+        future = loop.create_future()
+
+        def onWriteable():
+            loop.remove_writer(fd)
+            if future.done():
+                return
+            try:
+                self.put(value)
+            except Exception as exc:
+                future.set_exception(exc)
+            else:
+                future.set_result(None)
+
+        def onDone(_):
+            if future.cancelled():
+                loop.remove_writer(fd)
+
+        loop.add_writer(fd, onWriteable)
+        future.add_done_callback(onDone)
+        return future
+
+    def poll(self, timeout=0):
+        """
+        :param float|None timeout: in seconds. None means to wait forever.
+        :return: whether there is something to get()
+        :rtype: bool
+        """
+        return self.conn.poll(timeout)
+
+    def fileno(self):
+        """
+        The fd of our connection. It becomes readable when there is a message
+        or when the other side died. Thus, AsyncTask can be used with select() and co.
+        The shmring transport has no such fd, thus this raises ValueError then.
+        """
+        if isinstance(self.conn, ShmRing_ConnectionWrapper):
+            raise ValueError(
+                "%s uses the shmring transport, which has no pollable fd. "
+                "It cannot be used with select(), AsyncTaskSelector, waitAsyncTasks or aget/aput. "
+                "Use poll() and get() instead." % self.name)
+        return self.conn.fileno()
+
+    @property
+    def isParent(self):
+        return self.parent_pid == os.getpid()
+
+    @property
+    def isChild(self):
+        if self.isParent: return False
+        # Note: self.parent_pid != os.getppid() if the parent died.
+        return True
+
+    # This might be called from the module code.
+    # See OnRequestQueue which implements the same interface.
+    def setCancel(self):
+        self.conn.close()
+        if self.isParent and self.child_pid:
+            import signal
+            try:
+                os.kill(self.child_pid, signal.SIGINT)
+            except OSError:
+                # Could be that the process already died or so. Just ignore and assume it is dead.
+                pass
+            self.child_pid = None
+
+    terminate = setCancel  # alias
+
+    def join(self, timeout=None):
+        res = self.proc.join(timeout=timeout)
+        self._updateChildRusage()
+        return res
+
+    def is_alive(self):
+        res = self.proc.is_alive()
+        self._updateChildRusage()
+        return res
+
+    def _updateChildRusage(self):
+        rusage = getattr(self.proc, "rusage", None)  # only ExecingProcess has it
+        if rusage and self.isParent:
+            self.counters.update({
+                "childUserTime": rusage["userTime"],
+                "childSystemTime": rusage["systemTime"],
+                "childMaxRss": rusage["maxRss"]})
+
+    @staticmethod
+    def _makeStats(counters, conn):
+        d = dict(counters)
+        d.update(conn.stats())
+        return d
+
+    def stats(self):
+        """
+        Performance counters of our side of the connection (see ExecingProcess_ConnectionWrapper),
+        and in the parent, the spawn time (until the child process was started)
+        and after the child exited (see join), its CPU times and max RSS (childUserTime,
+        childSystemTime, childMaxRss). The latter are only available with mustExec.
+        Times are in seconds. childMaxRss is in KB on Linux.
+
+        :rtype: dict[str,int|float]
+        """
+        if self.isParent:
+            self._updateChildRusage()
+        return self._makeStats(self.counters, self.conn)
+
+
+class AsyncTaskStatsRegistry(object):
+    """
+    Keeps track of the stats of all AsyncTasks created in this process, e.g. for monitoring.
+    The stats of tasks which are gone (garbage collected) stay in the aggregate.
+    """
+
+    def __init__(self):
+        import threading
+        # RLock because the weakref callback can run via the GC while we hold it.
+        self.lock = threading.RLock()
+        self.tasks = {}  # id(weakref) -> (weakref, counters, conn)
+        self.retired = {}
+        self.numRetired = 0
+
+    def __reduce__(self):
+        # E.g. a function from __main__ with `from TaskSystem import *` has us in its globals.
+        # In another process, it should just refer to the registry of that process.
+        return _getAsyncTaskStatsRegistry, ()
+
+    def register(self, task):
+        """
+        :param AsyncTask task:
+        """
+        import weakref
+        # Don't reference the task itself, otherwise it would never be garbage collected.
+        counters, conn = task.counters, task.parent_conn
+
+        def onGone(ref):
+            with self.lock:
+                self.tasks.pop(id(ref), None)
+                self._accumulate(self.retired, AsyncTask._makeStats(counters, conn))
+                self.numRetired += 1
+
+        ref = weakref.ref(task, onGone)
+        with self.lock:
+            self.tasks[id(ref)] = (ref, counters, conn)
+
+    @staticmethod
+    def _accumulate(total, stats):
+        for key, value in stats.items():
+            if "Max" in key:
+                total[key] = max(total.get(key, value), value)
+            else:
+                total[key] = total.get(key, 0) + value
+
+    def tasksStats(self):
+        """
+        :return: stats of all tasks which are not garbage collected yet, with name and pid
+        :rtype: list[dict[str]]
+        """
+        with self.lock:
+            tasks = [ref() for (ref, _, _) in self.tasks.values()]
+        res = []
+        for task in tasks:
+            if task is None:
+                continue
+            d = task.stats()
+            d["name"] = task.name
+            d["pid"] = task.child_pid
+            res.append(d)
+        return res
+
+    def aggregate(self):
+        """
+        :return: stats summed up over all tasks (the maximum for the Max entries),
+          and numTasks (all registered tasks) and numActiveTasks (not garbage collected yet)
+        :rtype: dict[str,int|float]
+        """
+        with self.lock:
+            total = dict(self.retired)
+            for ref, counters, conn in self.tasks.values():
+                task = ref()
+                if task is not None:
+                    task._updateChildRusage()
+                self._accumulate(total, AsyncTask._makeStats(counters, conn))
+            total["numTasks"] = len(self.tasks) + self.numRetired
+            total["numActiveTasks"] = len(self.tasks)
+            return total
+
+
+asyncTaskStatsRegistry = AsyncTaskStatsRegistry()
+
+
+def _getAsyncTaskStatsRegistry():
+    return asyncTaskStatsRegistry
+
+
+def _getProcessRss(pid):
+    """
+    :param int pid:
+    :return: current resident set size in bytes, or None if unknown (e.g. no /proc)
+    :rtype: int|None
+    """
+    try:
+        with open("/proc/%i/statm" % pid) as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def _TaskPool_workerLoop(task):
+    """
+    This runs in a TaskPool worker process.
+    It executes one function after another, as they are sent by the parent,
+    using the same protocol as asyncCall. None means that we should quit.
+    """
+    q = _AsyncCallQueue(task)
+    while True:
+        try:
+            func, name = task.get()
+        except (ProcConnectionDied, ForwardedKeyboardInterrupt):
+            break  # parent died or closed the connection
+        if func is None:
+            break
+        _asyncCallChild(q, func, name)
+
+
+class TaskPool:
+    """
+    This keeps a number of pre-started AsyncTask workers alive and
+    dispatches asyncCall-style functions to them.
+    Thus, the fork (or fork+exec) and interpreter startup is only done once
+    per worker, not once per call.
+    A worker which died or got interrupted in the middle of a call
+    is replaced by a new one.
+
+    Workers can also be recycled, i.e. replaced after they executed `maxTasksPerWorker` calls,
+    or when their RSS exceeds `maxWorkerRss`, or after `maxWorkerLifetime`.
+    This is checked after each call. For this, we keep one standby worker,
+    which is spawned in the background, so that recycling does not add latency to asyncCall.
+    The old worker quits in the background.
+    """
+
+    def __init__(self, numWorkers, name=None, mustExec=False, env_update=None, forkServer=None,
+                 maxTasksPerWorker=None, maxWorkerRss=None, maxWorkerLifetime=None):
+        """
+        :param int numWorkers: number of worker processes
+        :param str name: name for the worker processes
+        :param bool mustExec: if True, the workers do fork+exec, not just fork
+        :param dict[str,str] env_update: for mustExec, also update these env vars
+        :param ExecingForkServer|None forkServer: if given, the workers are forked from this fork server
+        :param int|None maxTasksPerWorker: recycle a worker after that many calls
+        :param int|None maxWorkerRss: in bytes. recycle a worker when its RSS is above (Linux only)
+        :param float|None maxWorkerLifetime: in seconds. recycle a worker when it is older
+        """
+        import threading
+        assert numWorkers > 0
+        self.name = name or "unnamed"
+        self.numWorkers = numWorkers
+        self.mustExec = mustExec
+        self.env_update = env_update
+        self.forkServer = forkServer
+        self.lock = threading.RLock()
+        self.idleCond = threading.Condition(self.lock)
+        self.closed = False
+        self.workers = []
+        self.idleWorkers = []
+        self.maxTasksPerWorker = maxTasksPerWorker
+        self.maxWorkerRss = maxWorkerRss
+        self.maxWorkerLifetime = maxWorkerLifetime
+        self.workerInfo = {}  # worker -> {"numTasks", "startTime"}
+        self.numRecycled = 0
+        self.standbyWorker = None
+        self.standbyThread = None
+        self.backgroundThreads = []
+        for i in range(numWorkers):
+            self._addWorker()
+        if self._recyclingEnabled():
+            self._spawnStandbyInBackground()
+
+    def _newWorker(self):
+        return AsyncTask(
+            func=_TaskPool_workerLoop, name="%s pool worker" % self.name,
+            mustExec=self.mustExec, env_update=self.env_update, forkServer=self.forkServer)
+
+    def _addWorker(self, worker=None):
+        if worker is None:
+            worker = self._newWorker()
+        with self.lock:
+            self.workers.append(worker)
+            self.idleWorkers.append(worker)
+            self.workerInfo[worker] = {"numTasks": 0, "startTime": time.time()}
+            self.idleCond.notify()
+
+    def _recyclingEnabled(self):
+        return any(limit is not None for limit in [self.maxTasksPerWorker, self.maxWorkerRss, self.maxWorkerLifetime])
+
+    def _startBackgroundThread(self, target, name):
+        import threading
+        thread = threading.Thread(target=target, name="%s %s" % (self.name, name))
+        thread.daemon = True
+        with self.lock:
+            self.backgroundThreads = [t for t in self.backgroundThreads if t.is_alive()] + [thread]
+        thread.start()
+        return thread
+
+    def _spawnStandbyInBackground(self):
+        def spawn():
+            try:
+                worker = self._newWorker()
+            except Exception:
+                print("TaskPool %s: cannot spawn standby worker" % self.name)
+                sys.excepthook(*sys.exc_info())
+                return
+            with self.lock:
+                if not self.closed:
+                    self.standbyWorker = worker
+                    return
+            self._quitWorker(worker)
+        self.standbyThread = self._startBackgroundThread(spawn, "pool standby spawn")
+
+    def _spawnReplacement(self):
+        worker = self._newWorker()
+        with self.lock:
+            if not self.closed:
+                self._addWorker(worker)
+                return
+        self._quitWorker(worker)
+
+    @staticmethod
+    def _quitWorker(worker):
+        try:
+            worker.put((None, None))
+        except ProcConnectionDied:
+            pass
+        worker.join()
+
+    def _needsRecycling(self, worker):
+        info = self.workerInfo[worker]
+        if self.maxTasksPerWorker is not None and info["numTasks"] >= self.maxTasksPerWorker:
+            return True
+        if self.maxWorkerLifetime is not None and time.time() - info["startTime"] >= self.maxWorkerLifetime:
+            return True
+        if self.maxWorkerRss is not None:
+            rss = _getProcessRss(worker.child_pid)
+            if rss is not None and rss >= self.maxWorkerRss:
+                return True
+        return False
+
+    def _recycleWorker(self, worker):
+        """
+        Replaces the (idle) worker by the standby worker, or by a new one if the standby is not ready yet.
+        """
+        with self.lock:
+            self.workers.remove(worker)
+            del self.workerInfo[worker]
+            self.numRecycled += 1
+            replacement, self.standbyWorker = self.standbyWorker, None
+            if replacement:
+                self._addWorker(replacement)
+        if replacement:
+            self._spawnStandbyInBackground()
+        else:
+            # The standby is still spawning, and will be available later as usual.
+            self._startBackgroundThread(self._spawnReplacement, "pool worker spawn")
+        self._startBackgroundThread(lambda: self._quitWorker(worker), "pool worker quit")
+
+    def _acquireWorker(self):
+        with self.lock:
+            while not self.idleWorkers:
+                if self.closed:
+                    raise ProcConnectionDied("TaskPool %s closed" % self.name)
+                self.idleCond.wait()
+            if self.closed:
+                raise ProcConnectionDied("TaskPool %s closed" % self.name)
+            return self.idleWorkers.pop()
+
+    def _releaseWorker(self, worker):
+        with self.lock:
+            self.workerInfo[worker]["numTasks"] += 1
+            if not self.closed and self._recyclingEnabled() and self._needsRecycling(worker):
+                self._recycleWorker(worker)
+                return
+            self.idleWorkers.append(worker)
+            self.idleCond.notifyAll()
+
+    def _discardWorker(self, worker):
+        worker.setCancel()
+        with self.lock:
+            self.workers.remove(worker)
+            del self.workerInfo[worker]
+            if self.closed:
+                self.idleCond.notifyAll()
+                return
+        self._addWorker()
+
+    def asyncCall(self, func, name=None):
+        """
+        Like asyncCall(), but executes func() in one of our worker processes.
+        Blocks until a worker is free and until func() is finished.
+        """
+        worker = self._acquireWorker()
+        try:
+            worker.put((func, name))
+            t, value = _asyncCallHostLoop(worker)
+        except BaseException:
+            # The worker died or we were interrupted in the middle of the protocol.
+            # In both cases, we cannot reuse it.
+            self._discardWorker(worker)
+            raise
+        self._releaseWorker(worker)
+        return _asyncCallResult(t, value)
+
+    def close(self):
+        """
+        Waits until all running calls are finished and then lets the workers quit.
+        """
+        with self.lock:
+            self.closed = True
+            self.idleCond.notifyAll()
+            while len(self.idleWorkers) < len(self.workers):
+                self.idleCond.wait()
+            workers = list(self.workers)
+            del self.workers[:]
+            del self.idleWorkers[:]
+            self.workerInfo.clear()
+        if self.standbyThread:
+            self.standbyThread.join()
+        with self.lock:
+            if self.standbyWorker:
+                workers.append(self.standbyWorker)
+                self.standbyWorker = None
+            backgroundThreads = list(self.backgroundThreads)
+        for worker in workers:
+            try:
+                worker.put((None, None))
+            except ProcConnectionDied:
+                pass
+        for worker in workers:
+            worker.join()
+        for thread in backgroundThreads:
+            thread.join()
+
+    def terminate(self):
+        """
+        Kills all workers, also the busy ones.
+        """
+        with self.lock:
+            self.closed = True
+            workers = list(self.workers)
+            if self.standbyWorker:
+                workers.append(self.standbyWorker)
+                self.standbyWorker = None
+            self.idleCond.notifyAll()
+        for worker in workers:
+            worker.setCancel()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+
+class WorkStealingScheduler:
+    """
+    Dispatches asyncCall-style functions to a fixed set of long-lived AsyncTask workers,
+    e.g. one per device, each with its own env_update.
+    Every worker has its own queue, ordered by priority (higher first, FIFO otherwise).
+    A worker whose queue is empty steals from the longest queue of the other workers,
+    thus heterogeneous task durations do not leave workers idle.
+    The affinity hint of a call is some hashable key (e.g. the name of the dataset it uses),
+    and the call is queued at the worker which ran the last call with the same key.
+    It is only a hint, i.e. the call can still be stolen by another worker.
+
+    In the parent, there is one dispatcher thread per worker.
+    The submit() functions return an AsyncCallFuture.
+    Cancelling it while it is queued just removes it,
+    cancelling it while it runs kills the worker, which gets replaced then.
+    """
+
+    MaxAffinityKeys = 10000
+
+    def __init__(self, numWorkers=None, name=None, mustExec=False, env_update=None, forkServer=None,
+                 workerEnvUpdates=None, workerPlacements=None):
+        """
+        :param int|None numWorkers: number of worker processes. by default len(workerEnvUpdates)
+        :param str name: name for the worker processes
+        :param bool mustExec: if True, the workers do fork+exec, not just fork
+        :param dict[str,str] env_update: for mustExec, also update these env vars, for all workers
+        :param ExecingForkServer|None forkServer: if given, the workers are forked from this fork server
+        :param list[dict[str,str]]|None workerEnvUpdates: per worker, additionally to env_update,
+          e.g. [{"CUDA_VISIBLE_DEVICES": str(i)} for i in range(numDevices)]
+        :param list[ProcessPlacement]|str|None workerPlacements: per worker,
+          or "spread" for ProcessPlacement.spread(numWorkers)
+        """
+        import threading
+        if numWorkers is None:
+            assert workerEnvUpdates, "specify numWorkers or workerEnvUpdates"
+            numWorkers = len(workerEnvUpdates)
+        assert numWorkers > 0
+        assert workerEnvUpdates is None or len(workerEnvUpdates) == numWorkers
+        if workerPlacements == "spread":
+            workerPlacements = ProcessPlacement.spread(numWorkers)
+        assert workerPlacements is None or len(workerPlacements) == numWorkers
+        self.name = name or "unnamed"
+        self.numWorkers = numWorkers
+        self.mustExec = mustExec
+        self.env_update = env_update
+        self.forkServer = forkServer
+        self.workerEnvUpdates = workerEnvUpdates
+        self.workerPlacements = workerPlacements
+        self.lock = threading.RLock()
+        self.cond = threading.Condition(self.lock)
+        self.closed = False
+        self.seq = 0
+        self.queues = [[] for i in range(numWorkers)]  # heaps of (-priority, seq, job)
+        self.affinities = OrderedDict()  # affinity key -> worker index, LRU
+        self.counters = {"executed": [0] * numWorkers, "stolen": [0] * numWorkers}
+        self.workers = [self._startWorker(i) for i in range(numWorkers)]
+        self.threads = []
+        for i in range(numWorkers):
+            thread = threading.Thread(target=self._dispatchLoop, args=(i,),
+                                      name="%s scheduler dispatcher %i" % (self.name, i))
+            thread.daemon = True
+            self.threads.append(thread)
+            thread.start()
+
+    def _startWorker(self, idx):
+        env_update = dict(self.env_update or {})
+        if self.workerEnvUpdates:
+            env_update.update(self.workerEnvUpdates[idx])
+        return AsyncTask(
+            func=_TaskPool_workerLoop, name="%s scheduler worker %i" % (self.name, idx),
+            mustExec=self.mustExec, env_update=env_update or None, forkServer=self.forkServer,
+            placement=self.workerPlacements[idx] if self.workerPlacements else None)
+
+    def submit(self, func, name=None, priority=0, affinity=None, worker=None):
+        """
+        Queues func() for execution in one of the workers.
+
+        :param ()->T func:
+        :param str|None name:
+        :param int|float priority: higher priority calls are started first
+        :param affinity: hashable key. prefer the worker which ran the last call with this key
+        :param int|None worker: prefer this worker index. overrides affinity
+        :rtype: AsyncCallFuture
+        """
+        import heapq
+        future = AsyncCallFuture()
+        job = (func, name, affinity, future)
+        with self.lock:
+            if self.closed:
+                raise ProcConnectionDied("WorkStealingScheduler %s closed" % self.name)
+            if worker is None and affinity is not None:
+                worker = self.affinities.get(affinity)
+            if worker is None:
+                worker = min(range(self.numWorkers), key=lambda i: len(self.queues[i]))
+            assert 0 <= worker < self.numWorkers
+            self.seq += 1
+            heapq.heappush(self.queues[worker], (-priority, self.seq, job))
+            self.cond.notifyAll()
+        return future
+
+    def asyncCall(self, func, name=None, priority=0, affinity=None, worker=None):
+        """
+        Like submit(), but blocks until func() is finished, and returns its result.
+        """
+        return self.submit(func, name=name, priority=priority, affinity=affinity, worker=worker).result()
+
+    def _popJob(self, idx):
+        """
+        Takes the next job from our own queue, or steals one from the longest other queue.
+        Cancelled jobs are dropped on the way.
+        Must be called with the lock held.
+
+        :param int idx: worker index
+        :return: job or None
+        """
+        import heapq
+        while True:
+            queue = self.queues[idx]
+            stolen = False
+            if not queue:
+                victim = max(range(self.numWorkers), key=lambda i: len(self.queues[i]))
+                queue = self.queues[victim]
+                stolen = True
+            if not queue:
+                return None
+            _, _, job = heapq.heappop(queue)
+            if job[3].done():  # cancelled while queued
+                continue
+            if stolen:
+                self.counters["stolen"][idx] += 1
+            return job
+
+    def _dispatchLoop(self, idx):
+        while True:
+            with self.lock:
+                while True:
+                    job = self._popJob(idx)
+                    if job or self.closed:
+                        break
+                    self.cond.wait()
+                worker = self.workers[idx]
+            if not job:
+                break
+            func, name, affinity, future = job
+            future.task = worker
+            try:
+                worker.put((func, name))
+                t, value = _asyncCallHostLoop(worker)
+            except BaseException as exc:
+                # The worker died or got cancelled in the middle of the protocol. We cannot reuse it.
+                worker.setCancel()
+                future._setDone(exception=exc if isinstance(exc, Exception) else ProcConnectionDied(repr(exc)))
+                with self.lock:
+                    if self.closed:
+                        break
+                try:
+                    newWorker = self._startWorker(idx)
+                except Exception:
+                    print("WorkStealingScheduler %s: cannot restart worker %i" % (self.name, idx))
+                    sys.excepthook(*sys.exc_info())
+                    break
+                with self.lock:
+                    self.workers[idx] = newWorker
+                continue
+            with self.lock:
+                self.counters["executed"][idx] += 1
+                if affinity is not None:
+                    self.affinities.pop(affinity, None)
+                    self.affinities[affinity] = idx
+                    while len(self.affinities) > self.MaxAffinityKeys:
+                        self.affinities.popitem(last=False)
+            try:
+                res = _asyncCallResult(t, value)
+            except BaseException as exc:  # e.g. SystemExit from the child. It must not kill this thread.
+                future._setDone(exception=exc if isinstance(exc, Exception) else ProcConnectionDied(repr(exc)))
+            else:
+                future._setDone(result=res)
+        with self.lock:
+            worker = self.workers[idx]
+        try:
+            worker.put((None, None))
+        except ProcConnectionDied:
+            pass
+        worker.join()
+
+    def queueSizes(self):
+        """
+        :return: number of queued (not yet started) calls per worker
+        :rtype: list[int]
+        """
+        with self.lock:
+            return [len(queue) for queue in self.queues]
+
+    def stats(self):
+        """
+        :return: per worker: number of executed calls, and how many of them were stolen from other workers
+        :rtype: dict[str,list[int]]
+        """
+        with self.lock:
+            return {key: list(value) for (key, value) in self.counters.items()}
+
+    def close(self):
+        """
+        Executes all queued calls, and then lets the workers quit.
+        """
+        with self.lock:
+            self.closed = True
+            self.cond.notifyAll()
+        for thread in self.threads:
+            thread.join()
+
+    def terminate(self):
+        """
+        Cancels all queued calls and kills all workers, also the busy ones.
+        """
+        with self.lock:
+            self.closed = True
+            jobs = [job for queue in self.queues for (_, _, job) in queue]
+            for queue in self.queues:
+                del queue[:]
+            workers = list(self.workers)
+            self.cond.notifyAll()
+        for func, name, affinity, future in jobs:
+            future.cancel()
+        for worker in workers:
+            worker.setCancel()
 
+    def __enter__(self):
+        return self
 
-isFork = False  # fork() without exec()
-isMainProcess = True
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
 
 
-class AsyncTask:
+class AsyncTaskSelector:
     """
-    This uses multiprocessing.Process or ExecingProcess to execute some function.
-    In addition, it provides a duplex pipe for communication. This is either
-    multiprocessing.Pipe or ExecingProcess_Pipe.
+    Waits on many AsyncTask connections at once, via the selectors module (epoll and co),
+    or via select.epoll/select.poll in Python 2.
+    Tasks are registered once, thus select() costs O(ready), not O(registered).
+    A task is ready when it has a message for us or when the other side died.
+    It can also be passed to waitAsyncTasks/waitProcesses, to reuse it across calls.
     """
 
-    def __init__(self, func, name=None, mustExec=False, env_update=None):
+    def __init__(self):
+        import select
+        try:
+            import selectors
+        except ImportError:
+            selectors = None
+        self.tasks = {}  # fd -> (task, data)
+        self.fds = {}  # task -> fd
+        if selectors:
+            self.selector = selectors.DefaultSelector()
+            self.poller = None
+        else:
+            self.selector = None
+            self.pollerIsEpoll = hasattr(select, "epoll")
+            if self.pollerIsEpoll:
+                self.poller = select.epoll()
+                self.pollerEvents = select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP
+            else:
+                self.poller = select.poll()
+                self.pollerEvents = select.POLLIN | select.POLLERR | select.POLLHUP
+
+    def register(self, task, data=None, fd=None):
         """
-        :param func: a function which gets a single parameter,
-          which will be a reference to our instance in the fork,
-          so that it can use our communication methods put/get.
-        :type str name: name for the sub process
-        :param bool mustExec: if True, we do fork+exec, not just fork
-        :param dict[str,str] env_update: for mustExec, also update these env vars
+        :param AsyncTask task:
+        :param data: will be returned by select() together with the task
+        :param int|None fd: by default task.fileno(). E.g. you can also wait for a process sentinel.
         """
-        self.name = name or "unnamed"
-        self.func = func
-        self.mustExec = mustExec
-        self.env_update = env_update
-        self.parent_pid = os.getpid()
-        proc_args = {
-            "target": funcCall,
-            "args": ((AsyncTask, "_asyncCall"), (self,)),
-            "name": self.name + " worker process"
-        }
-        if mustExec and sys.platform != "win32":
-            self.Process = ExecingProcess
-            self.Pipe = ExecingProcess_Pipe
-            proc_args["env_update"] = env_update
+        if fd is None:
+            fd = task.fileno()
+        assert fd not in self.tasks, "%r already registered" % task
+        self.tasks[fd] = (task, data)
+        self.fds[task] = fd
+        if self.selector:
+            import selectors
+            self.selector.register(fd, selectors.EVENT_READ)
         else:
-            from multiprocessing import Process, Pipe
-            self.Process = Process
-            self.Pipe = Pipe_ConnectionWrapper
-        self.parent_conn, self.child_conn = self.Pipe()
-        self.proc = self.Process(**proc_args)
-        self.proc.daemon = True
-        if sys.platform == 'win32':
-            self.proc._Popen = Win32_mp_Popen_wrapper(env_update=env_update)
-        self.proc.start()
-        self.child_conn.close()
-        self.child_pid = self.proc.pid
-        assert self.child_pid
-        self.conn = self.parent_conn
+            self.poller.register(fd, self.pollerEvents)
 
-    @staticmethod
-    def _asyncCall(self):
-        assert self.isChild
-        self.parent_conn.close()
-        self.conn = self.child_conn # we are the child
-        if not self.mustExec and sys.platform != "win32":
-            global isFork
-            isFork = True
-        global isMainProcess
-        isMainProcess = False
-        try:
-            self.func(self)
-        except KeyboardInterrupt:
-            print("Exception in AsyncTask %s: KeyboardInterrupt" % self.name)
-            sys.exit(1)
-        except SystemExit:
-            raise
-        except BaseException:
-            print("Exception in AsyncTask %s" % self.name)
-            sys.excepthook(*sys.exc_info())
-            sys.exit(1)
-        finally:
-            self.conn.close()
+    def unregister(self, task):
+        fd = self.fds.pop(task)
+        del self.tasks[fd]
+        if self.selector:
+            self.selector.unregister(fd)
+        else:
+            try:
+                self.poller.unregister(fd)
+            except (IOError, OSError):
+                pass  # the fd was closed in the meantime, thus it is gone anyway
 
-    def put(self, value):
-        self.conn.send(value)
+    def select(self, timeout=None):
+        """
+        :param float|None timeout: in seconds. None means wait forever.
+        :return: list of (task, data) which are ready
+        :rtype: list[(AsyncTask,object)]
+        """
+        if not self.tasks:
+            if timeout:
+                time.sleep(timeout)
+            return []
+        while True:
+            try:
+                if self.selector:
+                    fds = [key.fd for key, _ in self.selector.select(timeout)]
+                elif self.pollerIsEpoll:
+                    fds = [fd for fd, _ in self.poller.poll(-1 if timeout is None else timeout)]
+                else:
+                    fds = [fd for fd, _ in self.poller.poll(None if timeout is None else timeout * 1000)]
+                break
+            except (IOError, OSError) as e:
+                if e.errno == errno.EINTR:
+                    continue  # Python 2 does not retry by itself.
+                raise
+        return [self.tasks[fd] for fd in fds]
 
-    def get(self):
-        thread = currentThread()
-        try:
-            thread.waitQueue = self
-            res = self.conn.recv()
-        except EOFError: # this happens when the child died
-            raise ForwardedKeyboardInterrupt()
-        except Exception:
-            raise
-        finally:
-            thread.waitQueue = None
-        return res
+    def close(self):
+        if self.selector:
+            self.selector.close()
+        elif self.pollerIsEpoll:
+            self.poller.close()
+        self.tasks.clear()
+        self.fds.clear()
 
-    @property
-    def isParent(self):
-        return self.parent_pid == os.getpid()
 
-    @property
-    def isChild(self):
-        if self.isParent: return False
-        # Note: self.parent_pid != os.getppid() if the parent died.
-        return True
+FIRST_COMPLETED = "FIRST_COMPLETED"
+ALL_COMPLETED = "ALL_COMPLETED"
 
-    # This might be called from the module code.
-    # See OnRequestQueue which implements the same interface.
-    def setCancel(self):
-        self.conn.close()
-        if self.isParent and self.child_pid:
-            import signal
-            try:
-                os.kill(self.child_pid, signal.SIGINT)
-            except OSError:
-                # Could be that the process already died or so. Just ignore and assume it is dead.
-                pass
-            self.child_pid = None
 
-    terminate = setCancel  # alias
+def waitAsyncTasks(tasks, timeout=None, return_when=FIRST_COMPLETED, selector=None):
+    """
+    Like concurrent.futures.wait(), for AsyncTask.
+    A task is done when it has a message for us (or died), i.e. when task.get() would not block.
 
-    def join(self, timeout=None):
-        return self.proc.join(timeout=timeout)
+    Without `selector`, this is meant for ad-hoc waits on a few tasks.
+    When you wait on the same (many) tasks repeatedly, e.g. in a loop which handles one message at a time,
+    pass a persistent AsyncTaskSelector, which is then only used for this. See _waitSelectable.
 
-    def is_alive(self):
-        return self.proc.is_alive()
+    :param list[AsyncTask] tasks:
+    :param float|None timeout: in seconds
+    :param str return_when: FIRST_COMPLETED or ALL_COMPLETED
+    :param AsyncTaskSelector|None selector: reused across calls. Close it when you are done
+    :return: (ready, notReady)
+    :rtype: (set[AsyncTask], set[AsyncTask])
+    """
+    return _waitSelectable(
+        tasks, getFd=lambda task: task.fileno(), timeout=timeout, return_when=return_when, selector=selector)
+
+
+def waitProcesses(procs, timeout=None, return_when=FIRST_COMPLETED, selector=None):
+    """
+    Like waitAsyncTasks(), but waits until the processes have exited, via their sentinel.
+    Use join() afterwards to get the exit status.
+
+    :param list[ExecingProcess] procs: or anything else with a `sentinel`,
+      e.g. multiprocessing.Process in Python 3
+    :param float|None timeout: in seconds
+    :param str return_when: FIRST_COMPLETED or ALL_COMPLETED
+    :param AsyncTaskSelector|None selector: like for waitAsyncTasks
+    :return: (exited, notExited)
+    :rtype: (set[ExecingProcess], set[ExecingProcess])
+    """
+    return _waitSelectable(
+        procs, getFd=lambda proc: proc.sentinel, timeout=timeout, return_when=return_when, selector=selector,
+        unregisterReady=True)  # the sentinel gets closed by join()
+
+
+_SelectMaxFds = 16  # up to this, a one-shot wait uses _selectReadable(), which needs no setup
+
+
+def _waitSelectable(objs, getFd, timeout, return_when, selector=None, unregisterReady=False):
+    """
+    Common implementation of waitAsyncTasks() and waitProcesses().
+    Objects where getFd returns None are considered as ready.
+
+    With a persistent `selector`, its registrations are synced with objs,
+    i.e. in the steady state (same objs as in the last call), there is no setup cost,
+    and a wait costs O(ready), not O(len(objs)) syscall work.
+    Without one, we use select() for a few fds, otherwise a temporary AsyncTaskSelector.
+
+    :param bool unregisterReady: remove ready objs from a persistent selector
+    """
+    assert return_when in (FIRST_COMPLETED, ALL_COMPLETED)
+    fds = dict([(obj, getFd(obj)) for obj in set(objs)])  # first, as this can raise, e.g. for shmring tasks
+    ready = set([obj for obj, fd in fds.items() if fd is None])
+    notReady = set(objs) - ready
+    if not notReady or (ready and return_when == FIRST_COMPLETED):
+        return ready, notReady
+    persistent = selector is not None
+    if persistent:
+        for obj, fd in list(selector.fds.items()):
+            if fds.get(obj) != fd:
+                selector.unregister(obj)
+        for obj in notReady:
+            if obj not in selector.fds:
+                selector.register(obj, fd=fds[obj])
+    elif len(notReady) > _SelectMaxFds or max([fds[obj] for obj in notReady]) >= 1024:  # FD_SETSIZE
+        selector = AsyncTaskSelector()
+        for obj in notReady:
+            selector.register(obj, fd=fds[obj])
+
+    def selectReady(timeout):
+        if selector is None:
+            fdToObj = dict([(fds[obj], obj) for obj in notReady])
+            return [fdToObj[fd] for fd in _selectReadable(list(fdToObj), timeout)]
+        return [obj for obj, _ in selector.select(timeout)]
+
+    try:
+        deadline = (time.time() + timeout) if timeout is not None else None
+        while notReady:
+            remaining = None if deadline is None else max(deadline - time.time(), 0)
+            for obj in selectReady(remaining):
+                if selector is not None and (not persistent or unregisterReady or return_when == ALL_COMPLETED):
+                    selector.unregister(obj)  # otherwise it would be reported again (a persistent one: next call)
+                notReady.remove(obj)
+                ready.add(obj)
+            if ready and return_when == FIRST_COMPLETED:
+                break
+            if deadline is not None and time.time() >= deadline:
+                break
+    finally:
+        if selector is not None and not persistent:
+            selector.close()
+    return ready, notReady
 
 
 def WarnMustNotBeInForkDecorator(func):
@@ -590,40 +5072,489 @@ def WarnMustNotBeInForkDecorator(func):
     return decoratedFunc
 
 
+def _getThreadIdent():
+    if PY3:
+        import threading
+        return threading.get_ident()
+    else:
+        import thread
+        return thread.get_ident()
+
+
 class ReadWriteLock(object):
     """Classic implementation of ReadWriteLock.
     Note that this partly supports recursive lock usage:
-    - Inside a readlock, a writelock will always block!
     - Inside a readlock, another readlock is fine.
     - Inside a writelock, any other writelock or readlock is fine.
+    - Inside a readlock, a writelock upgrades the lock, i.e. it waits until all other readers are gone.
+      Only one thread can upgrade at a time, otherwise they would deadlock each other.
+      Thus it raises RuntimeError if another thread holds the upgradablereadlock.
+      Use upgradablereadlock to reserve this in advance.
+
+    The policy decides who goes first when readers and writers are waiting:
+    - ReaderPreferring: new readers can always enter while there is no writer.
+      Under a steady read load, writers can starve.
+    - WriterPreferring: new readers wait while a writer waits.
+    - Fair: new readers wait only for writers which came before them.
+
+    acquireRead/acquireWrite/acquireUpgradable have an optional timeout.
+    Contention counters (wait time, hold time, queue depth) are returned by stats().
     """
-    def __init__(self):
+
+    ReaderPreferring = "reader"
+    WriterPreferring = "writer"
+    Fair = "fair"
+
+    def __init__(self, policy=ReaderPreferring):
         import threading
-        self.lock = threading.RLock()
-        self.writeReadyCond = threading.Condition(self.lock)
-        self.readerCount = 0
+        assert policy in (self.ReaderPreferring, self.WriterPreferring, self.Fair)
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.readers = {}  # thread ident -> recursion count
+        self.writer = None  # thread ident
+        self.writerCount = 0
+        self.writerReservedUpgrade = False
+        self.upgrader = None  # thread ident which holds the upgradablereadlock or upgrades
+        self.upgraderCount = 0
+        self.upgrading = False
+        self.nextTicket = 0
+        self.waitingWriterTickets = []
+        self.numWaitingReaders = 0
+        self.holdStartTimes = {}  # (thread ident, kind) -> time
+        self._stats = None
+        self.resetStats()
+
+    @property
+    def readerCount(self):
+        return len(self.readers)
+
+    def resetStats(self):
+        with self.lock:
+            self._stats = {}
+            for kind in ("read", "write"):
+                self._stats.update({
+                    kind + "Acquires": 0, kind + "Timeouts": 0,
+                    kind + "WaitTime": 0.0, kind + "MaxWaitTime": 0.0,
+                    kind + "HoldTime": 0.0, kind + "MaxHoldTime": 0.0,
+                    kind + "MaxQueueDepth": 0})
+
+    def stats(self):
+        """
+        :return: counters since creation or resetStats(). Times are in seconds.
+          The current state is in readers, writer, waitingReaders and waitingWriters.
+        :rtype: dict[str]
+        """
+        with self.lock:
+            d = dict(self._stats)
+            d["readers"] = len(self.readers)
+            d["writer"] = self.writer is not None
+            d["waitingReaders"] = self.numWaitingReaders
+            d["waitingWriters"] = len(self.waitingWriterTickets) + int(self.upgrading)
+            return d
+
+    def _takeTicket(self):
+        self.nextTicket += 1
+        return self.nextTicket
+
+    def _wait(self, deadline):
+        """
+        :return: False if the deadline is over
+        """
+        if deadline is None:
+            self.cond.wait()
+            return True
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        self.cond.wait(remaining)
+        return True
+
+    def _canRead(self, ticket):
+        if self.writer is not None:
+            return False
+        if self.policy == self.WriterPreferring:
+            return not self.waitingWriterTickets and not self.upgrading
+        if self.policy == self.Fair:
+            if self.upgrading:
+                return False
+            return not (self.waitingWriterTickets and self.waitingWriterTickets[0] < ticket)
+        return True
+
+    def _recordAcquire(self, kind, me, startTime):
+        now = time.time()
+        waitTime = now - startTime
+        self._stats[kind + "Acquires"] += 1
+        self._stats[kind + "WaitTime"] += waitTime
+        self._stats[kind + "MaxWaitTime"] = max(self._stats[kind + "MaxWaitTime"], waitTime)
+        self.holdStartTimes[(me, kind)] = now
+
+    def _recordRelease(self, kind, me):
+        holdTime = time.time() - self.holdStartTimes.pop((me, kind))
+        self._stats[kind + "HoldTime"] += holdTime
+        self._stats[kind + "MaxHoldTime"] = max(self._stats[kind + "MaxHoldTime"], holdTime)
+
+    def _waitForRead(self, me, timeout, upgradable):
+        """
+        Called with self.lock held, when we do not hold the lock yet.
+        :return: False on timeout
+        """
+        startTime = time.time()
+        deadline = (startTime + timeout) if timeout is not None else None
+        ticket = self._takeTicket()
+        self.numWaitingReaders += 1
+        self._stats["readMaxQueueDepth"] = max(self._stats["readMaxQueueDepth"], self.numWaitingReaders)
+        try:
+            while not self._canRead(ticket) or (upgradable and self.upgrader is not None):
+                if not self._wait(deadline):
+                    self._stats["readTimeouts"] += 1
+                    return False
+        finally:
+            self.numWaitingReaders -= 1
+        self.readers[me] = 1
+        self._recordAcquire("read", me, startTime)
+        return True
+
+    def acquireRead(self, timeout=None):
+        """
+        :param float|None timeout: in seconds. None means to wait forever.
+        :return: whether we got the lock. Only False on timeout.
+        :rtype: bool
+        """
+        me = _getThreadIdent()
+        with self.lock:
+            if me in self.readers or self.writer == me:
+                self.readers[me] = self.readers.get(me, 0) + 1
+                return True
+            return self._waitForRead(me, timeout=timeout, upgradable=False)
+
+    def releaseRead(self):
+        me = _getThreadIdent()
+        with self.lock:
+            if me not in self.readers:
+                raise RuntimeError("ReadWriteLock: releaseRead without readlock")
+            self.readers[me] -= 1
+            if self.readers[me] > 0:
+                return
+            del self.readers[me]
+            if (me, "read") in self.holdStartTimes:
+                self._recordRelease("read", me)
+            self.cond.notifyAll()
+
+    def acquireUpgradable(self, timeout=None):
+        """
+        Like acquireRead, but in addition, only one thread at a time can hold it,
+        and a writelock inside of it is guaranteed to be able to upgrade.
+        """
+        me = _getThreadIdent()
+        with self.lock:
+            if self.upgrader == me:
+                self.upgraderCount += 1
+                self.readers[me] += 1
+                return True
+            if me in self.readers or self.writer == me:
+                if self.upgrader is not None:
+                    raise RuntimeError("ReadWriteLock: another thread holds the upgradablereadlock, would deadlock")
+                self.upgrader = me
+                self.upgraderCount = 1
+                self.readers[me] = self.readers.get(me, 0) + 1
+                return True
+            if not self._waitForRead(me, timeout=timeout, upgradable=True):
+                return False
+            self.upgrader = me
+            self.upgraderCount = 1
+            return True
+
+    def releaseUpgradable(self):
+        me = _getThreadIdent()
+        with self.lock:
+            if self.upgrader != me:
+                raise RuntimeError("ReadWriteLock: releaseUpgradable without upgradablereadlock")
+            self.upgraderCount -= 1
+            if self.upgraderCount == 0:
+                self.upgrader = None
+                self.cond.notifyAll()
+        self.releaseRead()
+
+    def acquireWrite(self, timeout=None):
+        """
+        :param float|None timeout: in seconds. None means to wait forever.
+        :return: whether we got the lock. Only False on timeout.
+        :rtype: bool
+        """
+        me = _getThreadIdent()
+        with self.lock:
+            if self.writer == me:
+                self.writerCount += 1
+                return True
+            startTime = time.time()
+            deadline = (startTime + timeout) if timeout is not None else None
+            isUpgrade = me in self.readers
+            reservedUpgrade = False
+            ticket = None
+            if isUpgrade:
+                if self.upgrader not in (None, me):
+                    raise RuntimeError("ReadWriteLock: another thread holds the upgradablereadlock, would deadlock")
+                if self.upgrader is None:
+                    self.upgrader = me
+                    reservedUpgrade = True
+                self.upgrading = True
+            else:
+                ticket = self._takeTicket()
+                self.waitingWriterTickets.append(ticket)
+            queueDepth = len(self.waitingWriterTickets) + int(self.upgrading)
+            self._stats["writeMaxQueueDepth"] = max(self._stats["writeMaxQueueDepth"], queueDepth)
+            try:
+                while True:
+                    if self.writer is None:
+                        if isUpgrade:
+                            if len(self.readers) == 1:
+                                break
+                        elif not self.readers and not self.upgrading and self.waitingWriterTickets[0] == ticket:
+                            break
+                    if not self._wait(deadline):
+                        self._stats["writeTimeouts"] += 1
+                        if reservedUpgrade:
+                            self.upgrader = None
+                        return False
+            finally:
+                if isUpgrade:
+                    self.upgrading = False
+                else:
+                    self.waitingWriterTickets.remove(ticket)
+                self.cond.notifyAll()  # readers might wait for waiting writers
+            self.writer = me
+            self.writerCount = 1
+            self.writerReservedUpgrade = reservedUpgrade
+            self._recordAcquire("write", me, startTime)
+            return True
+
+    def releaseWrite(self):
+        me = _getThreadIdent()
+        with self.lock:
+            if self.writer != me:
+                raise RuntimeError("ReadWriteLock: releaseWrite without writelock")
+            self.writerCount -= 1
+            if self.writerCount > 0:
+                return
+            self.writer = None
+            if self.writerReservedUpgrade:
+                self.upgrader = None
+                self.writerReservedUpgrade = False
+            self._recordRelease("write", me)
+            self.cond.notifyAll()
+
     @property
     @contextmanager
     def readlock(self):
-        with self.lock:
-            self.readerCount += 1
+        self.acquireRead()
         try: yield
         finally:
-            with self.lock:
-                self.readerCount -= 1
-                if self.readerCount == 0:
-                    self.writeReadyCond.notifyAll()
+            self.releaseRead()
+
+    @property
+    @contextmanager
+    def upgradablereadlock(self):
+        self.acquireUpgradable()
+        try: yield
+        finally:
+            self.releaseUpgradable()
+
     @property
     @contextmanager
     def writelock(self):
-        with self.lock:
-            while self.readerCount > 0:
-                self.writeReadyCond.wait()
-            yield
+        self.acquireWrite()
+        try: yield
+        finally:
+            self.releaseWrite()
+
+
+class ProcessReadWriteLock(object):
+    """
+    Reader/writer lock which works across processes, e.g. between the parent
+    and its AsyncTask/ExecingProcess children, and also across threads.
+    It has the same readlock/writelock API as ReadWriteLock.
+
+    It is backed by flock() on a file in shared memory (/dev/shm, if available).
+    The kernel releases the lock when the holder process dies,
+    thus a crashed child cannot block the others.
+    Within a process, a ReadWriteLock coordinates the threads.
+
+    It is inherited by fork and it can be pickled (e.g. for ExecingProcess),
+    because each process opens the file by itself
+    (flock locks belong to the open file description).
+    The process which created the file deletes it in close().
+
+    Note that across processes, a writelock inside a readlock (upgrade) is not atomic:
+    another process might get the writelock in between.
+    """
+
+    def __init__(self, path=None, policy=ReadWriteLock.ReaderPreferring):
+        """
+        :param str|None path: file to use. If None, we create a temporary file.
+        :param str policy: for the ReadWriteLock between the threads of one process
+        """
+        if path is None:
+            import tempfile
+            shmDir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+            fd, path = tempfile.mkstemp(prefix="TaskSystem-rwlock-", dir=shmDir)
+            os.close(fd)
+            self.ownerPid = os.getpid()
+        else:
+            self.ownerPid = None
+        self.path = path
+        self.policy = policy
+        self._initProcState()
+
+    def _initProcState(self):
+        self.pid = os.getpid()
+        self.fd = None  # opened on first use
+        self.threadLock = ReadWriteLock(policy=self.policy)
+        self.procLock = Lock()  # protects the following
+        self.procReaders = 0
+        self.procWriterCount = 0
+        self.procMode = None  # None, "read" or "write", i.e. what we hold via flock
+
+    def _checkPid(self):
+        if self.pid != os.getpid():
+            # We are in a fork. The inherited fd shares the flock with the parent, so start from scratch.
+            if self.fd is not None:
+                os.close(self.fd)
+            self._initProcState()
+
+    def __getstate__(self):
+        return {"path": self.path, "policy": self.policy}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self.policy = state["policy"]
+        self.ownerPid = None
+        self._initProcState()
+
+    def _flock(self, mode, deadline):
+        """
+        :param str|None mode: "read", "write" or None (unlock)
+        :param float|None deadline:
+        :return: False on timeout
+        """
+        import fcntl
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDWR)
+        op = {"read": fcntl.LOCK_SH, "write": fcntl.LOCK_EX, None: fcntl.LOCK_UN}[mode]
+        delay = 0.0005
+        while True:
+            try:
+                if deadline is None or mode is None:
+                    fcntl.flock(self.fd, op)
+                else:
+                    fcntl.flock(self.fd, op | fcntl.LOCK_NB)
+                return True
+            except (IOError, OSError) as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EACCES):
+                    raise
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.05)
+
+    def acquireRead(self, timeout=None):
+        """
+        :param float|None timeout: in seconds. None means to wait forever.
+        :return: whether we got the lock. Only False on timeout.
+        :rtype: bool
+        """
+        self._checkPid()
+        deadline = (time.time() + timeout) if timeout is not None else None
+        if not self.threadLock.acquireRead(timeout=timeout):
+            return False
+        with self.procLock:
+            if self.procMode is None:
+                if not self._flock("read", deadline=deadline):
+                    self.threadLock.releaseRead()
+                    return False
+                self.procMode = "read"
+            self.procReaders += 1
+        return True
+
+    def releaseRead(self):
+        with self.procLock:
+            self.procReaders -= 1
+            if self.procReaders == 0 and self.procMode == "read":
+                self._flock(None, deadline=None)
+                self.procMode = None
+        self.threadLock.releaseRead()
+
+    def acquireWrite(self, timeout=None):
+        """
+        :param float|None timeout: in seconds. None means to wait forever.
+        :return: whether we got the lock. Only False on timeout.
+        :rtype: bool
+        """
+        self._checkPid()
+        deadline = (time.time() + timeout) if timeout is not None else None
+        if not self.threadLock.acquireWrite(timeout=timeout):
+            return False
+        with self.procLock:
+            if self.procMode == "write":
+                self.procWriterCount += 1
+                return True
+            oldMode = self.procMode  # "read" if we upgrade
+            if not self._flock("write", deadline=deadline):
+                if oldMode == "read":
+                    # The conversion is not atomic, thus we might have lost the shared lock.
+                    self._flock("read", deadline=None)
+                self.threadLock.releaseWrite()
+                return False
+            self.procMode = "write"
+            self.procWriterCount = 1
+        return True
+
+    def releaseWrite(self):
+        with self.procLock:
+            self.procWriterCount -= 1
+            if self.procWriterCount == 0:
+                if self.procReaders > 0:  # we upgraded, or there are reads inside of the writelock
+                    self._flock("read", deadline=None)
+                    self.procMode = "read"
+                else:
+                    self._flock(None, deadline=None)
+                    self.procMode = None
+        self.threadLock.releaseWrite()
+
+    @property
+    @contextmanager
+    def readlock(self):
+        self.acquireRead()
+        try: yield
+        finally:
+            self.releaseRead()
+
+    @property
+    @contextmanager
+    def writelock(self):
+        self.acquireWrite()
+        try: yield
+        finally:
+            self.releaseWrite()
+
+    def close(self):
+        if self.pid == os.getpid() and self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if self.ownerPid == os.getpid():
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+            self.ownerPid = None
 
 
 if __name__ == "__main__":
     try:
+        ExecingForkServer.checkServer()  # Never returns if this proc is the fork server.
         ExecingProcess.checkExec()  # Never returns if this proc is called via ExecingProcess.
     except KeyboardInterrupt:
         sys.exit(1)
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks for TaskSystem.
+
+Run e.g.:
+
+  python tests/benchmark_TaskSystem.py --output bench.json
+
+and compare the JSON output between versions.
+All numbers are in seconds, MB/s or operations per second, as indicated by the key.
+"""
+
+from __future__ import print_function
+
+import sys
+import os
+import time
+import json
+import threading
+import platform
+import argparse
+import multiprocessing
+
+_my_dir = os.path.dirname(os.path.abspath(__file__))
+_base_dir = os.path.dirname(_my_dir)
+sys.path.insert(0, _base_dir)
+# The fork+exec'd children must be able to import this module, to unpickle our functions.
+os.environ["PYTHONPATH"] = os.pathsep.join([_my_dir, _base_dir] + [os.environ.get("PYTHONPATH", "")]).rstrip(os.pathsep)
+
+import TaskSystem
+from TaskSystem import AsyncTask, TaskPool, ExecingForkServer, ExecingProcess_ConnectionWrapper, ReadWriteLock
+from TaskSystem import ExecingBootstrap
+
+
+def _summary(times):
+    """
+    :param list[float] times:
+    :rtype: dict[str,float]
+    """
+    times = sorted(times)
+    return {
+        "min": times[0],
+        "median": times[len(times) // 2],
+        "mean": sum(times) / len(times),
+        "max": times[-1],
+        "n": len(times)}
+
+
+def _echoFunc(task):
+    while True:
+        x = task.get()
+        if x is None:
+            break
+        task.put(x)
+
+
+def _sinkFunc(task):
+    n = 0
+    while True:
+        x = task.get()
+        if x is None:
+            break
+        n += 1
+    task.put(n)
+
+
+def _noop():
+    return None
+
+
+def bench_spawn(repeat):
+    """
+    Time from AsyncTask creation until the first message from the child arrived.
+    """
+    def spawn(**kwargs):
+        task = AsyncTask(_echoFunc, name="bench_spawn", **kwargs)
+        task.put(1)
+        task.get()
+        task.put(None)
+        task.join()
+
+    res = {}
+    modes = [("fork", {}), ("exec", {"mustExec": True}),
+             ("exec_fast", {"mustExec": True, "bootstrap": ExecingBootstrap.Fast})]
+    forkServer = None
+    if sys.platform != "win32":
+        forkServer = ExecingForkServer(preload=["extpickle"])
+        forkServer.start()
+        modes.append(("forkServer", {"forkServer": forkServer}))
+    try:
+        for mode, kwargs in modes:
+            spawn(**kwargs)  # warmup
+            times = []
+            for i in range(repeat):
+                startTime = time.time()
+                spawn(**kwargs)
+                times.append(time.time() - startTime)
+            res["spawn_%s_sec" % mode] = _summary(times)
+    finally:
+        if forkServer:
+            forkServer.stop()
+    return res
+
+
+def bench_roundtrip(repeat):
+    """
+    put+get round trip for a small message.
+    """
+    res = {}
+    for mode, kwargs in [("fork", {}), ("exec", {"mustExec": True}),
+                         ("fork_shmring", {"transport": "shmring"}),
+                         ("exec_shmring", {"mustExec": True, "transport": "shmring"})]:
+        task = AsyncTask(_echoFunc, name="bench_roundtrip", **kwargs)
+        times = []
+        for i in range(repeat + 10):
+            startTime = time.time()
+            task.put(i)
+            task.get()
+            if i >= 10:  # warmup
+                times.append(time.time() - startTime)
+        task.put(None)
+        task.join()
+        res["roundtrip_%s_sec" % mode] = _summary(times)
+    return res
+
+
+def bench_messageRate(repeat):
+    """
+    Many small messages in one direction, without waiting for a reply in between.
+    """
+    res = {}
+    for mode, kwargs in [("exec", {"mustExec": True}), ("exec_shmring", {"mustExec": True, "transport": "shmring"})]:
+        task = AsyncTask(_sinkFunc, name="bench_messageRate", **kwargs)
+        task.put(0)  # warmup
+        startTime = time.time()
+        for i in range(repeat):
+            task.put(i)
+        task.put(None)
+        n = task.get()
+        duration = time.time() - startTime
+        assert n == repeat + 1
+        task.join()
+        res["messageRate_%s_per_sec" % mode] = repeat / duration
+    return res
+
+
+def bench_throughput(repeat, payloadSize):
+    """
+    Throughput for large payloads.
+    fork uses Pipe_ConnectionWrapper, exec uses ExecingProcess_Pipe.
+    """
+    res = {}
+    payload = b"x" * payloadSize
+    oldThreshold = ExecingProcess_ConnectionWrapper.SharedMemThreshold
+    try:
+        for shm in [False, True]:
+            ExecingProcess_ConnectionWrapper.SharedMemThreshold = (1024 * 1024) if shm else None
+            for mode, kwargs in [("fork", {}), ("exec", {"mustExec": True})]:
+                task = AsyncTask(_sinkFunc, name="bench_throughput", **kwargs)
+                task.put(payload)  # warmup
+                startTime = time.time()
+                for i in range(repeat):
+                    task.put(payload)
+                task.put(None)
+                n = task.get()
+                duration = time.time() - startTime
+                assert n == repeat + 1
+                task.join()
+                key = "throughput_%s%s_MBps" % (mode, "_shm" if shm else "")
+                res[key] = payloadSize * repeat / duration / 1024. / 1024.
+    finally:
+        ExecingProcess_ConnectionWrapper.SharedMemThreshold = oldThreshold
+    return res
+
+
+def bench_asyncCall(repeat):
+    """
+    End-to-end overhead of asyncCall (including spawn) and of TaskPool.asyncCall.
+    """
+    res = {}
+    for mode, kwargs in [("fork", {}), ("exec", {"mustExec": True})]:
+        times = []
+        for i in range(repeat):
+            startTime = time.time()
+            TaskSystem.asyncCall(_noop, name="bench_asyncCall", **kwargs)
+            times.append(time.time() - startTime)
+        res["asyncCall_%s_sec" % mode] = _summary(times)
+        with TaskPool(1, name="bench_asyncCall", **kwargs) as pool:
+            pool.asyncCall(_noop)  # warmup
+            times = []
+            for i in range(repeat):
+                startTime = time.time()
+                pool.asyncCall(_noop)
+                times.append(time.time() - startTime)
+        res["TaskPool_asyncCall_%s_sec" % mode] = _summary(times)
+    return res
+
+
+def bench_ReadWriteLock(duration, numReaders, numWriters):
+    """
+    Operations per second with concurrent readers and writers.
+    """
+    lock = ReadWriteLock()
+    counts = {"read": 0, "write": 0}
+    countsLock = threading.Lock()
+    stop = threading.Event()
+
+    def worker(kind):
+        n = 0
+        while not stop.is_set():
+            if kind == "read":
+                with lock.readlock:
+                    n += 1
+            else:
+                with lock.writelock:
+                    n += 1
+        with countsLock:
+            counts[kind] += n
+
+    threads = [threading.Thread(target=worker, args=("read",)) for i in range(numReaders)]
+    threads += [threading.Thread(target=worker, args=("write",)) for i in range(numWriters)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return {
+        "ReadWriteLock_read_opsps": counts["read"] / duration,
+        "ReadWriteLock_write_opsps": counts["write"] / duration}
+
+
+def main():
+    argParser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    argParser.add_argument("--repeat", type=int, default=20)
+    argParser.add_argument("--payload_size", type=int, default=8 * 1024 * 1024, help="bytes, for throughput")
+    argParser.add_argument("--lock_duration", type=float, default=1.0, help="seconds, for ReadWriteLock")
+    argParser.add_argument(
+        "--only", help="comma-separated list of: spawn,roundtrip,messageRate,throughput,asyncCall,lock")
+    argParser.add_argument("--output", help="JSON output file. By default, stdout")
+    args = argParser.parse_args()
+
+    benchmarks = [
+        ("spawn", lambda: bench_spawn(args.repeat)),
+        ("roundtrip", lambda: bench_roundtrip(args.repeat * 50)),
+        ("messageRate", lambda: bench_messageRate(args.repeat * 1000)),
+        ("throughput", lambda: bench_throughput(args.repeat, args.payload_size)),
+        ("asyncCall", lambda: bench_asyncCall(args.repeat)),
+        ("lock", lambda: bench_ReadWriteLock(args.lock_duration, numReaders=4, numWriters=1)),
+    ]
+    only = args.only.split(",") if args.only else None
+    results = {}
+    for name, func in benchmarks:
+        if only and name not in only:
+            continue
+        print("Benchmark %s ..." % name, file=sys.stderr)
+        results.update(func())
+
+    output = {
+        "meta": {
+            "python": sys.version,
+            "platform": platform.platform(),
+            "cpu_count": multiprocessing.cpu_count(),
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "args": vars(args)},
+        "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    else:
+        json.dump(output, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == "__main__":
+    main()
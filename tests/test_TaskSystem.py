@@ -1,10 +1,19 @@
 
-from nose.tools import assert_equal, assert_is, assert_is_not
+try:
+    from nose.tools import assert_equal, assert_is, assert_is_not
+except ImportError:  # e.g. Python >=3.10, where nose does not work. Then run via pytest.
+    import unittest
+    _testCase = unittest.TestCase("__init__")
+    assert_equal, assert_is, assert_is_not = _testCase.assertEqual, _testCase.assertIs, _testCase.assertIsNot
 import TaskSystem
 from TaskSystem import *
 
-import better_exchook
-better_exchook.replace_traceback_format_tb()
+try:
+    import better_exchook
+except ImportError:
+    better_exchook = None
+else:
+    better_exchook.replace_traceback_format_tb()
 
 
 def test_AsyncTask():
@@ -49,3 +58,1117 @@ def test_AsyncTask_mustExec():
     assert_equal(x, 1)
     task.put(2)
     task.join()
+
+
+def test_TaskPool():
+    def func():
+        return os.getpid()
+    def raiseFunc():
+        raise ValueError("test")
+    def mainProcFunc():
+        return execInMainProc(lambda: os.getpid())
+    with TaskPool(2, name="test_TaskPool") as pool:
+        workerPids = set(w.child_pid for w in pool.workers)
+        for i in range(5):
+            assert pool.asyncCall(func) in workerPids
+        try:
+            pool.asyncCall(raiseFunc)
+            raise Exception("Did not get an exception.")
+        except ValueError:
+            pass
+        assert_equal(pool.asyncCall(mainProcFunc), os.getpid())
+        assert_equal(set(w.child_pid for w in pool.workers), workerPids)
+
+
+def test_TaskPool_mustExec():
+    def func():
+        assert not TaskSystem.isFork
+        return os.getpid()
+    with TaskPool(1, mustExec=True, name="test_TaskPool_mustExec") as pool:
+        pid = pool.asyncCall(func)
+        assert_equal(pool.asyncCall(func), pid)
+
+
+def test_AsyncTask_forkServer():
+    def func(task):
+        assert not TaskSystem.isFork
+        assert_equal(os.environ.get("TASKSYSTEM_TEST"), "1")
+        task.put(os.getpid())
+        x = task.get()
+        assert x == 2
+    with ExecingForkServer(preload=["extpickle"]) as forkServer:
+        for i in range(2):
+            task = AsyncTask(func, forkServer=forkServer, env_update={"TASKSYSTEM_TEST": "1"},
+                             name="test_AsyncTask_forkServer")
+            x = task.get()
+            assert_equal(x, task.child_pid)
+            task.put(2)
+            task.join()
+            assert not task.is_alive()
+            assert_equal(task.proc.exit_status, 0)
+
+
+def test_AsyncTask_forkServer_manyFds():
+    # The status fd is >= 1024, i.e. the non-blocking status read must not use select().
+    def func(task):
+        task.put(task.get())
+    fds = _openManyFds()
+    try:
+        with ExecingForkServer() as forkServer:
+            task = AsyncTask(func, forkServer=forkServer, name="test_AsyncTask_forkServer_manyFds")
+            assert task.proc.status_fd >= 1024
+            assert task.is_alive()
+            task.put(42)
+            assert_equal(task.get(), 42)
+            waitProcesses([task.proc], timeout=5)
+            assert not task.is_alive()  # reads the exit status without blocking
+            assert_equal(task.proc.exit_status, 0)
+    finally:
+        _closeFds(fds)
+
+
+def test_ExecingProcess_Pipe_SharedMem():
+    import array
+    c1, c2 = ExecingProcess_Pipe()
+    assert c1._checkCanPassFds()
+    assert ExecingProcess_ConnectionWrapper.SharedMemThreshold is None  # opt-in
+    c1.SharedMemThreshold = 1024 * 1024
+    big = b"x" * (c1.SharedMemThreshold + 10)
+    arr = array.array("i", range(c1.SharedMemThreshold // 2))
+    c1.send((1, big, bytearray(big), arr, big))
+    x, big2, bigArray, arr2, big3 = c2.recv()
+    assert_equal(x, 1)
+    assert_equal(big2, big)
+    assert_equal(type(bigArray), bytearray)
+    assert_equal(bigArray, bytearray(big))
+    assert_equal(arr2, arr)
+    assert_is(big3, big2)
+    assert c1.stats()["bytesSent"] < len(big)
+    c1.close()
+    c2.close()
+
+
+def test_ExecingProcess_Pipe_SharedMemViews():
+    import array
+    if not PY3:
+        from unittest import SkipTest
+        raise SkipTest("Python 2 buffers cannot be memoryviews of a mapping")
+    c1, c2 = ExecingProcess_Pipe()
+    c1.SharedMemThreshold = 1024 * 1024
+    c2.SharedMemViews = True
+    big = b"x" * (c1.SharedMemThreshold + 10)
+    arr = array.array("i", range(c1.SharedMemThreshold // 2))
+    c1.send((big, bytearray(big), arr))
+    big2, bigArray, arr2 = c2.recv()
+    assert_equal(type(big2), memoryview)
+    assert big2.readonly
+    assert_equal(big2, big)
+    assert_equal(type(bigArray), memoryview)
+    assert not bigArray.readonly
+    bigArray[0] = ord("y")
+    assert_equal(bigArray[:2].tobytes(), b"yx")
+    assert_equal(type(arr2), memoryview)
+    assert_equal(arr2.format, "i")
+    assert_equal(arr2.tolist(), arr.tolist())
+    c1.close()
+    c2.close()
+
+
+def test_ExecingProcess_Pipe_SharedMem_threads():
+    # Each message is followed by its fds. Messages from multiple threads must not interleave.
+    import threading
+    c1, c2 = ExecingProcess_Pipe()
+    c1.SharedMemThreshold = 1000
+    numThreads, numMsgs = 4, 50
+    def sender(i):
+        for j in range(numMsgs):
+            c1.send((i, j, str(i).encode("ascii") * 1000, b"y" * (1000 + j)))
+    threads = [threading.Thread(target=sender, args=(i,)) for i in range(numThreads)]
+    if hasattr(sys, "setswitchinterval"):
+        oldInterval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)  # make thread switches within send() likely
+    try:
+        for thread in threads:
+            thread.start()
+        nextMsg = [0] * numThreads
+        for _ in range(numThreads * numMsgs):
+            i, j, data1, data2 = c2.recv()
+            assert_equal(j, nextMsg[i])
+            nextMsg[i] += 1
+            assert_equal(data1, str(i).encode("ascii") * 1000)
+            assert_equal(data2, b"y" * (1000 + j))
+        for thread in threads:
+            thread.join()
+    finally:
+        if hasattr(sys, "setswitchinterval"):
+            sys.setswitchinterval(oldInterval)
+    c1.close()
+    c2.close()
+
+
+def test_AsyncTask_mustExec_SharedMem():
+    def func(task):
+        task.conn.SharedMemThreshold = 1024 * 1024
+        x = task.get()
+        task.put(x + x)
+    task = AsyncTask(func, mustExec=True, name="test_AsyncTask_mustExec_SharedMem")
+    task.conn.SharedMemThreshold = 1024 * 1024
+    big = b"abc" * task.conn.SharedMemThreshold
+    task.put(big)
+    assert_equal(task.get(), big + big)
+    assert task.conn.stats()["bytesReceived"] < len(big)
+    task.join()
+
+
+def test_ExecingProcess_Pipe_OutOfBand():
+    import array
+    from unittest import SkipTest
+    c1, c2 = ExecingProcess_Pipe()
+    c1.OutOfBandThreshold = 1024
+    if not c1._checkOutOfBand():
+        raise SkipTest("pickle protocol 5 / sendmsg not available")
+    c1.SharedMemThreshold = None
+    big = b"x" * 10000
+    arr = array.array("i", range(10000))
+    c1.send((1, big, bytearray(big), arr, b"small"))
+    x, big2, bigArray, arr2, small = c2.recv()
+    assert_equal(x, 1)
+    assert_equal(big2, big)
+    assert_equal(type(bigArray), bytearray)
+    assert_equal(bigArray, bytearray(big))
+    assert_equal(arr2, arr)
+    assert_equal(small, b"small")
+    c1.send(2)
+    assert_equal(c2.recv(), 2)
+    c1.close()
+    c2.close()
+
+
+def test_AsyncTask_asyncio():
+    try:
+        import asyncio
+    except ImportError:
+        from unittest import SkipTest
+        raise SkipTest("asyncio not available")
+    def func(task):
+        x = task.get()
+        task.put(x + 1)
+    def callFunc(x):
+        return x + execInMainProc(lambda: 1)
+    loop = asyncio.new_event_loop()
+    try:
+        task = AsyncTask(func, name="test_AsyncTask_asyncio")
+        loop.run_until_complete(task.aput(1, loop=loop))
+        assert_equal(loop.run_until_complete(task.aget(loop=loop)), 2)
+        task.join()
+        futures = [asyncioCall(lambda i=i: callFunc(i), loop=loop) for i in range(5)]
+        assert_equal(loop.run_until_complete(asyncio.gather(*futures)), [1, 2, 3, 4, 5])
+        pid = loop.run_until_complete(asyncioCall(os.getpid, loop=loop))
+        if os.path.exists("/proc/self"):
+            # The child gets joined, i.e. it does not stay as a zombie.
+            for _ in range(100):
+                if not os.path.exists("/proc/%i" % pid):
+                    break
+                loop.run_until_complete(asyncio.sleep(0.05))
+            assert not os.path.exists("/proc/%i" % pid)
+        envFuture = asyncioCall(
+            lambda: os.environ.get("TASKSYSTEM_TEST"), mustExec=True, env_update={"TASKSYSTEM_TEST": "1"}, loop=loop)
+        assert_equal(loop.run_until_complete(envFuture), "1")
+    finally:
+        loop.close()
+
+
+def test_asyncCallFuture():
+    def func():
+        return os.getpid()
+    def raiseFunc():
+        raise ValueError("test")
+    f1 = asyncCallFuture(func, name="test_asyncCallFuture")
+    f2 = asyncCallFuture(raiseFunc, name="test_asyncCallFuture")
+    assert f1.result() != os.getpid()
+    assert isinstance(f2.exception(), ValueError)
+    assert_equal(set(asCompleted([f1, f2])), set([f1, f2]))
+    f3 = asyncCallFuture(lambda: sys.exit(3), name="test_asyncCallFuture")
+    assert isinstance(f3.exception(timeout=60), SystemExit)
+
+
+def test_asyncCallMap():
+    def func(x):
+        return x * 2
+    assert_equal(list(asyncCallMap(func, range(10), maxWorkers=3)), [x * 2 for x in range(10)])
+    assert_equal(sorted(asyncCallMap(func, range(10), ordered=False, maxWorkers=3)), [x * 2 for x in range(10)])
+    assert_equal(list(asyncCallStarmap(lambda a, b: a + b, [(1, 2), (3, 4)])), [3, 7])
+
+
+def _checkWaitAsyncTasks(selector=None):
+    def func(task):
+        x = task.get()
+        if x is not None:
+            task.put(x)
+    tasks = [AsyncTask(func, name="test_waitAsyncTasks") for i in range(3)]
+    ready, notReady = waitAsyncTasks(tasks, timeout=0.1, selector=selector)
+    assert_equal(ready, set())
+    assert_equal(notReady, set(tasks))
+    if selector is not None:
+        assert_equal(set(selector.fds), set(tasks))  # stays registered
+    tasks[1].put(1)
+    ready, notReady = waitAsyncTasks(tasks, selector=selector)
+    assert_equal(ready, set([tasks[1]]))
+    assert_equal(tasks[1].get(), 1)
+    tasks[0].put(0)
+    tasks[2].put(None)  # will die without a message
+    ready, notReady = waitAsyncTasks(tasks[0::2], return_when=ALL_COMPLETED, selector=selector)
+    assert_equal(ready, set(tasks[0::2]))
+    if selector is not None:
+        assert tasks[1] not in selector.fds  # not waited for anymore
+    assert_equal(tasks[0].get(), 0)
+    try:
+        tasks[2].get()
+        raise Exception("Did not get an exception.")
+    except ProcConnectionDied:
+        pass
+    for task in tasks:
+        task.join()
+
+
+def test_waitAsyncTasks():
+    _checkWaitAsyncTasks()
+
+
+def test_waitAsyncTasks_selector():
+    selector = AsyncTaskSelector()
+    try:
+        _checkWaitAsyncTasks(selector)
+    finally:
+        selector.close()
+
+
+def test_waitAsyncTasks_manyFds():
+    oldMaxFds = TaskSystem._SelectMaxFds
+    TaskSystem._SelectMaxFds = 0  # i.e. a temporary AsyncTaskSelector, like for many tasks
+    try:
+        _checkWaitAsyncTasks()
+    finally:
+        TaskSystem._SelectMaxFds = oldMaxFds
+
+
+def test_ExecingProcess_join_timeout():
+    import time
+    def func(task):
+        task.get()
+    tasks = [AsyncTask(func, mustExec=True, name="test_ExecingProcess_join_timeout") for i in range(2)]
+    startTime = time.time()
+    tasks[0].join(timeout=0.2)
+    assert 0.15 < time.time() - startTime < 1.0
+    assert tasks[0].is_alive()
+    exited, notExited = waitProcesses([task.proc for task in tasks], timeout=0.01)
+    assert_equal(exited, set())
+    tasks[1].put(None)
+    exited, notExited = waitProcesses([task.proc for task in tasks])
+    assert_equal(exited, set([tasks[1].proc]))
+    startTime = time.time()
+    tasks[1].join(timeout=10)
+    assert time.time() - startTime < 1.0
+    assert not tasks[1].is_alive()
+    assert_equal(tasks[1].proc.exit_status, 0)
+    tasks[0].put(None)
+    tasks[0].join()
+
+
+def _openManyFds(n=1100):
+    """
+    :return: list of open fds, so that any new fd will be >= n, i.e. beyond select()'s FD_SETSIZE
+    :rtype: list[int]
+    """
+    fds = []
+    try:
+        while len(fds) < n:
+            fds.extend(os.pipe())
+    except Exception:
+        _closeFds(fds)
+        raise
+    return fds
+
+
+def _closeFds(fds):
+    for fd in fds:
+        os.close(fd)
+
+
+def test_ExecingProcess_join_manyFds():
+    fds = _openManyFds()
+    try:
+        def func(task):
+            task.put(task.get())
+        task = AsyncTask(func, mustExec=True, name="test_ExecingProcess_join_manyFds")
+        assert task.proc.sentinel >= 1024
+        task.put(42)
+        assert_equal(task.get(), 42)
+        task.join(timeout=5)
+        assert not task.is_alive()
+        assert_equal(task.proc.exit_status, 0)
+    finally:
+        _closeFds(fds)
+
+
+def test_asyncCall_execInMainProc_concurrent():
+    import time
+    import threading
+    def mainProcFunc(x):
+        time.sleep(0.5)
+        return x, os.getpid()
+    def func():
+        results = {}
+        def threadFunc(x):
+            results[x] = execInMainProc(lambda: mainProcFunc(x))
+        threads = [threading.Thread(target=threadFunc, args=(x,)) for x in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+    hostThreads = TaskSystem._AsyncCallQueue.HostThreads
+    TaskSystem._AsyncCallQueue.HostThreads = 3
+    try:
+        startTime = time.time()
+        results = asyncCall(func, name="test_asyncCall_execInMainProc_concurrent")
+        assert time.time() - startTime < 1.4
+        assert_equal(results, dict((x, (x, os.getpid())) for x in range(3)))
+    finally:
+        TaskSystem._AsyncCallQueue.HostThreads = hostThreads
+    # By default, they are executed one after another.
+    results = asyncCall(func, name="test_asyncCall_execInMainProc_concurrent")
+    assert_equal(results, dict((x, (x, os.getpid())) for x in range(3)))
+
+
+def test_ReadWriteLock():
+    for policy in [ReadWriteLock.ReaderPreferring, ReadWriteLock.WriterPreferring, ReadWriteLock.Fair]:
+        lock = ReadWriteLock(policy=policy)
+        with lock.readlock:
+            with lock.readlock:
+                pass
+        with lock.writelock:
+            with lock.readlock:
+                with lock.writelock:
+                    pass
+        with lock.upgradablereadlock:
+            with lock.writelock:
+                assert_equal(lock.stats()["writer"], True)
+        with lock.readlock:
+            with lock.writelock:  # upgrade
+                pass
+        stats = lock.stats()
+        assert_equal(stats["readers"], 0)
+        assert_equal(stats["writer"], False)
+        assert_equal(stats["writeAcquires"], 3)
+
+
+def test_ReadWriteLock_timeout_and_writer_preference():
+    import threading
+    import time
+    for policy in [ReadWriteLock.ReaderPreferring, ReadWriteLock.WriterPreferring]:
+        lock = ReadWriteLock(policy=policy)
+        gotWriteLock = threading.Event()
+        lock.acquireRead()
+        assert lock.acquireWrite(timeout=0.01)  # upgrade, we are the only reader
+        lock.releaseWrite()
+        def writer():
+            lock.acquireWrite()
+            gotWriteLock.set()
+            lock.releaseWrite()
+        def otherReader(res):
+            res.append(lock.acquireRead(timeout=0.1))
+            if res[-1]:
+                lock.releaseRead()
+        writerThread = threading.Thread(target=writer)
+        writerThread.start()
+        while lock.stats()["waitingWriters"] == 0:
+            time.sleep(0.001)
+        res = []
+        readerThread = threading.Thread(target=otherReader, args=(res,))
+        readerThread.start()
+        readerThread.join()
+        assert_equal(res, [policy == ReadWriteLock.ReaderPreferring])
+        assert not gotWriteLock.is_set()
+        lock.releaseRead()
+        writerThread.join()
+        assert gotWriteLock.is_set()
+        assert_equal(lock.stats()["readTimeouts"], 0 if policy == ReadWriteLock.ReaderPreferring else 1)
+
+
+def test_ReadWriteLock_upgrade_conflict():
+    import threading
+    lock = ReadWriteLock()
+    lock.acquireUpgradable()
+    res = []
+    def otherThread():
+        lock.acquireRead()
+        try:
+            lock.acquireWrite()
+        except RuntimeError:
+            res.append("RuntimeError")
+        lock.releaseRead()
+    thread = threading.Thread(target=otherThread)
+    thread.start()
+    thread.join()
+    assert_equal(res, ["RuntimeError"])
+    lock.releaseUpgradable()
+
+
+def test_ProcessReadWriteLock():
+    lock = ProcessReadWriteLock()
+    try:
+        def func(task):
+            assert not lock.acquireRead(timeout=0.1)
+            task.put("waiting")
+            with lock.readlock:
+                task.put("got readlock")
+        with lock.writelock:
+            task = AsyncTask(func=func, name="test_ProcessReadWriteLock", mustExec=True)
+            assert_equal(task.get(), "waiting")
+        assert_equal(task.get(), "got readlock")
+        task.join()
+    finally:
+        lock.close()
+
+
+def test_ProcessReadWriteLock_crashed_holder():
+    lock = ProcessReadWriteLock()
+    try:
+        def func(task):
+            lock.acquireWrite()
+            task.put("locked")
+            os._exit(1)  # without releasing
+        task = AsyncTask(func=func, name="test_ProcessReadWriteLock_crashed_holder")
+        assert_equal(task.get(), "locked")
+        task.join()
+        assert lock.acquireWrite(timeout=5)
+        lock.releaseWrite()
+    finally:
+        lock.close()
+
+
+def test_AsyncTask_stats():
+    numTasksBefore = asyncTaskStatsRegistry.aggregate()["numTasks"]
+    def func(task):
+        x = task.get()
+        task.put(x)
+        task.put(task.stats())
+    for mustExec in [False, True]:
+        task = AsyncTask(func=func, name="test_AsyncTask_stats", mustExec=mustExec)
+        task.put(b"x" * 1000)
+        assert_equal(task.get(), b"x" * 1000)
+        childStats = task.get()
+        task.join()
+        stats = task.stats()
+        assert_equal(stats["messagesSent"], 1)
+        assert_equal(stats["messagesReceived"], 2)
+        assert stats["bytesSent"] > 1000
+        assert_equal(childStats["messagesReceived"], 1)
+        assert_equal(childStats["bytesReceived"], stats["bytesSent"])
+        assert stats["spawnTime"] > 0
+        if mustExec:
+            assert stats["childMaxRss"] > 0
+            assert "childUserTime" in stats
+    total = asyncTaskStatsRegistry.aggregate()
+    assert_equal(total["numTasks"], numTasksBefore + 2)
+    assert total["messagesReceived"] >= 4
+
+
+def test_Tracing():
+    import shutil
+    import json
+    traceDir = Tracing.enable()
+    try:
+        def func():
+            return execInMainProc(lambda: 42) + 1
+        for mustExec in [False, True]:
+            assert_equal(asyncCall(func, name="test_Tracing", mustExec=mustExec), 43)
+        fn = os.path.join(traceDir, "trace.json")
+        Tracing.writeChromeTrace(fn)
+        with open(fn) as f:
+            events = json.load(f)["traceEvents"]
+    finally:
+        Tracing.disable()
+        shutil.rmtree(traceDir)
+    names = set([event["name"] for event in events])
+    for name in ["asyncCall", "spawn", "pickle target", "unpickle target", "AsyncTask", "asyncCall func",
+                 "execInMainProc", "execInMainProc host", "asyncCall send result", "send", "unpickle"]:
+        assert name in names, "%r not in %r" % (name, names)
+    pids = set([event["pid"] for event in events])
+    assert_equal(len(pids), 3)
+    assert not Tracing.isEnabled()
+
+
+def test_ExecingProcess_exitPipe_grandchild():
+    import signal
+    import time
+    def func(task):
+        import multiprocessing
+        import time
+        proc = multiprocessing.Process(target=time.sleep, args=(30,))
+        proc.start()
+        task.put(proc.pid)
+        os._exit(0)  # the grandchild is still alive
+    oldPidfdSupported = TaskSystem._pidfdSupported
+    TaskSystem._pidfdSupported = False  # use the exit pipe
+    try:
+        task = AsyncTask(func, name="test_ExecingProcess_exitPipe_grandchild", mustExec=True)
+    finally:
+        TaskSystem._pidfdSupported = oldPidfdSupported
+    grandchildPid = task.get()
+    try:
+        startTime = time.time()
+        task.join(timeout=10)
+        assert time.time() - startTime < 5
+        assert not task.is_alive()
+    finally:
+        os.kill(grandchildPid, signal.SIGKILL)
+
+
+def test_ExecingProcess_mainScript():
+    # In Python 3, multiprocessing registers the main script also as __mp_main__,
+    # and the exec'd child must be able to import it under that name.
+    import tempfile
+    import shutil
+    import subprocess
+    tmpDir = tempfile.mkdtemp()
+    try:
+        fn = os.path.join(tmpDir, "mainScript.py")
+        with open(fn, "w") as f:
+            f.write("\n".join([
+                "import multiprocessing",
+                "from TaskSystem import asyncCall",
+                "def func(): return 42",
+                "if __name__ == '__main__':",
+                "    print(asyncCall(func, name='test_ExecingProcess_mainScript', mustExec=True))",
+                ""]))
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join([os.path.dirname(os.path.abspath(TaskSystem.__file__))] + sys.path)
+        out = subprocess.check_output([sys.executable, fn], env=env)
+    finally:
+        shutil.rmtree(tmpDir)
+    assert_equal(out.decode("utf8").strip().splitlines()[-1], "42")
+
+
+def test_ExecingProcess_TargetCache():
+    def func(task):
+        task.put(task.get() + 1)
+    cache = ExecingProcess.TargetCache
+    with ExecingForkServer() as forkServer:
+        for i in range(3):
+            hits = cache.hits
+            task = AsyncTask(func, forkServer=forkServer, name="test_ExecingProcess_TargetCache")
+            task.put(i)
+            assert_equal(task.get(), i + 1)
+            task.join()
+            assert_equal(task.proc.exit_status, 0)
+            if i == 0:
+                numDigests = len(forkServer.codeDigests)
+                assert numDigests > 0
+            else:
+                assert cache.hits > hits
+                # The fork server already has all the code, i.e. we only sent digests.
+                assert_equal(len(forkServer.codeDigests), numDigests)
+
+
+def test_ExecingBootstrap_Fast():
+    def func(task):
+        assert_equal(task.get(), "ping")
+        task.put(("pong", "site" in sys.modules, sys.excepthook is sys.__excepthook__))
+    task = AsyncTask(func, name="test_ExecingBootstrap_Fast", mustExec=True, bootstrap=ExecingBootstrap.Fast)
+    report = task.proc.startupReport()
+    for key in ["interpreterStartup", "importTaskSystem", "preload", "unpickleTarget", "total"]:
+        assert report[key] >= 0, "%s: %r" % (key, report)
+    task.put("ping")
+    pong, haveSite, defaultExcepthook = task.get()
+    task.join()
+    assert_equal(pong, "pong")
+    assert not haveSite
+    assert not defaultExcepthook  # the lazy better_exchook
+    assert_equal(task.proc.exit_status, 0)
+
+
+def test_asyncCallIter():
+    def gen(n):
+        for i in range(n):
+            yield execInMainProc(lambda: i * 2)
+    for mustExec in [False, True]:
+        res = list(asyncCallIter(lambda: gen(20), name="test_asyncCallIter", mustExec=mustExec, window=4))
+        assert_equal(res, [i * 2 for i in range(20)])
+
+
+def test_asyncCallIter_exception():
+    def gen():
+        yield 1
+        raise ValueError("test_asyncCallIter_exception")
+    it = asyncCallIter(gen, name="test_asyncCallIter_exception")
+    assert_equal(next(it), 1)
+    try:
+        next(it)
+    except ValueError as exc:
+        assert_equal(str(exc), "test_asyncCallIter_exception")
+    else:
+        assert False, "expected ValueError"
+
+
+_asyncCallIter_cleanedUp = []
+
+
+def test_asyncCallIter_cancel():
+    cleanedUp = _asyncCallIter_cleanedUp  # module global, because execInMainProc pickles the function
+    def gen():
+        try:
+            i = 0
+            while True:  # infinite, so only the cancellation stops it
+                yield i
+                i += 1
+        finally:
+            execInMainProc(lambda: _asyncCallIter_cleanedUp.append(True))
+    for mustExec in [False, True]:
+        it = asyncCallIter(gen, name="test_asyncCallIter_cancel", mustExec=mustExec, window=2)
+        assert_equal([next(it) for i in range(5)], list(range(5)))
+        it.close()
+    assert_equal(cleanedUp, [True, True])
+
+
+def test_ExecingProcess_Pipe_Chunked():
+    import threading
+    oldChunkSize = ExecingProcess_ConnectionWrapper.ChunkSize
+    ExecingProcess_ConnectionWrapper.ChunkSize = 1000
+    try:
+        c1, c2 = ExecingProcess_Pipe()
+        c1.SharedMemThreshold = 100000
+        big = b"x" * (c1.SharedMemThreshold + 10)  # goes via shared memory
+        msgs = [
+            (1, "small"),
+            (2, [str(i) * 10 for i in range(1000)], b"y" * 12345),
+            (3, big, [u"\n".join(["line"] * 1000)]),
+            (4, "after abort")]
+        res = []
+        def reader():
+            for i in range(len(msgs)):
+                res.append(c2.recv())
+        thread = threading.Thread(target=reader)
+        thread.start()
+        for msg in msgs[:-1]:
+            c1.send(msg)
+        try:
+            c1.send(([b"z" * 100] * 100, threading.Lock()))  # fails after the first chunks
+        except Exception:
+            pass
+        else:
+            assert False, "expected pickle error"
+        c1.send(msgs[-1])
+        thread.join()
+        assert_equal(res, msgs)
+        assert_equal(c1.stats()["chunkedMessagesSent"], 2)
+        assert_equal(c2.stats()["chunkedMessagesReceived"], 2)
+        c1.close()
+        c2.close()
+    finally:
+        ExecingProcess_ConnectionWrapper.ChunkSize = oldChunkSize
+
+
+def _compressionEchoFunc(task):
+    while True:
+        x = task.get()
+        if x is None:
+            break
+        task.put(x)
+
+
+def test_AsyncTask_compression():
+    compressible = [b"abc" * 10000, [str(i % 10) * 100 for i in range(1000)]]
+    for mustExec in [False, True]:
+        task = AsyncTask(_compressionEchoFunc, name="test_AsyncTask_compression", mustExec=mustExec,
+                         compression=["nonexisting", "zlib"])
+        assert_equal(task.conn.compression, "zlib")
+        for x in compressible + [b"small"]:
+            task.put(x)
+            assert_equal(task.get(), x)
+        stats = task.conn.stats()
+        assert_equal(stats["compressedMessagesSent"], len(compressible))
+        assert stats["compressionSavedBytes"] > 0
+        task.put(None)
+        task.join()
+
+
+def test_ExecingProcess_Pipe_compression_backoff():
+    c1, c2 = ExecingProcess_Pipe()
+    c1.setCompression("zlib")
+    incompressible = os.urandom(ExecingProcess_ConnectionWrapper.CompressionThreshold * 2)
+    for i in range(4):
+        c1.send(incompressible)
+        assert_equal(c2.recv(), incompressible)
+    # 1st try, skip 1, 2nd try, skip 2.
+    assert_equal(c1.stats()["compressedMessagesSent"], 0)
+    assert_equal(c1.compressionSkip, 1)
+    c1.close()
+    c2.close()
+
+
+def test_WorkStealingScheduler():
+    def getWorker():
+        time.sleep(0.05)
+        return os.environ["TASKSYSTEM_TEST_WORKER"]
+    with WorkStealingScheduler(
+            name="test_WorkStealingScheduler", mustExec=True,
+            workerEnvUpdates=[{"TASKSYSTEM_TEST_WORKER": str(i)} for i in range(2)]) as scheduler:
+        # All queued at worker 0, but worker 1 steals.
+        futures = [scheduler.submit(getWorker, worker=0) for i in range(10)]
+        assert_equal(set(f.result() for f in futures), {"0", "1"})
+        stats = scheduler.stats()
+        assert_equal(sum(stats["executed"]), 10)
+        assert stats["stolen"][1] > 0
+        # Affinity: queued where the last call with the same key ran.
+        worker = scheduler.asyncCall(getWorker, affinity="data")
+        assert_equal(scheduler.affinities["data"], int(worker))
+        # A SystemExit from the child must not kill the dispatcher thread.
+        future = scheduler.submit(lambda: sys.exit(3), worker=0)
+        assert isinstance(future.exception(timeout=60), ProcConnectionDied)
+        assert scheduler.submit(getWorker, worker=0).result(timeout=60) in ("0", "1")
+        assert all(thread.is_alive() for thread in scheduler.threads)
+
+
+_WorkStealingScheduler_block = None
+
+
+def test_WorkStealingScheduler_priority():
+    import threading
+    global _WorkStealingScheduler_block
+    _WorkStealingScheduler_block = block = threading.Event()
+    def waitFunc():
+        execInMainProc(lambda: _WorkStealingScheduler_block.wait())
+    def timeFunc():
+        return time.time()
+    with WorkStealingScheduler(1, name="test_WorkStealingScheduler_priority") as scheduler:
+        first = scheduler.submit(waitFunc)
+        while scheduler.queueSizes()[0] > 0:
+            time.sleep(0.01)
+        low = scheduler.submit(timeFunc, priority=0)
+        cancelled = scheduler.submit(timeFunc, priority=5)
+        high = scheduler.submit(timeFunc, priority=10)
+        assert cancelled.cancel()
+        block.set()
+        first.result()
+        assert high.result() < low.result()
+        assert cancelled.cancelled()
+        assert_equal(scheduler.stats()["executed"], [3])
+
+
+def test_ProcessPlacement():
+    cpus = getCpuAffinity()
+    assert cpus
+    nodes = getNumaNodes()
+    assert_equal(sorted(sum(nodes.values(), [])), cpus)
+    placements = ProcessPlacement.spread(len(cpus) + 1, nice=1)
+    assert_equal(len(placements), len(cpus) + 1)
+    for placement in placements:
+        assert placement.cpus and set(placement.cpus) <= set(cpus)
+    def func():
+        return getCpuAffinity(), os.nice(0)
+    for mustExec in [False, True]:
+        task = AsyncTask(
+            lambda task: task.put(func()), name="test_ProcessPlacement", mustExec=mustExec,
+            placement=ProcessPlacement(cpus=cpus[-1:], nice=1, schedPolicy="batch"))
+        assert_equal(task.get(), (cpus[-1:], os.nice(0) + 1))
+        task.join()
+
+
+def test_TaskPool_recycling():
+    def func():
+        return os.getpid()
+    with TaskPool(1, name="test_TaskPool_recycling", maxTasksPerWorker=2) as pool:
+        pids = [pool.asyncCall(func) for i in range(6)]
+        assert_equal(len(set(pids)), 3)
+        assert_equal(pids[0], pids[1])
+        assert_equal(pool.numRecycled, 3)
+        assert_equal(len(pool.workers), 1)
+    with TaskPool(1, name="test_TaskPool_recycling", maxWorkerRss=1) as pool:
+        assert pool.asyncCall(func) != pool.asyncCall(func)
+
+
+def test_ShmRing_Pipe():
+    import threading
+    c1, c2 = ShmRing_Pipe(capacity=1000)
+    assert not c2.poll()
+    msgs = [1, "small", b"x" * 12345, [str(i) for i in range(1000)]]  # some are larger than the ring
+    res = []
+    def reader():
+        for i in range(len(msgs)):
+            res.append(c2.recv())
+    thread = threading.Thread(target=reader)
+    thread.start()
+    for msg in msgs:
+        c1.send(msg)
+    thread.join()
+    assert_equal(res, msgs)
+    c2.send("back")
+    assert c1.poll(timeout=1)
+    assert_equal(c1.recv(), "back")
+    assert_equal(c1.stats()["messagesSent"], len(msgs))
+    c2.close()
+    try:
+        c1.recv()
+    except ProcConnectionDied:
+        pass
+    else:
+        assert False, "expected ProcConnectionDied"
+    c1.close()
+
+
+def test_ShmRing_Pipe_duplex():
+    # Both sides send and receive at the same time, with full rings, i.e. both doorbells are used.
+    import threading
+    c1, c2 = ShmRing_Pipe(capacity=100)
+    msgs = [b"x" * 1000] * 200
+    res = {}
+    def reader(conn):
+        res[conn] = [conn.recv() for _ in msgs]
+    threads = [threading.Thread(target=reader, args=(conn,)) for conn in (c1, c2)]
+    for thread in threads:
+        thread.start()
+    sender = threading.Thread(target=lambda: [c2.send(msg) for msg in msgs])
+    sender.start()
+    for msg in msgs:
+        c1.send(msg)
+    sender.join()
+    for thread in threads:
+        thread.join()
+    assert_equal(res[c1], msgs)
+    assert_equal(res[c2], msgs)
+    c1.close()
+    c2.close()
+
+
+def test_ShmRing_Pipe_manyFds():
+    # The doorbell fds are >= 1024, i.e. the waits in send/recv/poll must not use select().
+    import threading
+    fds = _openManyFds()
+    try:
+        c1, c2 = ShmRing_Pipe(capacity=100)
+        assert not c2.poll(timeout=0.01)
+        msgs = [b"x" * 1000] * 20  # larger than the ring, i.e. the writer waits for space
+        res = []
+        thread = threading.Thread(target=lambda: res.extend([c2.recv() for _ in msgs]))
+        thread.start()
+        for msg in msgs:
+            c1.send(msg)
+        thread.join()
+        assert_equal(res, msgs)
+        c2.send("back")
+        assert c1.poll(timeout=1)
+        assert_equal(c1.recv(), "back")
+        c1.close()
+        c2.close()
+    finally:
+        _closeFds(fds)
+
+
+def test_ShmRing_Pipe_unsupportedMachine():
+    # head/tail are published without memory barriers, which is only correct on x86.
+    oldMachines = TaskSystem._ShmRing.SupportedMachines
+    TaskSystem._ShmRing.SupportedMachines = ()
+    try:
+        ShmRing_Pipe()
+    except NotImplementedError:
+        pass
+    else:
+        assert False, "expected NotImplementedError"
+    finally:
+        TaskSystem._ShmRing.SupportedMachines = oldMachines
+
+
+def test_ShmMutex_ownerDied():
+    import mmap
+    if not TaskSystem._ShmMutex.isSupported():
+        from unittest import SkipTest
+        raise SkipTest("no process-shared robust pthread mutex")
+    mm = mmap.mmap(-1, TaskSystem._ShmMutex.Size)
+    TaskSystem._ShmMutex.initialize(mm, 0)
+    mutex = TaskSystem._ShmMutex(mm, 0)
+    pid = os.fork()
+    if pid == 0:
+        mutex.__enter__()
+        os._exit(0)  # dies while holding it
+    os.waitpid(pid, 0)
+    with mutex:  # recovered, i.e. this does not block forever
+        pass
+
+
+def test_AsyncTask_shmring():
+    def func(task):
+        while True:
+            x = task.get()
+            if x is None:
+                break
+            task.put(x + 1)
+    for kwargs in [{}, {"mustExec": True}]:
+        task = AsyncTask(func, name="test_AsyncTask_shmring", transport="shmring", **kwargs)
+        for i in range(100):
+            task.put(i)
+            assert_equal(task.get(), i + 1)
+        # There is no pollable fd, and that is rejected up front.
+        try:
+            waitAsyncTasks([task], timeout=0)
+        except ValueError:
+            pass
+        else:
+            assert False, "expected ValueError"
+        task.put(None)
+        task.join()
+        assert_equal(task.proc.exitcode if hasattr(task.proc, "exitcode") else task.proc.exit_status, 0)
+    task = AsyncTask(lambda task: None, name="test_AsyncTask_shmring", transport="shmring", mustExec=True)
+    try:
+        task.get()  # the child exits without sending anything
+    except ProcConnectionDied:
+        pass
+    else:
+        assert False, "expected ProcConnectionDied"
+    task.join()
+
+
+def _failLoad(data):
+    raise ValueError("test")
+
+
+class _SessionUnloadable(object):
+    def __reduce__(self):
+        return _failLoad, (b"x" * 1000,)
+
+
+def test_ExecingProcess_Pipe_session():
+    import threading
+    c1, c2 = ExecingProcess_Pipe()
+    c1.enableSession(maxObjects=3, minSize=100)
+    vocab = dict(("word%i" % i, i) for i in range(1000))
+    c1.shareInSession(vocab)
+    big = b"x" * 10000
+    func = lambda x: x + 1
+    c1.send((vocab, big, func))
+    vocab2, big2, func2 = c2.recv()
+    assert_equal((vocab2, big2, func2(1)), (vocab, big, 2))
+    bytesSent = c1.stats()["bytesSent"]
+    c1.send((vocab, big, big))
+    res = c2.recv()
+    assert res[0] is vocab2 and res[1] is big2 and res[2] is big2
+    assert c1.stats()["bytesSent"] - bytesSent < 1000
+    assert_equal(c1.stats()["sessionHits"], 3)
+    # A failed message must not desync the tables.
+    try:
+        c1.send((b"y" * 1000, threading.Lock()))
+    except Exception:
+        pass
+    else:
+        assert False, "expected pickle error"
+    c1.send(b"y" * 1000)
+    assert_equal(c2.recv(), b"y" * 1000)
+    # Eviction: only 3 objects are kept.
+    for i in range(5):
+        c1.send((str(i) * 1000, big))
+        assert_equal(c2.recv(), (str(i) * 1000, big))
+    assert_equal(c1.stats()["sessionObjects"], 3)
+    assert len(c2.recvSession) <= 4
+    # If the receiver fails to unpickle, the objects of the message which did load are kept,
+    # and back-references to the failed one give a clear error.
+    z = b"z" * 1000
+    bad = _SessionUnloadable()
+    c1.shareInSession(bad)
+    c1.send((z, bad))
+    try:
+        c2.recv()
+    except ValueError:
+        pass
+    else:
+        assert False, "expected unpickle error"
+    sessionHits = c1.stats()["sessionHits"]
+    c1.send(z)
+    assert_equal(c2.recv(), z)
+    assert_equal(c1.stats()["sessionHits"], sessionHits + 1)
+    c1.send(bad)
+    try:
+        c2.recv()
+    except pickle.UnpicklingError as exc:
+        assert "failed to unpickle earlier" in str(exc)
+    else:
+        assert False, "expected unpickle error"
+    c1.close()
+    c2.close()
+
+
+def test_AsyncTask_pickleSession():
+    def func(task):
+        x = task.get()
+        for i in range(3):
+            task.put(x)
+    task = AsyncTask(func, name="test_AsyncTask_pickleSession", mustExec=True, pickleSession={"minSize": 100})
+    task.put(b"x" * 10000)
+    res = [task.get() for i in range(3)]
+    assert_equal(res, [b"x" * 10000] * 3)
+    assert res[0] is res[1] is res[2]
+    task.join()
+
+
+def test_AsyncCallCache():
+    import tempfile
+    import shutil
+    import threading
+    def slowFunc():
+        time.sleep(0.2)
+        return os.getpid()
+    def raiseFunc():
+        raise ValueError("test_AsyncCallCache")
+    cacheDir = tempfile.mkdtemp()
+    try:
+        cache = AsyncCallCache(cacheDir=cacheDir)
+        # Single-flight: concurrent calls share one child.
+        res = []
+        threads = [threading.Thread(target=lambda: res.append(asyncCall(slowFunc, cache=cache))) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert_equal(len(res), 3)
+        assert_equal(len(set(res)), 1)
+        assert_equal(asyncCall(slowFunc, cache=cache), res[0])
+        stats = cache.stats()
+        assert_equal(stats["misses"], 1)
+        assert_equal(stats["sharedCalls"] + stats["hits"], 3)
+        # Disk tier.
+        cache2 = AsyncCallCache(cacheDir=cacheDir)
+        assert_equal(cache2.asyncCall(slowFunc), res[0])
+        assert_equal(cache2.stats()["diskHits"], 1)
+        # TTL.
+        assert cache2.asyncCall(slowFunc, key="ttl", ttl=0.01) != res[0]
+        time.sleep(0.02)
+        cache2.asyncCall(slowFunc, key="ttl", ttl=0.01)
+        assert_equal(cache2.stats()["misses"], 2)
+        # Exceptions are not cached.
+        for i in range(2):
+            try:
+                cache.asyncCall(raiseFunc)
+            except ValueError:
+                pass
+            else:
+                assert False, "expected ValueError"
+        assert_equal(cache.stats()["misses"], 3)
+        # Size based eviction.
+        cache3 = AsyncCallCache(maxEntries=1)
+        cache3.put("a", b"1")
+        cache3.put("b", b"2")
+        assert_equal((cache3.get("a"), cache3.get("b")), (None, b"2"))
+        # Not picklable, but it works via fork. Then it is not cached, unless there is an explicit key.
+        lock = threading.Lock()
+        def lockFunc():
+            with lock:
+                return os.getpid()
+        cache4 = AsyncCallCache()
+        assert cache4.makeKey(lockFunc) is None
+        assert asyncCall(lockFunc, cache=cache4) != asyncCall(lockFunc, cache=cache4)
+        assert_equal(cache4.stats()["uncachable"], 2)
+        assert_equal(cache4.stats()["misses"], 0)
+        assert_equal(cache4.asyncCall(lockFunc, key="lockFunc"), cache4.asyncCall(lockFunc, key="lockFunc"))
+        assert_equal(cache4.stats()["hits"], 1)
+    finally:
+        shutil.rmtree(cacheDir)